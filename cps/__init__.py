@@ -67,6 +67,8 @@ mimetypes.add_type('application/x-tar', '.cbt')
 mimetypes.add_type('application/x-7z-compressed', '.cb7')
 mimetypes.add_type('image/vnd.djvu', '.djv')
 mimetypes.add_type('image/vnd.djvu', '.djvu')
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
 mimetypes.add_type('application/mpeg', '.mpeg')
 mimetypes.add_type('audio/mpeg', '.mp3')
 mimetypes.add_type('audio/x-m4a', '.m4a')
@@ -221,6 +223,9 @@ def create_app():
     from .schedule import register_scheduled_tasks, register_startup_tasks
     register_scheduled_tasks(config.schedule_reconnect)
     register_startup_tasks()
+    # queue the tasks interrupted by the last shutdown again
+    from .services.worker import WorkerThread
+    WorkerThread.get_instance().restore_tasks()
 
     return app
 
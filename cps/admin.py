@@ -45,7 +45,7 @@ from sqlalchemy.sql.expression import func, or_, text
 
 from . import constants, logger, helper, services, cli_param
 from . import db, calibre_db, ub, web_server, config, updater_thread, gdriveutils, \
-    kobo_sync_status, schedule
+    kobo_sync_status, schedule, change_feed
 from .helper import check_valid_domain, send_test_mail, reset_password, generate_password_hash, check_email, \
     valid_email, check_username
 from .embed_helper import get_calibre_binarypath
@@ -146,6 +146,7 @@ def shutdown():
     if task in (0, 1):  # valid commandos received
         # close all database connections
         ub.dispose()
+        calibre_db.dispose()
 
         if task == 0:
             show_text['text'] = _('Server restarted, please reload page.')
@@ -584,7 +585,10 @@ def update_view_configuration():
         flash(_("Invalid Restricted Column"), category="error")
         log.debug("Invalid Restricted Column")
         return view_configuration()
-    _config_int(to_save, "config_restricted_column")
+    if _config_int(to_save, "config_restricted_column"):
+        # the books visible to the users change, the ones not synced yet are queued with the next Kobo sync
+        change_feed.record(ub.BookChange.KIND_VISIBILITY, None)
+        ub.session_commit()
 
     _config_int(to_save, "config_theme")
     _config_int(to_save, "config_random_books")
@@ -949,6 +953,7 @@ def ajax_pathchooser():
 
 def do_full_kobo_sync(userid):
     count = ub.session.query(ub.KoboSyncedBooks).filter(userid == ub.KoboSyncedBooks.user_id).delete()
+    change_feed.record_all_books(calibre_db.session, int(userid))
     message = _("{} sync entries deleted").format(count)
     ub.session_commit(message)
     return make_response(jsonify(type="success", message=message))
@@ -1745,6 +1750,8 @@ def _db_configuration_update_helper():
         if not os.path.exists(metadata_db) or not to_save['config_calibre_dir']:
             return _db_configuration_result(_('DB Location is not Valid, Please Enter Correct Path'), gdrive_error)
         else:
+            # drop pooled connections, they may still point to the old database file
+            calibre_db.dispose()
             calibre_db.setup_db(to_save['config_calibre_dir'], ub.app_DB_path)
         # if db changed -> delete shelfs, delete download books, delete read books, kobo sync...
         if db_change:
@@ -1757,6 +1764,7 @@ def _db_configuration_update_helper():
             ub.session.query(ub.KoboReadingState).delete()
             ub.session.query(ub.KoboStatistics).delete()
             ub.session.query(ub.KoboSyncedBooks).delete()
+            ub.session.query(ub.BookChange).delete()
             helper.delete_thumbnail_cache()
             ub.session_commit()
             # deleted visibilities based on custom column and tags
@@ -2002,6 +2010,7 @@ def _delete_user(content):
             ub.session.query(ub.RemoteAuthToken).filter(ub.RemoteAuthToken.user_id == content.id).delete()
             ub.session.query(ub.User_Sessions).filter(ub.User_Sessions.user_id == content.id).delete()
             ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.user_id == content.id).delete()
+            ub.session.query(ub.BookChange).filter(ub.BookChange.user_id == content.id).delete()
             # delete KoboReadingState and all it's children
             kobo_entries = ub.session.query(ub.KoboReadingState).filter(ub.KoboReadingState.user_id == content.id).all()
             for kobo_entry in kobo_entries:
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Change feed of books, archive bits and reading states (book_change table in app.db) used by the Kobo sync.
+# Devices remember the sequence number of the last change they received and page through newer changes,
+# instead of comparing the whole library with the list of synced books on every sync.
+# Reading state changes, books added to synced shelves and changed restrictions of users are recorded by
+# ub.record_book_changes, changes of the library itself are found by comparing last_modified of the books with the
+# newest change seen so far. These are appended in the order of last_modified, so the position of a device in the
+# feed follows from the last_modified of the newest book it has seen.
+
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.sql.expression import or_, func
+
+from . import logger, ub
+
+log = logger.create()
+
+_scan_lock = threading.Lock()
+_scanned_generation = None
+
+
+def record(kind, book_id, user_id=None, session=None):
+    """Adds a change to the session, it's stored with the next commit"""
+    (session or ub.session).add(ub.BookChange(kind=kind, book_id=book_id, user_id=user_id))
+
+
+def scan_library(calibre_session, generation):
+    """Records all books modified in metadata.db since the last scan, nothing is done as long as the
+    library generation (modification time of metadata.db) is unchanged"""
+    global _scanned_generation
+    with _scan_lock:
+        if generation is not None and generation == _scanned_generation:
+            return
+        watermark = ub.session.query(func.max(ub.BookChange.book_modified)).scalar()
+        if watermark:
+            changed = calibre_session.execute(text("SELECT id, last_modified FROM books WHERE last_modified > :last "
+                                                   "ORDER BY last_modified, id"), {"last": watermark}).fetchall()
+        else:
+            changed = calibre_session.execute(text("SELECT id, last_modified FROM books "
+                                                   "ORDER BY last_modified, id")).fetchall()
+        if changed:
+            log.debug("Change feed: {} changed books found in library".format(len(changed)))
+            ub.session.bulk_insert_mappings(ub.BookChange, [{"kind": ub.BookChange.KIND_BOOK,
+                                                             "book_id": row[0],
+                                                             "book_modified": str(row[1])} for row in changed])
+            ub.session_commit()
+            compact()
+        _scanned_generation = generation
+
+
+def record_all_books(calibre_session, user_id):
+    """Queues all books of the library for the user, used to force a full sync"""
+    ub.session.bulk_insert_mappings(ub.BookChange, [{"kind": ub.BookChange.KIND_BOOK, "book_id": row[0],
+                                                     "user_id": user_id}
+                                                    for row in calibre_session.execute(text("SELECT id FROM books"))])
+
+
+def record_books(book_ids, user_id):
+    """Queues the books for the user, used for the books the user can see after the restrictions changed"""
+    ub.session.bulk_insert_mappings(ub.BookChange, [{"kind": ub.BookChange.KIND_BOOK, "book_id": book_id,
+                                                     "user_id": user_id} for book_id in book_ids])
+
+
+def get_position(books_last_modified):
+    """Sequence number of the last library change older than books_last_modified, used for sync tokens
+    written before the change feed existed"""
+    # calibre stores last_modified with time zone, the token holds it in UTC without
+    return ub.session.query(func.max(ub.BookChange.id)).filter(
+        func.julianday(ub.BookChange.book_modified) <= func.julianday(str(books_last_modified))).scalar() or 0
+
+
+def compact():
+    """Removes all changes superseded by a newer change of the same kind for the same book and user,
+    the change holding the newest modification time of the library is kept"""
+    try:
+        ub.session.execute(text(
+            "DELETE FROM book_change WHERE id NOT IN "
+            "(SELECT max(id) FROM book_change GROUP BY kind, book_id, user_id) "
+            "AND (book_modified IS NULL OR book_modified < (SELECT max(book_modified) FROM book_change))"))
+        ub.session_commit()
+    except Exception as ex:
+        log.error_or_exception(ex)
+        ub.session.rollback()
+
+
+def get_changes(user_id, last_id, limit):
+    """Returns the next changes concerning the user after the change with last_id, ordered by sequence number"""
+    return (ub.session.query(ub.BookChange)
+            .filter(ub.BookChange.id > last_id)
+            .filter(or_(ub.BookChange.user_id == None, ub.BookChange.user_id == user_id))
+            .order_by(ub.BookChange.id)
+            .limit(limit).all())
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Single pages of comic archives (cbz, cbr, cbt) for the comic reader.
+# Opened archives together with their sorted page index are kept per (file, modification time), so turning a page
+# only reads that entry, recently read (and prefetched) pages are kept in memory up to a size limit.
+
+import os
+import threading
+import zipfile
+import tarfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+
+try:
+    from natsort import natsorted as sort
+except ImportError:
+    sort = sorted  # Just use regular sort then, may cause issues with badly named pages in cbz/cbr files
+
+try:
+    import rarfile
+    use_rarfile = True
+except (ImportError, SyntaxError):
+    use_rarfile = False
+
+try:
+    from wand.image import Image
+    use_IM = True
+except (ImportError, RuntimeError):
+    use_IM = False
+
+log = logger.create()
+
+ARCHIVE_CACHE_SIZE = 16
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+MAX_PREFETCH = 5
+PREFETCH_WORKERS = 2
+# pages waiting to be prefetched, further prefetch requests are ignored
+PREFETCH_QUEUE_LIMIT = 50
+
+PAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+COMIC_FORMATS = ('cbz', 'zip', 'cbr', 'rar', 'cbt', 'tar')
+
+
+class PageArchive:
+    def __init__(self, path, book_format, rar_executable=None):
+        book_format = book_format.lower()
+        if book_format in ('cbz', 'zip'):
+            self.archive = zipfile.ZipFile(path)
+            names = [info.filename for info in self.archive.infolist() if not info.is_dir()]
+            self._read = self.archive.read
+        elif book_format in ('cbr', 'rar'):
+            if not use_rarfile:
+                raise ValueError('Unrar is not supported please install python rarfile extension')
+            if rar_executable:
+                rarfile.UNRAR_TOOL = rar_executable
+            self.archive = rarfile.RarFile(path)
+            names = [info.filename for info in self.archive.infolist() if not info.isdir()]
+            self._read = self.archive.read
+        elif book_format in ('cbt', 'tar'):
+            self.archive = tarfile.TarFile(path)
+            names = [member.name for member in self.archive.getmembers() if member.isfile()]
+            self._read = lambda name: self.archive.extractfile(name).read()
+        else:
+            raise ValueError('Unsupported comic format {}'.format(book_format))
+        # files in __MACOSX are resource forks of the pages, not images
+        self.pages = sort([name for name in names if os.path.splitext(name)[1].lower() in PAGE_EXTENSIONS
+                           and "__MACOSX" not in name])
+        # archive objects are not safe to read from concurrently
+        self.lock = threading.Lock()
+
+    def read(self, page):
+        with self.lock:
+            return self._read(self.pages[page])
+
+    def close(self):
+        with self.lock:
+            self.archive.close()
+
+
+_archives = OrderedDict()
+_archives_lock = threading.Lock()
+
+_pages = OrderedDict()
+_pages_size = 0
+_pages_lock = threading.Lock()
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='comic_prefetch')
+_prefetching = set()
+
+
+def _archive_key(path):
+    return path, os.path.getmtime(path)
+
+
+def get_archive(path, book_format, rar_executable=None):
+    """Returns the opened archive, a changed file is opened again"""
+    key = _archive_key(path)
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive:
+            _archives.move_to_end(key)
+            return archive
+    archive = PageArchive(path, book_format, rar_executable)
+    stale = list()
+    with _archives_lock:
+        if key in _archives:
+            stale.append(archive)
+            archive = _archives[key]
+        else:
+            # an older version of the same file is not going to be read again
+            stale.extend(_archives.pop(k) for k in [k for k in _archives if k[0] == path])
+            _archives[key] = archive
+            while len(_archives) > ARCHIVE_CACHE_SIZE:
+                stale.append(_archives.popitem(last=False)[1])
+    for old in stale:
+        old.close()
+    return archive
+
+
+def _cached_page(key):
+    with _pages_lock:
+        data = _pages.get(key)
+        if data is not None:
+            _pages.move_to_end(key)
+        return data
+
+
+def _cache_page(key, data):
+    global _pages_size
+    if len(data) > PAGE_CACHE_BYTES // 4:
+        return
+    with _pages_lock:
+        if key in _pages:
+            return
+        _pages[key] = data
+        _pages_size += len(data)
+        while _pages_size > PAGE_CACHE_BYTES:
+            _pages_size -= len(_pages.popitem(last=False)[1])
+
+
+def resize_page(data, width):
+    """Scales the page down to the given width, the original is returned if that's not possible"""
+    if not use_IM:
+        return data
+    try:
+        with Image(blob=data) as img:
+            if img.width <= width:
+                return data
+            img.transform(resize='{}x'.format(width))
+            return img.make_blob()
+    except Exception as ex:
+        log.debug('Cannot resize comic page: %s', ex)
+        return data
+
+
+def get_page(path, book_format, page, width=None, rar_executable=None):
+    """Returns the name and content of the page, optionally downscaled to the width"""
+    archive = get_archive(path, book_format, rar_executable)
+    name = archive.pages[page]
+    key = _archive_key(path) + (page, width)
+    data = _cached_page(key)
+    if data is None:
+        original_key = key[:-1] + (None,)
+        data = _cached_page(original_key)
+        if data is None:
+            data = archive.read(page)
+            _cache_page(original_key, data)
+        if width:
+            resized = resize_page(data, width)
+            if resized is not data:
+                _cache_page(key, resized)
+            data = resized
+    return name, data
+
+
+def _prefetch_page(key, path, book_format, page, width, rar_executable):
+    try:
+        get_page(path, book_format, page, width, rar_executable)
+    except Exception as ex:
+        log.debug('Prefetching page %s of %s failed: %s', page, path, ex)
+    finally:
+        with _pages_lock:
+            _prefetching.discard(key)
+
+
+def prefetch(path, book_format, pages, width=None, rar_executable=None):
+    """Reads the pages into the page cache in the background"""
+    for page in pages:
+        key = _archive_key(path) + (page, width)
+        with _pages_lock:
+            if key in _pages or key in _prefetching:
+                continue
+            if len(_prefetching) >= PREFETCH_QUEUE_LIMIT:
+                return
+            _prefetching.add(key)
+        _prefetch_executor.submit(_prefetch_page, key, path, book_format, page, width, rar_executable)
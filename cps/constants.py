@@ -48,9 +48,33 @@ CACHE_DIRECTORY = os.environ.get(
 # an initial metadata manifest (prior to downloading videos or media) here:
 XKLB_DB_FILE      = "/library/calibre-web/xklb-metadata.db"
 
+# Store for the ids of the last search of every user ("add search results to shelf"), "memory" keeps them in this
+# process, "sqlite" in app.db so several worker processes share them
+SEARCH_RESULT_STORE = os.environ.get('SEARCH_RESULT_STORE', 'memory')
+SEARCH_RESULT_TTL = 3600  # seconds
+SEARCH_RESULT_MAX_USERS = 100
+SEARCH_RESULT_MAX_IDS = 200000  # total number of ids kept in memory over all users
+
+# Maximum number of background tasks running concurrently per task lane, can be changed with the environment variable
+# TASK_LANE_LIMITS, e.g. TASK_LANE_LIMITS="download=4,mail=8"
+TASK_LANE_LIMITS = {'default': 1, 'download': 2, 'metadata': 2, 'convert': 1, 'thumbnail': 4, 'mail': 4}
+for _lane_limit in os.environ.get('TASK_LANE_LIMITS', '').split(','):
+    if '=' in _lane_limit:
+        _lane, _limit = _lane_limit.split('=', 1)
+        if _limit.strip().isdigit() and int(_limit) > 0:
+            TASK_LANE_LIMITS[_lane.strip()] = int(_limit)
+
 # Maximum number of videos to download, from a playlist or channel
 MAX_VIDEOS_PER_DOWNLOAD = 100
 
+# Number of 'lb tubeadd' calls running at the same time while refreshing the metadata of the videos of a playlist,
+# can be changed with the environment variable METADATA_FETCH_WORKERS
+METADATA_FETCH_WORKERS = 4
+if os.environ.get('METADATA_FETCH_WORKERS', '').strip().isdigit() and int(os.environ['METADATA_FETCH_WORKERS']) > 0:
+    METADATA_FETCH_WORKERS = int(os.environ['METADATA_FETCH_WORKERS'])
+# Number of retries of a 'lb tubeadd' call that failed because another call was writing to the xklb database
+METADATA_FETCH_RETRIES = 3
+
 # Maximum number of gigabytes to download, from a playlist or channel (not yet implemented!)
 MAX_GB_PER_DOWNLOAD = 10
 
@@ -67,6 +91,8 @@ else:
 
 DEFAULT_SETTINGS_FILE = "app.db"
 DEFAULT_GDRIVE_FILE = "gdrive.db"
+# Sidecar database holding the full text search index, stored next to the settings database
+SEARCH_INDEX_FILE = "search_index.db"
 
 ROLE_USER               = 0 << 0
 ROLE_ADMIN              = 1 << 0
@@ -195,6 +221,7 @@ NIGHTLY_VERSION[1] = '$Format:%cI$'
 
 # CACHE
 CACHE_TYPE_THUMBNAILS    = 'thumbnails'
+CACHE_TYPE_TEXT          = 'text'
 
 # Thumbnail Types
 THUMBNAIL_TYPE_COVER     = 1
@@ -205,7 +232,12 @@ THUMBNAIL_TYPE_AUTHOR    = 3
 COVER_THUMBNAIL_ORIGINAL = 0
 COVER_THUMBNAIL_SMALL    = 1
 COVER_THUMBNAIL_MEDIUM   = 2
+COVER_THUMBNAIL_MEDIUM_LARGE = 3
 COVER_THUMBNAIL_LARGE    = 4
 
+# Formats of the generated cover thumbnails, served depending on the Accept header of the client. Formats not supported
+# by ImageMagick are skipped, add 'avif' to generate AVIF thumbnails as well (encoding is considerably slower)
+COVER_THUMBNAIL_FORMATS  = ['jpeg', 'webp']
+
 # clean-up the module namespace
 del sys, os, namedtuple
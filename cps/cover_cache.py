@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Cover files already resolved per (book id, resolution, preferred image format), so cover requests are answered
+# without database queries.
+# Entries are dropped whenever the thumbnails or the cover of a book change.
+
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = 20000
+
+_files = OrderedDict()
+_lock = threading.Lock()
+
+
+def get(book_id, resolution, image_format):
+    """Returns the (directory, filename) of the cover, None if it's not cached"""
+    key = (book_id, resolution, image_format)
+    with _lock:
+        entry = _files.get(key)
+        if entry:
+            _files.move_to_end(key)
+        return entry
+
+
+def add(book_id, resolution, image_format, directory, filename):
+    with _lock:
+        _files[(book_id, resolution, image_format)] = (directory, filename)
+        if len(_files) > CACHE_SIZE:
+            _files.popitem(last=False)
+
+
+def invalidate(book_id=None):
+    """Drops the cached covers of the book, of all books if book_id is None or not positive"""
+    with _lock:
+        if book_id is None or book_id <= 0:
+            _files.clear()
+        else:
+            for key in [key for key in _files if key[0] == book_id]:
+                del _files[key]
@@ -20,6 +20,9 @@
 import os
 import re
 import json
+import time
+import threading
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timezone
 from urllib.parse import quote
 import unidecode
@@ -27,7 +30,7 @@ import unidecode
 from uuid import uuid4
 
 from sqlite3 import OperationalError as sqliteOperationalError
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
 from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session, selectinload
@@ -39,15 +42,16 @@ try:
     from sqlalchemy.orm import declarative_base
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, select, type_coerce, UnaryExpression
+from sqlalchemy.sql import operators
 from sqlalchemy.ext.associationproxy import association_proxy
 from .cw_login import current_user
 from flask_babel import gettext as _
 from flask_babel import get_locale
 from flask import flash, g, Flask
 
-from . import logger, ub, isoLanguages
+from . import logger, ub, isoLanguages, search_index
 from .pagination import Pagination
 from .string_helper import strip_whitespaces
 
@@ -56,6 +60,11 @@ log = logger.create()
 cc_exceptions = ['composite', 'series']
 cc_classes = {}
 
+# Books columns usable for keyset pagination, Books.id is always added as tiebreaker
+KEYSET_COLUMNS = ['timestamp', 'sort', 'title', 'author_sort', 'pubdate', 'series_index']
+COUNT_CACHE_TTL = 60
+COUNT_CACHE_SIZE = 512
+
 Base = declarative_base()
 
 books_authors_link = Table('books_authors_link', Base.metadata,
@@ -551,6 +560,15 @@ class CalibreDB:
     config_calibre_dir = None
     app_db_path = None
 
+    # process wide engine and connection pool, shared by all requests and background tasks
+    engine = None
+    engine_key = None
+    session_factory = None
+    _engine_lock = threading.Lock()
+    pool_size = 10
+    # modification time of metadata.db at the last reconnect
+    library_generation = None
+
     def __init__(self, _app: Flask=None):  # , expire_on_commit=True, init=False):
         """ Initialize a new CalibreDB session
         """
@@ -661,9 +679,22 @@ class CalibreDB:
 
     def teardown(self, exception):
         ctx = g.get("lib_sql")
-        if ctx:
+        if ctx and not g.get("lib_sql_streaming"):
             ctx.close()
 
+    @staticmethod
+    def keep_session(generator):
+        """Keeps the session of the request open while the generator of a streamed response is running,
+        books loaded by the view can still load their relations lazily.
+        The session is closed by the teardown at the end of the stream (stream_with_context)"""
+        def stream():
+            try:
+                yield from generator
+            finally:
+                g.lib_sql_streaming = False
+        g.lib_sql_streaming = True
+        return stream()
+
     @property
     def session(self):
         # connect or get active connection
@@ -681,6 +712,47 @@ class CalibreDB:
     def connect(self):
         return self.setup_db(self.config_calibre_dir, self.app_db_path)
 
+    @classmethod
+    def _create_engine(cls, dbpath, app_db_path):
+        engine = create_engine('sqlite://',
+                               echo=False,
+                               isolation_level="SERIALIZABLE",
+                               connect_args={'check_same_thread': False},
+                               poolclass=QueuePool,
+                               pool_size=cls.pool_size,
+                               max_overflow=-1)
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, __):
+            # Attaching the databases and warming up the page cache is done only once per pooled connection
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute("attach database '{}' as calibre;".format(dbpath.replace("'", "''")))
+                cursor.execute("attach database '{}' as app_settings;".format(app_db_path.replace("'", "''")))
+                cursor.execute("attach database '{}' as search_index;".format(
+                    search_index.get_index_path(app_db_path).replace("'", "''")))
+                cursor.execute('PRAGMA calibre.cache_size = 10000;')
+            finally:
+                cursor.close()
+            dbapi_connection.create_function('uuid4', 0, lambda: str(uuid4()))
+            dbapi_connection.create_function("lower", 1, lcase)
+
+        return engine
+
+    @classmethod
+    def dispose(cls):
+        # invalidates the connection pool, connections still in use are closed after they are returned
+        with cls._engine_lock:
+            old_engine = cls.engine
+            cls.engine = None
+            cls.engine_key = None
+            cls.session_factory = None
+        if old_engine:
+            try:
+                old_engine.dispose()
+            except Exception as ex:
+                log.error_or_exception(ex)
+
     @classmethod
     def setup_db(cls, config_calibre_dir, app_db_path):
 
@@ -693,36 +765,37 @@ class CalibreDB:
             cls.config.invalidate()
             return None
 
-        try:
-            engine = create_engine('sqlite://',
-                                       echo=False,
-                                       isolation_level="SERIALIZABLE",
-                                       connect_args={'check_same_thread': False},
-                                       poolclass=StaticPool)
-            with engine.begin() as connection:
-                connection.execute(text('PRAGMA cache_size = 10000;'))
-                connection.execute(text("attach database '{}' as calibre;".format(dbpath.replace("'", "''"))))
-                connection.execute(text("attach database '{}' as app_settings;".format(app_db_path.replace("'", "''"))))
-
-            conn = engine.connect()
-            # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
-        except Exception as ex:
-            cls.config.invalidate(ex)
-            return None
+        with cls._engine_lock:
+            if cls.engine is None or cls.engine_key != (dbpath, app_db_path):
+                old_engine = cls.engine
+                try:
+                    engine = cls._create_engine(dbpath, app_db_path)
+                    with engine.begin() as conn:
+                        search_index.create_key_table(conn)
+                    with engine.connect() as conn:
+                        if not cc_classes:
+                            try:
+                                cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
+                                cls.setup_db_cc_classes(cc)
+                            except OperationalError as e:
+                                log.error_or_exception(e)
+                                engine.dispose()
+                                return None
+                    # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
+                except Exception as ex:
+                    cls.config.invalidate(ex)
+                    return None
+                cls.engine = engine
+                cls.engine_key = (dbpath, app_db_path)
+                cls.session_factory = sessionmaker(autocommit=False,
+                                                   autoflush=False,
+                                                   bind=engine, future=True)
+                if old_engine:
+                    old_engine.dispose()
+            session_factory = cls.session_factory
 
         cls.config.db_configured = True
-
-        if not cc_classes:
-            try:
-                cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
-                cls.setup_db_cc_classes(cc)
-            except OperationalError as e:
-                log.error_or_exception(e)
-                return None
-
-        return scoped_session(sessionmaker(autocommit=False,
-                                           autoflush=False,
-                                           bind=engine, future=True))
+        return scoped_session(session_factory)
 
 
     def get_book(self, book_id):
@@ -732,6 +805,19 @@ class CalibreDB:
         return self.session.query(Books).filter(Books.id == book_id). \
             filter(self.common_filters(allow_show_archived)).first()
 
+    def is_book_visible(self, book_id, allow_show_archived=False):
+        return self.session.query(Books.id).filter(Books.id == book_id). \
+            filter(self.common_filters(allow_show_archived)).first() is not None
+
+    def has_restrictions(self):
+        """Returns True if the language, tag or custom column restrictions of the current user hide books"""
+        if current_user.filter_language() != "all" \
+                or current_user.list_denied_tags() != [''] or current_user.list_allowed_tags() != ['']:
+            return True
+        if self.config.config_restricted_column:
+            return bool(current_user.allowed_column_value or current_user.denied_column_value)
+        return False
+
     def get_book_read_archived(self, book_id, read_column, allow_show_archived=False):
         if not read_column:
             bd = (self.session.query(Books, ub.ReadBook.read_status, ub.ArchivedBook.is_archived).select_from(Books)
@@ -773,11 +859,11 @@ class CalibreDB:
     # Language and content filters for displaying in the UI
     def common_filters(self, allow_show_archived=False, return_all_languages=False):
         if not allow_show_archived:
-            archived_books = (ub.session.query(ub.ArchivedBook)
-                              .filter(ub.ArchivedBook.user_id==int(current_user.id))
-                              .filter(ub.ArchivedBook.is_archived==True)
-                              .all())
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
+            # app.db is attached to the calibre connection, the archived books are evaluated inside the query
+            archived_book_ids = (select(ub.ArchivedBook.book_id)
+                                 .where(ub.ArchivedBook.user_id == int(current_user.id))
+                                 .where(ub.ArchivedBook.is_archived == True)
+                                 .scalar_subquery())
             archived_filter = Books.id.notin_(archived_book_ids)
         else:
             archived_filter = true()
@@ -855,12 +941,12 @@ class CalibreDB:
 
     # Fill indexpage with all requested data from database
     def fill_indexpage(self, page, pagesize, database, db_filter, order,
-                       join_archive_read=False, config_read_column=0, *join):
+                       join_archive_read=False, config_read_column=0, *join, cursor=None):
         return self.fill_indexpage_with_archived_books(page, database, pagesize, db_filter, order, False,
-                                                       join_archive_read, config_read_column, *join)
+                                                       join_archive_read, config_read_column, *join, cursor=cursor)
 
     def fill_indexpage_with_archived_books(self, page, database, pagesize, db_filter, order, allow_show_archived,
-                                           join_archive_read, config_read_column, *join):
+                                           join_archive_read, config_read_column, *join, cursor=None):
         pagesize = pagesize or self.config.config_books_per_page
         if current_user.show_detail_random():
             random_query = self.generate_linked_query(config_read_column, database)
@@ -892,17 +978,101 @@ class CalibreDB:
                 element += 1
         query = query.filter(db_filter)\
             .filter(self.common_filters(allow_show_archived))
+        # keyset pagination is used if the caller opted in with a cursor ("" for the first page) and the order allows it
+        keyset = self.keyset_order(order) if cursor is not None else None
         entries = list()
         pagination = list()
         try:
-            pagination = Pagination(page, pagesize, query.count())
-            entries = query.order_by(*order).offset(off).limit(pagesize).all()
+            if keyset:
+                column, descending = keyset
+                pagination = Pagination(page, pagesize, self.cached_count(query))
+                query = query.order_by(column.desc() if descending else column,
+                                       Books.id.desc() if descending else Books.id)
+                position = self.decode_cursor(cursor)
+                if position:
+                    entries = query.filter(self.keyset_filter(column, descending, *position)).limit(pagesize).all()
+                else:
+                    entries = query.offset(off).limit(pagesize).all()
+                if len(entries) == int(pagesize):
+                    last = entries[-1].Books if join_archive_read else entries[-1]
+                    pagination.next_cursor = self.encode_cursor(column, last.id)
+            else:
+                pagination = Pagination(page, pagesize, query.count())
+                entries = query.order_by(*order).offset(off).limit(pagesize).all()
         except Exception as ex:
             log.error_or_exception(ex)
         # display authors in right order
         entries = self.order_authors(entries, True, join_archive_read)
         return entries, randm, pagination
 
+    @staticmethod
+    def keyset_order(order):
+        """Returns the Books column and direction of the order, None if the order can't be paginated by keyset"""
+        if len(order) != 1:
+            return None
+        element = order[0]
+        descending = False
+        if isinstance(element, UnaryExpression):
+            if element.modifier is operators.desc_op:
+                descending = True
+            elif element.modifier is not operators.asc_op:
+                return None
+            element = element.element
+        if hasattr(element, '__clause_element__'):
+            element = element.__clause_element__()
+        if getattr(element, 'table', None) is not Books.__table__ or element.key not in KEYSET_COLUMNS:
+            return None
+        return getattr(Books, element.key), descending
+
+    @staticmethod
+    def keyset_filter(column, descending, value, book_id):
+        # values are compared as stored in the database, null values are sorted first in ascending order
+        raw_column = type_coerce(column, String)
+        if value is None:
+            if descending:
+                return and_(column.is_(None), Books.id < book_id)
+            return or_(and_(column.is_(None), Books.id > book_id), column.isnot(None))
+        if descending:
+            return or_(raw_column < value, and_(raw_column == value, Books.id < book_id), column.is_(None))
+        return or_(raw_column > value, and_(raw_column == value, Books.id > book_id))
+
+    def encode_cursor(self, column, book_id):
+        value = self.session.query(type_coerce(column, String)).filter(Books.id == book_id).scalar()
+        return urlsafe_b64encode(json.dumps([value, book_id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if not cursor:
+            return None
+        try:
+            value, book_id = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+            if not isinstance(value, (str, int, float, type(None))):
+                return None
+            return value, int(book_id)
+        except (ValueError, TypeError, UnicodeError):
+            log.debug("Invalid pagination cursor: {}".format(cursor))
+            return None
+
+    _count_cache = dict()
+    _count_cache_lock = threading.Lock()
+
+    def cached_count(self, query):
+        """Counts the query result, the count is reused for COUNT_CACHE_TTL seconds as long as metadata.db
+        is unchanged, so paging through a large result doesn't count all matching books on every page"""
+        statement = query.statement.compile()
+        key = (str(statement), repr(sorted(statement.params.items())), self.get_library_generation())
+        now = time.monotonic()
+        with self._count_cache_lock:
+            cached = self._count_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        count = query.count()
+        with self._count_cache_lock:
+            if len(self._count_cache) >= COUNT_CACHE_SIZE:
+                self._count_cache.clear()
+            self._count_cache[key] = (now + COUNT_CACHE_TTL, count)
+        return count
+
     # Orders all Authors in the list according to authors sort
     def order_authors(self, entries, list_return=False, combined=False):
         for entry in entries:
@@ -952,7 +1122,7 @@ class CalibreDB:
         query = query or ''
         self.create_functions()
         entries = self.session.query(database).filter(tag_filter). \
-            filter(func.lower(database.name).ilike("%" + query + "%")).all()
+            filter(search_index.key_filter(database.__tablename__, database.id, database.name, query)).all()
         json_dumps = json.dumps([dict(name=r.name.replace(*replace)) for r in entries])
         return json_dumps
 
@@ -961,41 +1131,18 @@ class CalibreDB:
         q = list()
         author_terms = re.split(r'\s*&\s*', authr)
         for author_term in author_terms:
-            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + author_term + "%")))
+            q.append(Books.authors.any(search_index.key_filter('authors', Authors.id, Authors.name, author_term)))
 
         return self.session.query(Books) \
-            .filter(and_(Books.authors.any(and_(*q)), func.lower(Books.title).ilike("%" + title + "%"))).first()
+            .filter(and_(Books.authors.any(and_(*q)),
+                         search_index.key_filter('books', Books.id, Books.title, title))).first()
 
     def search_query(self, term, config, *join):
         term = strip_whitespaces(term).lower()
         self.create_functions()
 
-        # Try FTS5 search first for better performance
-        fts_ids = None
-        # Check if FTS5 table exists before attempting search
-        if not hasattr(self, '_fts_available'):
-            try:
-                result = self.session.execute(
-                    text("SELECT name FROM sqlite_master WHERE type='table' AND name='books_fts'")
-                ).fetchone()
-                self._fts_available = result is not None
-            except Exception:
-                self._fts_available = False
-
-        if self._fts_available:
-            try:
-                # Escape FTS5 special characters to prevent query errors
-                term_fts = term.replace('"', '""')
-                # Wrap in quotes for phrase matching and better accuracy
-                fts_results = self.session.execute(
-                    text("SELECT DISTINCT rowid FROM books_fts WHERE books_fts MATCH :term"),
-                    {"term": f'"{term_fts}"'}
-                ).fetchall()
-                if fts_results:
-                    fts_ids = [r[0] for r in fts_results]
-            except Exception as ex:
-                # FTS5 query failed, fall back to traditional search
-                log.debug("FTS5 search failed for term '{}', using fallback: {}".format(term, ex))
+        # Use the full text index if it has been built
+        fts_query = search_index.search(self.session, term)
 
         # Build base query with optimized joins
         base_query = self.generate_linked_query(config.config_read_column, Books)
@@ -1013,11 +1160,7 @@ class CalibreDB:
         elif len(join) == 1:
             base_query = base_query.outerjoin(join[0])
 
-        # If FTS5 found results, use those IDs
-        if fts_ids:
-            return base_query.filter(Books.id.in_(fts_ids))
-
-        # Fallback to traditional search with optimized subqueries
+        # Traditional search with optimized subqueries, used for books not yet part of the full text index
         author_terms = re.split("[, ]+", term)
 
         # Use subquery for authors to avoid expensive .any() with OR
@@ -1026,7 +1169,7 @@ class CalibreDB:
         )
         author_filters = []
         for author_term in author_terms:
-            author_filters.append(func.lower(Authors.name).ilike("%" + author_term + "%"))
+            author_filters.append(search_index.key_filter('authors', Authors.id, Authors.name, author_term))
         if author_filters:
             author_subquery = author_subquery.filter(and_(*author_filters))
 
@@ -1035,15 +1178,15 @@ class CalibreDB:
         filter_expression = [
             Books.id.in_(self.session.query(books_tags_link.c.book).join(
                 Tags, books_tags_link.c.tag == Tags.id
-            ).filter(func.lower(Tags.name).ilike("%" + term + "%"))),
+            ).filter(search_index.key_filter('tags', Tags.id, Tags.name, term))),
             Books.id.in_(self.session.query(books_series_link.c.book).join(
                 Series, books_series_link.c.series == Series.id
-            ).filter(func.lower(Series.name).ilike("%" + term + "%"))),
+            ).filter(search_index.key_filter('series', Series.id, Series.name, term))),
             Books.id.in_(author_subquery),
             Books.id.in_(self.session.query(books_publishers_link.c.book).join(
                 Publishers, books_publishers_link.c.publisher == Publishers.id
-            ).filter(func.lower(Publishers.name).ilike("%" + term + "%"))),
-            func.lower(Books.title).ilike("%" + term + "%")
+            ).filter(search_index.key_filter('publishers', Publishers.id, Publishers.name, term))),
+            search_index.key_filter('books', Books.id, Books.title, term)
         ]
 
         for c in cc:
@@ -1053,6 +1196,11 @@ class CalibreDB:
                             'custom_column_' + str(c.id)).any(
                         func.lower(cc_classes[c.id].value).ilike("%" + term + "%")))
 
+        if fts_query is not None:
+            # books added outside of Calibre-Web are indexed with the next index update
+            return base_query.filter(or_(Books.id.in_(fts_query),
+                                         and_(Books.id.notin_(search_index.indexed_books()),
+                                              or_(*filter_expression))))
         return base_query.filter(or_(*filter_expression))
 
     def get_cc_columns(self, config, filter_config_custom_read=False):
@@ -1072,7 +1220,7 @@ class CalibreDB:
         return cc
 
     # read search results from calibre-database and return it (function is used for feed and simple search
-    def get_search_results(self, term, config, offset=None, order=None, limit=None, *join):
+    def get_search_results(self, term, config, offset=None, order=None, limit=None, *join, exact_count=False):
         order = order[0] if order else [Books.sort]
         pagination = None
 
@@ -1082,18 +1230,20 @@ class CalibreDB:
 
             # Use LIMIT+1 pattern to estimate total count without expensive count()
             query = self.search_query(term, config, *join).order_by(*order)
-            result = query.limit(offset + limit_int + 1).all()
+            result = query.offset(offset).limit(limit_int + 1).all()
 
             # Check if there are more results
-            has_more = len(result) > (offset + limit_int)
-            if has_more:
-                result_count = offset + limit_int + 1  # Estimate: at least this many
+            has_more = len(result) > limit_int
+            if not has_more:
+                result_count = offset + len(result)
+            elif exact_count:
+                result_count = query.order_by(None).count()
             else:
-                result_count = len(result)
+                result_count = offset + limit_int + 1  # Estimate: at least this many
 
             # Extract the page of results
-            result = result[offset:offset + limit_int]
-            pagination = Pagination((offset / limit_int + 1), limit_int, result_count)
+            result = result[:limit_int]
+            pagination = Pagination((offset / limit_int + 1), limit_int, result_count, offset=offset)
         else:
             # No pagination, fetch all results
             result = self.search_query(term, config, *join).order_by(*order).all()
@@ -1164,10 +1314,23 @@ class CalibreDB:
             pass
 
     def reconnect_db(self, config, app_db_path):
-        # self.dispose()
-        # self.engine.dispose()
+        self.dispose()
         self.setup_db(config.config_calibre_dir, app_db_path)
         self.update_config(config, config.config_calibre_dir, app_db_path)
+        CalibreDB.library_generation = self.get_library_generation()
+
+    def reconnect_db_if_changed(self, config, app_db_path):
+        """Reconnects only if metadata.db was written to since the last reconnect"""
+        generation = self.get_library_generation()
+        if generation is None or generation != CalibreDB.library_generation:
+            self.reconnect_db(config, app_db_path)
+
+    def get_library_generation(self):
+        """Modification time of metadata.db, changes with every write to the library"""
+        try:
+            return os.path.getmtime(os.path.join(self.config.config_calibre_dir, "metadata.db"))
+        except (OSError, TypeError):
+            return None
 
 
 def lcase(s):
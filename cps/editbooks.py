@@ -23,7 +23,7 @@
 import os
 from datetime import datetime, timezone
 import json
-from shutil import copyfile, move
+from shutil import copyfile
 
 from markupsafe import escape, Markup  # dependency of flask
 from functools import wraps
@@ -37,7 +37,8 @@ from sqlalchemy.exc import OperationalError, IntegrityError, InterfaceError
 from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.sql.expression import func
 
-from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, kobo_sync_status, shelf
+from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, kobo_sync_status
+from . import media_ingest
 from .clean_html import clean_string
 from . import config, ub, db, calibre_db
 from .services.worker import WorkerThread
@@ -156,6 +157,9 @@ def upload():
                 upload_text = N_("File %(file)s uploaded", file=link)
                 WorkerThread.add(current_user.name, TaskUpload(upload_text, escape(title)))
                 helper.add_book_to_thumbnail_cache(book_id)
+                helper.update_search_index([book_id])
+                if meta.extension.lower() == '.epub':
+                    helper.generate_kepubs([book_id])
 
                 if len(request.files.getlist("btn-upload")) < 2:
                     if current_user.role_edit() or current_user.role_admin():
@@ -205,116 +209,15 @@ def media():
 
 @editbook.route("/meta", methods=["GET"])
 def meta():
-    def create_shelf(current_user_name=None, shelf_title=None):
-        shelf_object = ub.Shelf()
-        is_public = 1
-        original_title = shelf_title
-        suffix = 1
-        while not shelf.check_shelf_is_unique(shelf_title, is_public, shelf_id=None):
-            suffix += 1
-            shelf_title = f"{original_title} ({suffix})"
-        shelf_object.name = shelf_title
-        shelf_object.is_public = is_public
-        shelf_object.user_id = int(current_user.id)
-        ub.session.add(shelf_object)
-        shelf_action = "created"
-        flash_text = _("Shelf %(title)s created", title=shelf_title)
-        try:
-            ub.session.commit()
-            shelf_id = shelf_object.id
-            log.info("Shelf %s %s", shelf_title, shelf_action)
-        except (OperationalError, InvalidRequestError) as ex:
-            ub.session.rollback()
-            log.error("Settings Database error: %s", ex)
-        except Exception as ex:
-            ub.session.rollback()
-            log.error("Error occurred: %s", ex)
-
-        resp = {"shelf_id": shelf_id, "shelf_title": shelf_title}
-        return resp
-
     log.info("Received metadata request: %s", request.args)
-    def move_mediafile(requested_file, current_user_name=None, shelf_id=None):
-        log.info("Requested file: %s", requested_file)
-        requested_file = open(requested_file, "rb")
-        requested_file.filename = os.path.basename(requested_file.name)
-        requested_file.save = lambda path: move(requested_file.name, path)
-
-        log.info("Processing file: {}".format(requested_file))
-        try:
-            modify_date = False
-            calibre_db.create_functions(config)
-            calibre_db.session.connection().connection.connection.create_function(
-                "uuid4", 0, lambda: str(uuid4())
-            )
-
-            meta, error = file_handling_on_upload(requested_file)
-            if error:
-                return error
-
-            (
-                db_book,
-                input_authors,
-                title_dir,
-            ) = create_book_on_upload(modify_date, meta)
-
-            # Comments need book id therefore only possible after flush
-            modify_date |= edit_book_comments(
-                Markup(meta.description).unescape(), db_book
-            )
-
-            book_id = db_book.id
-            title = db_book.title
-
-            error = helper.update_dir_structure(
-                book_id,
-                config.config_calibre_dir,
-                input_authors[0],
-                meta.file_path,
-                title_dir + meta.extension.lower(),
-            )
-
-            move_coverfile(meta, db_book)
-
-            if modify_date:
-                calibre_db.set_metadata_dirty(book_id)
-            # save data to database, reread data
-            calibre_db.session.commit()
-
-            if error:
-                flash(error, category="error")
-            link = '<a href="{}">{}</a>'.format(
-                url_for("web.show_book", book_id=book_id), escape(title)
-            )
- 
-            helper.add_book_to_thumbnail_cache(book_id)
-
-            if shelf_id is not None:
-                shelf.add_to_shelf_as_guest(shelf_id, book_id)
-
-            book_path = db_book.path
-
-        except (OperationalError, IntegrityError, StaleDataError) as e:
-            calibre_db.session.rollback()
-            log.error_or_exception("Database error: {}".format(e))
-            flash(
-                _(
-                    "Oops! Database Error: %(error)s.",
-                    error=e.orig if hasattr(e, "orig") else e,
-                ),
-                category="error",
-            )
-
-        new_book_path = os.path.join(config.config_calibre_dir, book_path)
-        resp = {"file_downloaded": link, "shelf_id": shelf_id, "new_book_path": new_book_path}
-        return resp
-
     if request.method == "GET" and "requested_file" in request.args:
         requested_file = request.args.get("requested_file", None)
         current_user_name = request.args.get("current_user_name", None)
         shelf_id = request.args.get("shelf_id", None)
         try :
-            resp = move_mediafile(requested_file, current_user_name, shelf_id)
+            resp = media_ingest.import_media_file(requested_file, current_user_name, shelf_id)
+            if resp is None:
+                return jsonify({"error": "Import of {} failed".format(requested_file)}), 500
             return jsonify(resp)
         except Exception as ex:
             log.error_or_exception(ex)
@@ -324,7 +227,7 @@ def meta():
         shelf_title = request.args.get("shelf_title", None)
         current_user_name = request.args.get("current_user_name", None)
         try :
-            resp = create_shelf(current_user_name, shelf_title)
+            resp = media_ingest.create_shelf(shelf_title, current_user_name)
             return jsonify(resp)
         except Exception as ex:
             log.error_or_exception(ex)
@@ -478,6 +381,7 @@ def edit_book_param(param, vals, multi=False):
         return {"success":False, "msg":_("Oops! Selected book is unavailable. File does not exist or is not accessible")}
     ret = {}
     out = list()
+    edited_books = list()
     for elem in elements:
         book = calibre_db.get_book(elem)
         if not book:
@@ -594,12 +498,15 @@ def edit_book_param(param, vals, multi=False):
             if param == 'title' and vals.get('checkT') == False:
                 book.sort = sort_param
                 calibre_db.session.commit()
+            edited_books.append(book.id)
         except (OperationalError, IntegrityError, StaleDataError, AttributeError) as e:
             calibre_db.session.rollback()
             log.error_or_exception("Database error: {}".format(e))
             ret = {"success":False, "msg":'Database error: {}'.format(e.orig if hasattr(e, "orig") else e)}
             if multi:
                 out.append(ret)
+    if edited_books:
+        helper.update_search_index(edited_books)
     if multi:
         if len(out) > 0:
             return out
@@ -724,6 +631,7 @@ def merge_list_book():
                                                         element.format,
                                                         element.uncompressed_size,
                                                         to_name))
+                            kobo_sync_status.record_kobo_format(to_book.id, element.format)
                     check_delete_book([from_book.id], "", True)
                     return make_response(jsonify(success=True))
     return ""
@@ -735,6 +643,7 @@ def merge_list_book():
 def table_xchange_author_title():
     vals = request.get_json().get('xchange')
     edited_books_id = False
+    edited_books = list()
     if vals:
         for val in vals:
             modify_date = False
@@ -762,13 +671,16 @@ def table_xchange_author_title():
                 calibre_db.set_metadata_dirty(book.id)
             try:
                 calibre_db.session.commit()
+                edited_books.append(book.id)
             except (OperationalError, IntegrityError, StaleDataError) as e:
                 calibre_db.session.rollback()
                 log.error_or_exception("Database error: {}".format(e))
+                helper.update_search_index(edited_books)
                 return make_response(jsonify(success=False))
 
             if config.config_use_google_drive:
                 gdriveutils.updateGdriveCalibreFromLocal()
+        helper.update_search_index(edited_books)
         return make_response(jsonify(success=True))
     return ""
 
@@ -890,6 +802,7 @@ def do_edit_book(book_id, upload_formats=None):
 
         calibre_db.session.merge(book)
         calibre_db.session.commit()
+        helper.update_search_index([book.id])
         if config.config_use_google_drive:
             gdriveutils.updateGdriveCalibreFromLocal()
         if edit_error is not True and title_author_error is not True and cover_upload_success is not False:
@@ -1254,6 +1167,8 @@ def delete_book_from_UI(book_id, book_format, location=""):
                 if book_format.upper() in ['KEPUB', 'EPUB', 'EPUB3']:
                     kobo_sync_status.remove_synced_book(book.id, True)
             calibre_db.session.commit()
+            if not book_format:
+                helper.update_search_index([book_id])
         except Exception as ex:
             log.error_or_exception(ex)
             calibre_db.session.rollback()
@@ -1277,6 +1192,7 @@ def delete_book_from_table(book_id):
                         "message": error}
             delete_whole_book(book_id, book)
             calibre_db.session.commit()
+            helper.update_search_index([book_id])
             if error:
                 return {"location": url_for("edit-book.show_edit_book", book_id=book_id),
                            "type": "warning",
@@ -1627,6 +1543,7 @@ def upload_book_formats(requested_files, book, book_id, no_cover=True):
                     calibre_db.session.add(db_format)
                     calibre_db.session.commit()
                     calibre_db.create_functions(config)
+                    kobo_sync_status.record_kobo_format(book_id, file_ext)
                 except (OperationalError, IntegrityError, StaleDataError) as e:
                     calibre_db.session.rollback()
                     log.error_or_exception("Database error: {}".format(e))
@@ -1639,6 +1556,8 @@ def upload_book_formats(requested_files, book, book_id, no_cover=True):
             link = '<a href="{}">{}</a>'.format(url_for('web.show_book', book_id=book.id), escape(book.title))
             upload_text = N_("File format %(ext)s added to %(book)s", ext=file_ext.upper(), book=link)
             WorkerThread.add(current_user.name, TaskUpload(upload_text, escape(book.title)))
+            if file_ext == 'epub':
+                helper.generate_kepubs([book.id])
             meta = uploader.process(
                 saved_filename,
                 *os.path.splitext(current_filename),
@@ -19,7 +19,7 @@
 import os
 import json
 import shutil
-import chardet
+import itertools
 import ssl
 import sqlite3
 import mimetypes
@@ -66,7 +66,7 @@ except ImportError as err:
         importError = err
         gdrive_support = False
 
-from . import logger, cli_param, config, db
+from . import logger, cli_param, config, db, text_stream
 from .constants import CONFIG_DIR as _CONFIG_DIR
 
 
@@ -649,19 +649,25 @@ def do_gdrive_download(df, headers, convert_encoding=False):
     download_url = df.metadata.get('downloadUrl')
     s = partial(total_size, 1024 * 1024)  # I'm downloading BIG files, so 100M chunk size is fine for me
 
-    def stream(convert_encoding):
+    def stream():
         for byte in s:
             headers = {"Range": 'bytes={}-{}'.format(byte[0], byte[1])}
             resp, content = df.auth.Get_Http_Object().request(download_url, headers=headers)
             if resp.status == 206:
-                if convert_encoding:
-                    result = chardet.detect(content)
-                    content = content.decode(result['encoding']).encode('utf-8')
                 yield content
             else:
                 log.warning('An error occurred: {}'.format(resp))
                 return
-    return Response(stream_with_context(stream(convert_encoding)), headers=headers)
+
+    def transcoded():
+        chunks = stream()
+        first = next(chunks, b'')
+        encoding = text_stream.detect_encoding(first[:text_stream.DETECT_BYTES])
+        yield from text_stream.transcode(itertools.chain([first], chunks), encoding)
+
+    if convert_encoding:
+        return Response(stream_with_context(transcoded()), headers=headers)
+    return Response(stream_with_context(stream()), headers=headers)
 
 
 _SETTINGS_YAML_TEMPLATE = """
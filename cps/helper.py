@@ -54,7 +54,7 @@ except ImportError as e:
 from . import calibre_db, cli_param
 from .string_helper import strip_whitespaces
 from .tasks.convert import TaskConvert
-from . import logger, config, db, ub, fs
+from . import logger, config, db, ub, fs, cover_cache
 from . import gdriveutils as gd
 from .constants import (STATIC_DIR as _STATIC_DIR, CACHE_TYPE_THUMBNAILS, THUMBNAIL_TYPE_COVER, THUMBNAIL_TYPE_SERIES,
                         SUPPORTED_CALIBRE_BINARIES)
@@ -63,6 +63,8 @@ from .services.worker import WorkerThread
 from .tasks.mail import TaskEmail
 from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails
 from .tasks.metadata_backup import TaskBackupMetadata
+from .tasks.search_index import TaskUpdateSearchIndex
+from .tasks.kepub import TaskGenerateKepubs
 from .file_helper import get_temp_dir
 from .epub_helper import get_content_opf, create_new_metadata_backup, updateEpub, replace_metadata
 from .embed_helper import do_calibre_export
@@ -723,6 +725,15 @@ def get_cover_on_failure():
 
 
 def get_book_cover(book_id, resolution=None):
+    # restricted users only get covers of visible books, the check doesn't load the book
+    if calibre_db.has_restrictions() and not calibre_db.is_book_visible(book_id, allow_show_archived=True):
+        return get_cover_on_failure()
+    cover = cover_cache.get(book_id, resolution, get_cover_formats()[0])
+    if cover:
+        if os.path.isfile(os.path.join(*cover)):
+            # conditional response, browsers revalidating the cover get a 304 based on ETag and Last-Modified
+            return send_cover_file(*cover)
+        cover_cache.invalidate(book_id)
     book = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
     return get_book_cover_internal(book, resolution=resolution)
 
@@ -734,17 +745,33 @@ def get_book_cover_with_uuid(book_uuid, resolution=None):
     return get_book_cover_internal(book, resolution=resolution)
 
 
+def get_cover_formats():
+    """Returns the thumbnail formats acceptable for the client in order of preference,
+    modern formats are only used if the client lists them explicitly"""
+    accepted = list(request.accept_mimetypes.values())
+    return [image_format for image_format in ('avif', 'webp') if 'image/' + image_format in accepted] + ['jpeg']
+
+
+def send_cover_file(directory, filename):
+    response = send_from_directory(directory, filename)
+    # thumbnails are chosen depending on the Accept header
+    response.vary.add('Accept')
+    return response
+
+
 def get_book_cover_internal(book, resolution=None):
     if book and book.has_cover:
 
         # Send the book cover thumbnail if it exists in cache
         if resolution:
-            thumbnail = get_book_cover_thumbnail(book, resolution)
+            formats = get_cover_formats()
+            thumbnail = get_book_cover_thumbnail(book, resolution, formats)
             if thumbnail:
                 cache = fs.FileSystem()
                 if cache.get_cache_file_exists(thumbnail.filename, CACHE_TYPE_THUMBNAILS):
-                    return send_from_directory(cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
-                                               thumbnail.filename)
+                    cover_directory = cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS)
+                    cover_cache.add(book.id, resolution, formats[0], cover_directory, thumbnail.filename)
+                    return send_cover_file(cover_directory, thumbnail.filename)
 
         # Send the book cover from Google Drive if configured
         if config.config_use_google_drive:
@@ -765,22 +792,27 @@ def get_book_cover_internal(book, resolution=None):
         else:
             cover_file_path = os.path.join(config.get_book_path(), book.path)
             if os.path.isfile(os.path.join(cover_file_path, "cover.jpg")):
-                return send_from_directory(cover_file_path, "cover.jpg")
+                cover_cache.add(book.id, resolution, get_cover_formats()[0], cover_file_path, "cover.jpg")
+                return send_cover_file(cover_file_path, "cover.jpg")
             else:
                 return get_cover_on_failure()
     else:
         return get_cover_on_failure()
 
 
-def get_book_cover_thumbnail(book, resolution):
+def get_book_cover_thumbnail(book, resolution, formats=('jpeg',)):
     if book and book.has_cover:
-        return (ub.session
-                .query(ub.Thumbnail)
-                .filter(ub.Thumbnail.type == THUMBNAIL_TYPE_COVER)
-                .filter(ub.Thumbnail.entity_id == book.id)
-                .filter(ub.Thumbnail.resolution == resolution)
-                .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc)))
-                .first())
+        thumbnails = (ub.session
+                      .query(ub.Thumbnail)
+                      .filter(ub.Thumbnail.type == THUMBNAIL_TYPE_COVER)
+                      .filter(ub.Thumbnail.entity_id == book.id)
+                      .filter(ub.Thumbnail.resolution == resolution)
+                      .filter(ub.Thumbnail.format.in_(formats))
+                      .filter(or_(ub.Thumbnail.expiration.is_(None),
+                                  ub.Thumbnail.expiration > datetime.now(timezone.utc)))
+                      .all())
+        # return the thumbnail in the most preferred format
+        return min(thumbnails, key=lambda t: formats.index(t.format), default=None)
 
 
 def get_series_thumbnail_on_failure(series_id, resolution):
@@ -1120,11 +1152,13 @@ def get_download_link(book_id, book_format, client):
 
 
 def clear_cover_thumbnail_cache(book_id):
+    cover_cache.invalidate(book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
 
 
 def replace_cover_thumbnail_cache(book_id):
+    cover_cache.invalidate(book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
         WorkerThread.add(None, TaskGenerateCoverThumbnails(book_id), hidden=True)
@@ -1144,6 +1178,20 @@ def update_thumbnail_cache():
         WorkerThread.add(None, TaskGenerateCoverThumbnails())
 
 
+def update_search_index(book_ids):
+    if book_ids:
+        WorkerThread.add(None, TaskUpdateSearchIndex([int(book_id) for book_id in book_ids]), hidden=True)
+
+
+def generate_kepubs(book_ids=None):
+    """Converts books to kepub for the Kobo sync ahead of time, all books without kepub if book_ids is None"""
+    if config.config_kobo_sync and config.config_kepubifypath and book_ids != []:
+        if book_ids is None:
+            WorkerThread.add(None, TaskGenerateKepubs())
+        else:
+            WorkerThread.add(None, TaskGenerateKepubs([int(book_id) for book_id in book_ids]), hidden=True)
+
+
 def set_all_metadata_dirty():
     WorkerThread.add(None, TaskBackupMetadata(export_language=get_locale(),
                                               translated_title=_("Cover"),
@@ -153,6 +153,7 @@ def get_cover_srcset(book):
     resolutions = {
         constants.COVER_THUMBNAIL_SMALL: 'sm',
         constants.COVER_THUMBNAIL_MEDIUM: 'md',
+        constants.COVER_THUMBNAIL_MEDIUM_LARGE: 'ml',
         constants.COVER_THUMBNAIL_LARGE: 'lg'
     }
     for resolution, shortname in resolutions.items():
@@ -40,11 +40,12 @@ from flask import (
 from .cw_login import current_user
 from werkzeug.datastructures import Headers
 from sqlalchemy import func
-from sqlalchemy.sql.expression import and_, or_
+from sqlalchemy.sql.expression import and_, or_, select
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import StatementError
 
 from . import config, logger, kobo_auth, db, calibre_db, helper, shelf as shelf_lib, ub, csrf, kobo_sync_status
-from . import isoLanguages, limiter
+from . import isoLanguages, limiter, change_feed
 from .epub import get_epub_layout
 from .constants import COVER_THUMBNAIL_SMALL, COVER_THUMBNAIL_MEDIUM, COVER_THUMBNAIL_LARGE, BASE_DIR
 from .helper import get_download_link
@@ -152,10 +153,11 @@ def HandleSyncRequest():
         log.debug('Kobo: Received unproxied request, changed request port to external server port')
 
     # if no books synced don't respect sync_token
-    if not ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.user_id == current_user.id).count():
+    if not ub.session.query(ub.KoboSyncedBooks.id).filter(ub.KoboSyncedBooks.user_id == current_user.id).first():
         sync_token.books_last_modified = datetime.min
         sync_token.books_last_created = datetime.min
         sync_token.reading_state_last_modified = datetime.min
+        sync_token.books_last_change = 0
 
     new_books_last_modified = sync_token.books_last_modified  # needed for sync selected shelfs only
     new_books_last_created = sync_token.books_last_created  # needed to distinguish between new and changed entitlement
@@ -165,72 +167,79 @@ def HandleSyncRequest():
     sync_results = []
 
     # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
+    # in case of external changes (e.g: adding a book through Calibre), unchanged libraries are not reloaded.
+    calibre_db.reconnect_db_if_changed(config, ub.app_DB_path)
+    change_feed.scan_library(calibre_db.session, calibre_db.get_library_generation())
+    if sync_token.books_last_change is None:
+        # the device continues after the last library change it has seen instead of receiving all books again
+        sync_token.books_last_change = change_feed.get_position(sync_token.books_last_modified)
 
     only_kobo_shelves = current_user.kobo_only_shelves_sync
 
+    # page through the change feed, one change more than needed tells if there is more to sync
+    changes = change_feed.get_changes(current_user.id, sync_token.books_last_change, SYNC_ITEM_LIMIT + 1)
+    cont_sync = len(changes) > SYNC_ITEM_LIMIT
+    changes = changes[:SYNC_ITEM_LIMIT]
+    if changes:
+        sync_token.books_last_change = changes[-1].id
+    changed_book_ids = list(dict.fromkeys(change.book_id for change in changes
+                                          if change.kind in (ub.BookChange.KIND_BOOK, ub.BookChange.KIND_ARCHIVE)))
+    archive_changes = set(change.book_id for change in changes if change.kind == ub.BookChange.KIND_ARCHIVE)
+    reading_state_changes = set(change.book_id for change in changes
+                                if change.kind == ub.BookChange.KIND_READING_STATE)
+    log.debug("Changes to Sync: {}".format(len(changes)))
+
+    kobo_shelf_books = (ub.session.query(ub.BookShelf.book_id).join(ub.Shelf)
+                        .filter(ub.Shelf.user_id == current_user.id)
+                        .filter(ub.Shelf.kobo_sync))
+    changed_entries = calibre_db.session.query(db.Books,
+                                               ub.ArchivedBook.last_modified,
+                                               ub.ArchivedBook.is_archived)
+    changed_entries = (changed_entries
+                       .outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
+                                                        ub.ArchivedBook.user_id == current_user.id))
+                       .filter(db.Books.id.in_(changed_book_ids))
+                       .filter(db.Books.data.any(db.Data.format.in_(KOBO_FORMATS)))
+                       .filter(calibre_db.common_filters(allow_show_archived=True))
+                       .options(selectinload(db.Books.data), selectinload(db.Books.authors),
+                                selectinload(db.Books.comments), selectinload(db.Books.publishers),
+                                selectinload(db.Books.series), selectinload(db.Books.languages)))
     if only_kobo_shelves:
-        changed_entries = calibre_db.session.query(db.Books,
-                                                   ub.ArchivedBook.last_modified,
-                                                   ub.BookShelf.date_added,
-                                                   ub.ArchivedBook.is_archived)
-        changed_entries = (changed_entries
-                           .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
-                           .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
-                           .filter(ub.BookShelf.date_added > sync_token.books_last_modified)
-                           .filter(db.Data.format.in_(KOBO_FORMATS))
-                           .filter(calibre_db.common_filters(allow_show_archived=True))
-                           .order_by(db.Books.id)
-                           .order_by(ub.ArchivedBook.last_modified)
-                           .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
-                           .join(ub.Shelf)
-                           .filter(ub.Shelf.user_id == current_user.id)
-                           .filter(ub.Shelf.kobo_sync)
-                           .distinct())
-    else:
-        changed_entries = calibre_db.session.query(db.Books,
-                                                   ub.ArchivedBook.last_modified,
-                                                   ub.ArchivedBook.is_archived)
-        changed_entries = (changed_entries
-                           .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
-                           .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
-                           .filter(calibre_db.common_filters(allow_show_archived=True))
-                           .filter(db.Data.format.in_(KOBO_FORMATS))
-                           .order_by(db.Books.last_modified)
-                           .order_by(db.Books.id))
+        # archiving has to reach the device also for books no longer on a synced shelf
+        changed_entries = changed_entries.filter(or_(db.Books.id.in_([b.book_id for b in kobo_shelf_books]),
+                                                     db.Books.id.in_(archive_changes)))
+    books = {book.Books.id: book for book in changed_entries}
+    synced_books = set(b.book_id for b in ub.session.query(ub.KoboSyncedBooks.book_id)
+                       .filter(ub.KoboSyncedBooks.user_id == current_user.id)
+                       .filter(ub.KoboSyncedBooks.book_id.in_(list(books))))
+    entitlement_reading_states = get_or_create_reading_states(
+        [book_id for book_id in books if book_id in reading_state_changes or book_id not in synced_books])
 
     reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
-    for book in books:
+    missing_kepubs = []
+    for book_id in changed_book_ids:
+        book = books.get(book_id)
+        if not book:
+            continue
+        # only formats already present are announced, the book is synced again once its kepub is generated
         formats = [data.format for data in book.Books.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
+        if 'KEPUB' not in formats and 'EPUB' in formats:
+            missing_kepubs.append(book_id)
 
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
         entitlement = {
             "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
             "BookMetadata": get_metadata(book.Books),
         }
 
-        if kobo_reading_state.last_modified > sync_token.reading_state_last_modified:
+        kobo_reading_state = entitlement_reading_states.get(book_id)
+        if kobo_reading_state:
             entitlement["ReadingState"] = get_kobo_reading_state_response(book.Books, kobo_reading_state)
             new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
             reading_states_in_new_entitlements.append(book.Books.id)
 
         ts_created = book.Books.timestamp.replace(tzinfo=None)
 
-        try:
-            ts_created = max(ts_created, book.date_added)
-        except AttributeError:
-            pass
-
-        if ts_created > sync_token.books_last_created:
+        if book_id not in synced_books:
             sync_results.append({"NewEntitlement": entitlement})
         else:
             sync_results.append({"ChangedEntitlement": entitlement})
@@ -238,53 +247,37 @@ def HandleSyncRequest():
         new_books_last_modified = max(
             book.Books.last_modified.replace(tzinfo=None), new_books_last_modified
         )
-        try:
-            new_books_last_modified = max(
-                new_books_last_modified, book.date_added
-            )
-        except AttributeError:
-            pass
+        if book.is_archived and book.last_modified:
+            new_archived_last_modified = max(new_archived_last_modified, book.last_modified.replace(tzinfo=None))
 
         new_books_last_created = max(ts_created, new_books_last_created)
-        kobo_sync_status.add_synced_books(book.Books.id)
-
-    max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
-        .filter(ub.ArchivedBook.user_id == current_user.id) \
-        .order_by(func.datetime(ub.ArchivedBook.last_modified).desc()).first()
 
-    max_change = max_change.last_modified if max_change else new_archived_last_modified
+    kobo_sync_status.add_synced_books(set(books) - synced_books)
+    if any(change.kind == ub.BookChange.KIND_VISIBILITY for change in changes):
+        # the user may see other books now, the ones not on the device yet are appended to the feed
+        unsynced_book_ids = get_unsynced_book_ids(kobo_shelf_books if only_kobo_shelves else None)
+        if unsynced_book_ids:
+            change_feed.record_books(unsynced_book_ids, current_user.id)
+            ub.session_commit()
+            cont_sync = True
+    helper.generate_kepubs(missing_kepubs)
 
-    new_archived_last_modified = max(new_archived_last_modified, max_change)
-
-    # no. of books returned
-    book_count = changed_entries.count()
-    # last entry:
-    cont_sync = bool(book_count)
-    log.debug("Remaining books to Sync: {}".format(book_count))
     # generate reading state data
-    changed_reading_states = ub.session.query(ub.KoboReadingState)
-
-    if only_kobo_shelves:
-        changed_reading_states = changed_reading_states.join(ub.BookShelf,
-                                                             ub.KoboReadingState.book_id == ub.BookShelf.book_id)\
-            .join(ub.Shelf)\
-            .filter(current_user.id == ub.Shelf.user_id)\
-            .filter(ub.Shelf.kobo_sync,
-                    or_(
-                        ub.KoboReadingState.last_modified > sync_token.reading_state_last_modified,
-                        func.datetime(ub.BookShelf.date_added) > sync_token.books_last_modified
-                    )).distinct()
-    else:
-        changed_reading_states = changed_reading_states.filter(
-            ub.KoboReadingState.last_modified > sync_token.reading_state_last_modified)
-
-    changed_reading_states = changed_reading_states.filter(
+    changed_reading_states = ub.session.query(ub.KoboReadingState).filter(
         and_(ub.KoboReadingState.user_id == current_user.id,
-             ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))\
-        .order_by(ub.KoboReadingState.last_modified)
-    cont_sync |= bool(changed_reading_states.count() > SYNC_ITEM_LIMIT)
-    for kobo_reading_state in changed_reading_states.limit(SYNC_ITEM_LIMIT).all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
+             ub.KoboReadingState.book_id.in_(reading_state_changes),
+             ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))
+    if only_kobo_shelves:
+        changed_reading_states = changed_reading_states.filter(ub.KoboReadingState.book_id.in_(kobo_shelf_books))
+    changed_reading_states = (changed_reading_states
+                              .options(selectinload(ub.KoboReadingState.current_bookmark),
+                                       selectinload(ub.KoboReadingState.statistics),
+                                       selectinload(ub.KoboReadingState.book_read_link))
+                              .order_by(ub.KoboReadingState.last_modified).all())
+    state_books = {book.id: book for book in calibre_db.session.query(db.Books).filter(
+        db.Books.id.in_([state.book_id for state in changed_reading_states]))}
+    for kobo_reading_state in changed_reading_states:
+        book = state_books.get(kobo_reading_state.book_id)
         if book:
             sync_results.append({
                 "ChangedReadingState": {
@@ -305,6 +298,21 @@ def HandleSyncRequest():
     return generate_sync_response(sync_token, sync_results, cont_sync)
 
 
+def get_unsynced_book_ids(kobo_shelf_books):
+    """Ids of the books the user is allowed to sync which are not on the device,
+    app.db is attached to the calibre connection so the synced books are evaluated inside the query"""
+    synced_book_ids = (select(ub.KoboSyncedBooks.book_id)
+                       .where(ub.KoboSyncedBooks.user_id == current_user.id)
+                       .scalar_subquery())
+    unsynced = (calibre_db.session.query(db.Books.id)
+                .filter(db.Books.id.notin_(synced_book_ids))
+                .filter(db.Books.data.any(db.Data.format.in_(KOBO_FORMATS)))
+                .filter(calibre_db.common_filters(allow_show_archived=True)))
+    if kobo_shelf_books is not None:
+        unsynced = unsynced.filter(db.Books.id.in_([b.book_id for b in kobo_shelf_books]))
+    return [row[0] for row in unsynced.order_by(db.Books.id)]
+
+
 def generate_sync_response(sync_token, sync_results, set_cont=False):
     extra_headers = {}
     if config.config_kobo_proxy and not set_cont:
@@ -839,6 +847,38 @@ def get_ub_read_status(kobo_read_status):
     return string_to_enum_map[kobo_read_status]
 
 
+def get_or_create_reading_states(book_ids):
+    """Returns the reading states of the current user for the books by book id, missing ones are created"""
+    if not book_ids:
+        return dict()
+    user_id = int(current_user.id)
+    book_reads = {book_read.book_id: book_read for book_read in ub.session.query(ub.ReadBook)
+                  .filter(ub.ReadBook.book_id.in_(book_ids), ub.ReadBook.user_id == user_id)
+                  .options(selectinload(ub.ReadBook.kobo_reading_state))}
+    missing_states = [book_id for book_id in book_ids
+                      if book_id not in book_reads or not book_reads[book_id].kobo_reading_state]
+    if missing_states:
+        # empty reading states are inserted in bulk, they are not recorded as changes
+        ub.session.bulk_insert_mappings(ub.ReadBook, [{"user_id": user_id, "book_id": book_id}
+                                                      for book_id in book_ids if book_id not in book_reads])
+        ub.session.bulk_insert_mappings(ub.KoboReadingState, [{"user_id": user_id, "book_id": book_id}
+                                                              for book_id in missing_states])
+        state_ids = [row.id for row in ub.session.query(ub.KoboReadingState.id)
+                     .filter(ub.KoboReadingState.book_id.in_(missing_states), ub.KoboReadingState.user_id == user_id)]
+        ub.session.bulk_insert_mappings(ub.KoboBookmark, [{"kobo_reading_state_id": state_id}
+                                                          for state_id in state_ids])
+        ub.session.bulk_insert_mappings(ub.KoboStatistics, [{"kobo_reading_state_id": state_id}
+                                                            for state_id in state_ids])
+        ub.session_commit()
+    # all parts of the responses are loaded at once
+    return {kobo_reading_state.book_id: kobo_reading_state for kobo_reading_state in
+            ub.session.query(ub.KoboReadingState)
+            .filter(ub.KoboReadingState.book_id.in_(book_ids), ub.KoboReadingState.user_id == user_id)
+            .options(selectinload(ub.KoboReadingState.current_bookmark),
+                     selectinload(ub.KoboReadingState.statistics),
+                     selectinload(ub.KoboReadingState.book_read_link))}
+
+
 def get_or_create_reading_state(book_id):
     book_read = ub.session.query(ub.ReadBook).filter(ub.ReadBook.book_id == book_id,
                                                      ub.ReadBook.user_id == int(current_user.id)).one_or_none()
@@ -18,23 +18,23 @@
 
 
 from .cw_login import current_user
-from . import ub
+from . import ub, change_feed
 from datetime import datetime, timezone
 from sqlalchemy.sql.expression import or_, and_, true
 # from sqlalchemy import exc
 
 
-# Add the current book id to kobo_synced_books table for current user, if entry is already present,
-# do nothing (safety precaution)
-def add_synced_books(book_id):
-    is_present = ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.book_id == book_id)\
-        .filter(ub.KoboSyncedBooks.user_id == current_user.id).count()
-    if not is_present:
-        synced_book = ub.KoboSyncedBooks()
-        synced_book.user_id = current_user.id
-        synced_book.book_id = book_id
-        ub.session.add(synced_book)
-        ub.session_commit()
+# Add the book ids to kobo_synced_books table for current user, entries already present are skipped
+# (safety precaution)
+def add_synced_books(book_ids):
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    present = ub.session.query(ub.KoboSyncedBooks.book_id).filter(ub.KoboSyncedBooks.book_id.in_(book_ids))\
+        .filter(ub.KoboSyncedBooks.user_id == current_user.id).all()
+    ub.session.bulk_insert_mappings(ub.KoboSyncedBooks, [{"user_id": current_user.id, "book_id": book_id}
+                                                         for book_id in book_ids - set(b.book_id for b in present)])
+    ub.session_commit()
 
 
 # Select all entries of current book in kobo_synced_books table, which are from current user and delete them
@@ -43,6 +43,8 @@ def remove_synced_book(book_id, all=False, session=None):
         user = ub.KoboSyncedBooks.user_id == current_user.id
     else:
         user = true()
+    # the book is synced again with the next sync
+    change_feed.record(ub.BookChange.KIND_BOOK, book_id, None if all else current_user.id, session)
     if not session:
         ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.book_id == book_id).filter(user).delete()
         ub.session_commit()
@@ -51,6 +53,13 @@ def remove_synced_book(book_id, all=False, session=None):
         ub.session_commit(_session=session)
 
 
+# Books without a format the Kobo reader can read are skipped by the sync, they are synced once they get one
+def record_kobo_format(book_id, book_format, session=None):
+    if book_format.upper() in ['KEPUB', 'EPUB', 'EPUB3']:
+        change_feed.record(ub.BookChange.KIND_BOOK, book_id, None, session)
+        ub.session_commit(_session=session)
+
+
 # If state == none, it will toggle the archive state of the passed book_id. 
 # state = true archives it, state = false unarchives it
 def change_archived_books(book_id, state=None, message=None):
@@ -63,6 +72,7 @@ def change_archived_books(book_id, state=None, message=None):
     archived_book.last_modified = datetime.now(timezone.utc)        # toDo. Check utc timestamp
 
     ub.session.merge(archived_book)
+    change_feed.record(ub.BookChange.KIND_ARCHIVE, book_id, int(current_user.id))
     ub.session_commit(message)
     return archived_book.is_archived
 
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Import of media downloaded by the xklb tasks (TaskMetadataExtract, TaskDownload) into the library.
+# The tasks call these functions directly from the worker thread, the /meta endpoint is a thin wrapper around them
+# for external callers.
+
+import os
+import re
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from shutil import move
+from uuid import uuid4
+
+from flask import has_request_context, url_for
+from markupsafe import escape, Markup
+from sqlalchemy.exc import OperationalError, IntegrityError, InvalidRequestError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.expression import func
+
+from . import app, config, ub, db, calibre_db, helper, logger
+from . import editbooks
+from .cw_login import current_user
+
+log = logger.create()
+
+# books are imported one after the other, concurrent downloads must not write to the library at the same time
+_ingest_lock = threading.Lock()
+
+
+def server_url(original_url):
+    """Base url of the server the download was requested from, original_url points to its /meta endpoint"""
+    return re.sub(r"/meta(?=\?|$)", "", original_url.split("?")[0])
+
+
+def _request_context(base_url):
+    if has_request_context():
+        return nullcontext()
+    # the upload functions flash messages and build links, links point to the server the download was started from
+    return app.test_request_context(base_url=base_url)
+
+
+@contextmanager
+def _app_db_session():
+    # the functions are called from the worker threads, ub.session belongs to the threads serving the requests
+    ub_session = ub.init_db_thread()
+    try:
+        yield ub_session
+    finally:
+        ub_session.close()
+
+
+def create_shelf(shelf_title, current_user_name=None, base_url=None):
+    """Creates a public shelf for a playlist, a number is appended to the title if the name is already used"""
+    with _ingest_lock, _request_context(base_url), _app_db_session() as ub_session:
+        shelf_object = ub.Shelf()
+        is_public = 1
+        original_title = shelf_title
+        suffix = 1
+        while ub_session.query(ub.Shelf).filter(ub.Shelf.name == shelf_title,
+                                                ub.Shelf.is_public == is_public).first() is not None:
+            suffix += 1
+            shelf_title = f"{original_title} ({suffix})"
+        shelf_object.name = shelf_title
+        shelf_object.is_public = is_public
+        shelf_object.user_id = int(current_user.id)
+        ub_session.add(shelf_object)
+        shelf_id = None
+        try:
+            ub_session.commit()
+            shelf_id = shelf_object.id
+            log.info("Shelf %s created", shelf_title)
+        except (OperationalError, InvalidRequestError) as ex:
+            ub_session.rollback()
+            log.error("Settings Database error: %s", ex)
+        except Exception as ex:
+            ub_session.rollback()
+            log.error("Error occurred: %s", ex)
+        return {"shelf_id": shelf_id, "shelf_title": shelf_title}
+
+
+def import_media_file(requested_file, current_user_name=None, shelf_id=None, base_url=None):
+    """Moves the downloaded file into the library and adds it to the shelf of the playlist.
+    Returns the link to the new book, the shelf id and the directory of the book, None if the import failed"""
+    with _ingest_lock, _request_context(base_url):
+        log.info("Requested file: %s", requested_file)
+        media_file = open(requested_file, "rb")
+        media_file.filename = os.path.basename(media_file.name)
+        media_file.save = lambda path: move(media_file.name, path)
+        try:
+            return _import_media_file(media_file, shelf_id)
+        finally:
+            media_file.close()
+
+
+def _import_media_file(media_file, shelf_id):
+    log.info("Processing file: {}".format(media_file))
+    try:
+        modify_date = False
+        calibre_db.create_functions(config)
+        calibre_db.session.connection().connection.connection.create_function("uuid4", 0, lambda: str(uuid4()))
+
+        meta, error = editbooks.file_handling_on_upload(media_file)
+        if error:
+            log.error("File %s could not be imported", media_file.filename)
+            return None
+
+        db_book, input_authors, title_dir = editbooks.create_book_on_upload(modify_date, meta)
+
+        # Comments need book id therefore only possible after flush
+        modify_date |= editbooks.edit_book_comments(Markup(meta.description).unescape(), db_book)
+
+        book_id = db_book.id
+        title = db_book.title
+
+        error = helper.update_dir_structure(book_id,
+                                            config.config_calibre_dir,
+                                            input_authors[0],
+                                            meta.file_path,
+                                            title_dir + meta.extension.lower())
+
+        editbooks.move_coverfile(meta, db_book)
+
+        if modify_date:
+            calibre_db.set_metadata_dirty(book_id)
+        # save data to database, reread data
+        calibre_db.session.commit()
+
+        if error:
+            log.error(error)
+        link = '<a href="{}">{}</a>'.format(url_for("web.show_book", book_id=book_id), escape(title))
+
+        helper.add_book_to_thumbnail_cache(book_id)
+        helper.update_search_index([book_id])
+        if meta.extension.lower() == '.epub':
+            helper.generate_kepubs([book_id])
+
+        if shelf_id is not None:
+            with _app_db_session() as ub_session:
+                _add_to_shelves(ub_session, book_id, [shelf_id])
+
+        new_book_path = os.path.join(config.config_calibre_dir, db_book.path)
+    except (OperationalError, IntegrityError, StaleDataError) as e:
+        calibre_db.session.rollback()
+        log.error_or_exception("Database error: {}".format(e))
+        return None
+
+    return {"file_downloaded": link, "shelf_id": shelf_id, "new_book_path": new_book_path, "book_id": book_id}
+
+
+def _add_to_shelves(ub_session, book_id, shelf_ids):
+    for shelf_id in shelf_ids:
+        # the shelf may have been deleted while the video was downloaded
+        book_shelf = ub_session.query(ub.Shelf).filter(ub.Shelf.id == shelf_id).first() \
+            if shelf_id is not None else None
+        if book_shelf is None or ub_session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id,
+                                                                       ub.BookShelf.book_id == book_id).first():
+            continue
+        max_order = ub_session.query(func.max(ub.BookShelf.order)).filter(ub.BookShelf.shelf == shelf_id).scalar()
+        book_shelf.books.append(ub.BookShelf(shelf=shelf_id, book_id=book_id, order=(max_order or 0) + 1))
+        book_shelf.last_modified = datetime.now(timezone.utc)
+        try:
+            ub_session.commit()
+        except (OperationalError, InvalidRequestError) as e:
+            ub_session.rollback()
+            log.error_or_exception("Settings Database error: {}".format(e))
+
+
+def add_to_shelves(book_id, shelf_ids, base_url=None):
+    """Adds an imported book to further shelves (the same video requested by several playlists)"""
+    with _ingest_lock, _request_context(base_url), _app_db_session() as ub_session:
+        _add_to_shelves(ub_session, book_id, shelf_ids)
+
+
+def find_ingested_book(file_path, shelf_ids=(), base_url=None):
+    """Returns the book a downloaded file was imported to like import_media_file does, None if the file isn't
+    part of the library (anymore). The book is added to the shelves it's not part of yet"""
+    library_dir = os.path.realpath(config.config_calibre_dir)
+    book_dir = os.path.realpath(os.path.dirname(file_path))
+    if not os.path.isfile(file_path) or os.path.commonpath([library_dir, book_dir]) != library_dir:
+        return None
+    with _ingest_lock, _request_context(base_url):
+        book = calibre_db.session.query(db.Books).filter(
+            db.Books.path == os.path.relpath(book_dir, library_dir).replace(os.sep, '/')).first()
+        if book is None:
+            return None
+        with _app_db_session() as ub_session:
+            _add_to_shelves(ub_session, book.id, shelf_ids)
+        link = '<a href="{}">{}</a>'.format(url_for("web.show_book", book_id=book.id), escape(book.title))
+        return {"file_downloaded": link, "new_book_path": os.path.join(config.config_calibre_dir, book.path),
+                "book_id": book.id}
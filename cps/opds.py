@@ -23,7 +23,7 @@
 import datetime
 from urllib.parse import unquote_plus
 
-from flask import Blueprint, request, render_template, make_response, abort, g, jsonify
+from flask import Blueprint, request, render_template, make_response, abort, g, jsonify, Response, stream_with_context
 from flask_babel import get_locale
 from flask_babel import gettext as _
 
@@ -35,23 +35,38 @@ from . import logger, config, db, calibre_db, ub, isoLanguages, constants
 from .usermanagement import requires_basic_auth_if_no_ano, auth
 from .helper import get_download_link, get_book_cover
 from .pagination import Pagination
+from .opds_cache import cached_feed
 from .web import render_read_books
 
+try:
+    from flask import stream_template
+except ImportError:
+    # Flask < 2.2
+    from flask import current_app
+
+    def stream_template(template_name_or_list, **context):
+        current_app.update_template_context(context)
+        return current_app.jinja_env.get_or_select_template(template_name_or_list).generate(context)
+
 
 opds = Blueprint('opds', __name__)
 
 log = logger.create()
 
+STREAM_CHUNK_SIZE = 16 * 1024
+
 
 @opds.route("/opds/")
 @opds.route("/opds")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_index():
     return render_xml_template('index.xml')
 
 
 @opds.route("/opds/osd")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_osd():
     return render_xml_template('osd.xml', lang='en-EN')
 
@@ -61,7 +76,7 @@ def feed_osd():
 @requires_basic_auth_if_no_ano
 def feed_cc_search(query):
     # Handle strange query from Libera Reader with + instead of spaces
-    plus_query = unquote_plus(request.environ['RAW_URI'].split('/opds/search/')[1]).strip()
+    plus_query = unquote_plus(request.environ['RAW_URI'].split('/opds/search/')[1].split('?')[0]).strip()
     return feed_search(plus_query)
 
 
@@ -73,12 +88,14 @@ def feed_normal_search():
 
 @opds.route("/opds/books")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_booksindex():
     return render_element_index(db.Books.sort, None, 'opds.feed_letter_books')
 
 
 @opds.route("/opds/books/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_books(book_id):
     off = request.args.get("offset") or 0
     letter = true() if book_id == "00" else func.upper(db.Books.sort).startswith(book_id)
@@ -86,20 +103,23 @@ def feed_letter_books(book_id):
                                                         db.Books,
                                                         letter,
                                                         [db.Books.sort],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
 @opds.route("/opds/new")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_new():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RECENT):
         abort(404)
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books, True, [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -118,6 +138,7 @@ def feed_discover():
 
 @opds.route("/opds/rated")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_best_rated():
     if not auth.current_user().check_visibility(constants.SIDEBAR_BEST_RATED):
         abort(404)
@@ -125,13 +146,15 @@ def feed_best_rated():
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books, db.Books.ratings.any(db.Ratings.rating > 9),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
 @opds.route("/opds/hot")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_hot():
     if not auth.current_user().check_visibility(constants.SIDEBAR_HOT):
         abort(404)
@@ -157,6 +180,7 @@ def feed_hot():
 
 @opds.route("/opds/author")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_authorindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
@@ -165,6 +189,7 @@ def feed_authorindex():
 
 @opds.route("/opds/author/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_author(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
@@ -183,12 +208,14 @@ def feed_letter_author(book_id):
 
 @opds.route("/opds/author/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_author(book_id):
     return render_xml_dataset(db.Authors, book_id)
 
 
 @opds.route("/opds/publisher")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_publisherindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_PUBLISHER):
         abort(404)
@@ -207,12 +234,14 @@ def feed_publisherindex():
 
 @opds.route("/opds/publisher/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_publisher(book_id):
     return render_xml_dataset(db.Publishers, book_id)
 
 
 @opds.route("/opds/category")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_categoryindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
@@ -221,6 +250,7 @@ def feed_categoryindex():
 
 @opds.route("/opds/category/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_category(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
@@ -241,12 +271,14 @@ def feed_letter_category(book_id):
 
 @opds.route("/opds/category/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_category(book_id):
     return render_xml_dataset(db.Tags, book_id)
 
 
 @opds.route("/opds/series")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_seriesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
@@ -255,6 +287,7 @@ def feed_seriesindex():
 
 @opds.route("/opds/series/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_series(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
@@ -275,19 +308,22 @@ def feed_letter_series(book_id):
 
 @opds.route("/opds/series/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_series(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books,
                                                         db.Books.series.any(db.Series.id == book_id),
                                                         [db.Books.series_index],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
 @opds.route("/opds/ratings")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_ratingindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RATING):
         abort(404)
@@ -311,12 +347,14 @@ def feed_ratingindex():
 
 @opds.route("/opds/ratings/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_ratings(book_id):
     return render_xml_dataset(db.Ratings, book_id)
 
 
 @opds.route("/opds/formats")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_formatindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_FORMAT):
         abort(404)
@@ -336,13 +374,15 @@ def feed_formatindex():
 
 @opds.route("/opds/formats/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_format(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books,
                                                         db.Books.data.any(db.Data.format == book_id.upper()),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -350,6 +390,7 @@ def feed_format(book_id):
 @opds.route("/opds/language")
 @opds.route("/opds/language/")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_languagesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_LANGUAGE):
         abort(404)
@@ -368,19 +409,22 @@ def feed_languagesindex():
 
 @opds.route("/opds/language/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_languages(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books,
                                                         db.Books.languages.any(db.Languages.id == book_id),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        cursor=request.args.get("cursor", ""))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
 @opds.route("/opds/shelfindex")
 @requires_basic_auth_if_no_ano
+@cached_feed(per_user=True)
 def feed_shelfindex():
     if not (auth.current_user().is_authenticated or g.allow_anonymous):
         abort(404)
@@ -396,6 +440,7 @@ def feed_shelfindex():
 
 @opds.route("/opds/shelf/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed(per_user=True)
 def feed_shelf(book_id):
     if not (auth.current_user().is_authenticated or g.allow_anonymous):
         abort(404)
@@ -480,6 +525,7 @@ def feed_get_cover(book_id):
 
 @opds.route("/opds/readbooks")
 @requires_basic_auth_if_no_ano
+@cached_feed(per_user=True)
 def feed_read_books():
     if not (auth.current_user().check_visibility(constants.SIDEBAR_READ_AND_UNREAD) and not auth.current_user().is_anonymous):
         return abort(403)
@@ -491,6 +537,7 @@ def feed_read_books():
 
 @opds.route("/opds/unreadbooks")
 @requires_basic_auth_if_no_ano
+@cached_feed(per_user=True)
 def feed_unread_books():
     if not (auth.current_user().check_visibility(constants.SIDEBAR_READ_AND_UNREAD) and not auth.current_user().is_anonymous):
         return abort(403)
@@ -514,11 +561,20 @@ class FeedObject:
         return self.rating_name
 
 
+def get_search_offset():
+    # offset is used by the feed links, startIndex (counting from 1) by OpenSearch clients
+    try:
+        if request.args.get("startIndex"):
+            return max(int(request.args.get("startIndex")) - 1, 0)
+        return max(int(request.args.get("offset") or 0), 0)
+    except ValueError:
+        return 0
+
+
 def feed_search(term):
     if term:
-        entries, __, ___ = calibre_db.get_search_results(term, config=config)
-        entries_count = len(entries) if len(entries) > 0 else 1
-        pagination = Pagination(1, entries_count, entries_count)
+        entries, __, pagination = calibre_db.get_search_results(term, config, get_search_offset(), None,
+                                                                config.config_books_per_page, exact_count=True)
         cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
         return render_xml_template('feed.xml', searchterm=term, entries=entries, pagination=pagination, cc=cc)
     else:
@@ -527,12 +583,29 @@ def feed_search(term):
 
 
 def render_xml_template(*args, **kwargs):
+    """Renders the feed while it's sent, the size of a feed doesn't influence the time to the first byte
+    and the feed is never held in memory as a whole"""
     # ToDo: return time in current timezone similar to %z
     currtime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
-    xml = render_template(current_time=currtime, instance=config.config_calibre_web_title, constants=constants.sidebar_settings, *args, **kwargs)
-    response = make_response(xml)
-    response.headers["Content-Type"] = "application/atom+xml; charset=utf-8"
-    return response
+    xml = stream_template(current_time=currtime, instance=config.config_calibre_web_title,
+                          constants=constants.sidebar_settings, *args, **kwargs)
+    return Response(stream_with_context(calibre_db.keep_session(buffer_chunks(xml))),
+                    content_type="application/atom+xml; charset=utf-8")
+
+
+def buffer_chunks(chunks, size=STREAM_CHUNK_SIZE):
+    # jinja yields every piece of text on its own, send them in larger blocks
+    buffer = list()
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = list()
+            length = 0
+    if buffer:
+        yield "".join(buffer)
 
 
 def render_xml_dataset(data_table, book_id):
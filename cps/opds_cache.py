@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Cache of rendered OPDS feeds. OPDS clients poll the same feeds over and over, a feed is rendered once per
+# (url, restrictions of the user, library generation) and served from memory until metadata.db or app.db
+# (shelves, archived and read books, downloads, settings) are written to.
+# Users with the same restrictions and visibility settings share the cached feeds, feeds showing data of a single
+# user (shelves, read books) or users with archived books get their own entries.
+# Streamed feeds are collected while they are sent and stored after the last chunk.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+from flask_babel import get_locale
+
+from . import logger, ub, calibre_db
+from .usermanagement import auth
+
+log = logger.create()
+
+FEED_CACHE_BYTES = 16 * 1024 * 1024
+FEED_CONTENT_TYPE = "application/atom+xml; charset=utf-8"
+
+_feeds = OrderedDict()
+_feeds_size = 0
+_feeds_lock = threading.Lock()
+
+
+def get_generation():
+    """Modification times of metadata.db and app.db, changes with every write to one of them"""
+    try:
+        app_db_generation = os.stat(ub.app_DB_path).st_mtime_ns
+    except (OSError, TypeError):
+        app_db_generation = None
+    return calibre_db.get_library_generation(), app_db_generation
+
+
+def _has_archived_books(user):
+    return ub.session.query(ub.ArchivedBook.id).filter(ub.ArchivedBook.user_id == user.id,
+                                                       ub.ArchivedBook.is_archived == True).first() is not None
+
+
+def get_fingerprint(user, per_user=False):
+    """Everything of the user influencing the content of a feed"""
+    fingerprint = (user.filter_language(),
+                   tuple(user.list_denied_tags()),
+                   tuple(user.list_allowed_tags()),
+                   user.denied_column_value or "",
+                   user.allowed_column_value or "",
+                   user.sidebar_view,
+                   user.role,
+                   user.is_anonymous,
+                   str(get_locale()))
+    if per_user or (not user.is_anonymous and _has_archived_books(user)):
+        fingerprint += (user.id,)
+    return fingerprint
+
+
+def get_feed(key):
+    with _feeds_lock:
+        feed = _feeds.get(key)
+        if feed is not None:
+            _feeds.move_to_end(key)
+        return feed
+
+
+def store_feed(key, data):
+    global _feeds_size
+    if len(data) > FEED_CACHE_BYTES // 4:
+        return
+    etag = hashlib.sha1(data).hexdigest()
+    with _feeds_lock:
+        if key not in _feeds:
+            _feeds[key] = (etag, data)
+            _feeds_size += len(data)
+            while _feeds_size > FEED_CACHE_BYTES:
+                _feeds_size -= len(_feeds.popitem(last=False)[1][1])
+    return etag
+
+
+def clear():
+    global _feeds_size
+    with _feeds_lock:
+        _feeds.clear()
+        _feeds_size = 0
+
+
+def _feed_response(etag, data):
+    response = make_response(data)
+    response.headers["Content-Type"] = FEED_CONTENT_TYPE
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def cached_feed(per_user=False):
+    """Serves the feed rendered by the view from the cache, clients sending the ETag of the feed get 304 responses.
+    per_user has to be set for feeds showing data belonging to the current user"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            user = auth.current_user()
+            key = (request.script_root + request.full_path, get_fingerprint(user, per_user), get_generation())
+            feed = get_feed(key)
+            if feed:
+                return _feed_response(*feed)
+            response = f(*args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if response.is_streamed:
+                # the feed is stored once it's sent completely, the next request gets an ETag
+                response.response = _store_streamed_feed(key, response.response)
+                return response
+            etag = store_feed(key, response.get_data())
+            if not etag:
+                return response
+            return _feed_response(etag, response.get_data())
+        return decorated
+    return decorator
+
+
+def _store_streamed_feed(key, chunks):
+    parts = list()
+    size = 0
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                parts.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+                size += len(parts[-1])
+                if size > FEED_CACHE_BYTES // 4:
+                    parts = None
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    if parts is not None:
+        store_feed(key, b"".join(parts))
@@ -25,17 +25,25 @@ from math import ceil
 
 # simple pagination for the feed
 class Pagination(object):
-    def __init__(self, page, per_page, total_count):
+    def __init__(self, page, per_page, total_count, next_cursor=None, offset=None):
         self.page = int(page)
         self.per_page = int(per_page)
         self.total_count = int(total_count)
+        # keyset position of the next page, only set if the page was loaded with keyset pagination
+        self.next_cursor = next_cursor
+        # position of the first entry, only set if pages may start anywhere (OpenSearch startIndex)
+        self.offset = offset
 
     @property
     def next_offset(self):
+        if self.offset is not None:
+            return int(self.offset + self.per_page)
         return int(self.page * self.per_page)
 
     @property
     def previous_offset(self):
+        if self.offset is not None:
+            return max(int(self.offset - self.per_page), 0)
         return int((self.page - 2) * self.per_page)
 
     @property
@@ -51,10 +59,14 @@ class Pagination(object):
 
     @property
     def has_prev(self):
+        if self.offset is not None:
+            return self.offset > 0
         return self.page > 1
 
     @property
     def has_next(self):
+        if self.offset is not None:
+            return self.offset + self.per_page < self.total_count
         return self.page < self.pages
 
     # right_edge: last right_edges count of all pages are shown as number, means, if 10 pages are paginated -> 9,10 shown
@@ -25,6 +25,8 @@ from .tasks.clean import TaskClean
 from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails, TaskClearCoverThumbnailCache
 from .services.worker import WorkerThread
 from .tasks.metadata_backup import TaskBackupMetadata
+from .tasks.search_index import TaskUpdateSearchIndex
+from .tasks.kepub import TaskGenerateKepubs
 
 def get_scheduled_tasks(reconnect=True):
     tasks = list()
@@ -35,6 +37,9 @@ def get_scheduled_tasks(reconnect=True):
     # Delete temp folder
     tasks.append([lambda: TaskClean(), 'delete temp', True])
 
+    # Index books changed since the last run for full text search
+    tasks.append([lambda: TaskUpdateSearchIndex(), 'update search index', True])
+
     # Generate metadata.opf file for each changed book
     if config.schedule_metadata_backup:
         tasks.append([lambda: TaskBackupMetadata("en"), 'backup metadata', False])
@@ -48,6 +53,10 @@ def get_scheduled_tasks(reconnect=True):
     if config.schedule_generate_series_covers:
         tasks.append([lambda: TaskGenerateSeriesThumbnails(), 'generate book covers', False])
 
+    # Convert all books without kepub format for the Kobo sync
+    if config.config_kobo_sync and config.config_kepubifypath:
+        tasks.append([lambda: TaskGenerateKepubs(), 'generate kepub files', False])
+
     return tasks
 
 
@@ -94,7 +103,8 @@ def register_startup_tasks():
         if constants.APP_MODE in ['development', 'test'] and not should_task_be_running(start, duration):
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(False))
         else:
-            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True]])
+            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True],
+                                                        [lambda: TaskUpdateSearchIndex(), 'update search index', True]])
 
 
 def should_task_be_running(start, duration):
@@ -25,7 +25,7 @@ from flask_babel import gettext as _
 from sqlalchemy.sql.expression import func, not_, and_, or_, text, true
 from sqlalchemy.sql.functions import coalesce
 
-from . import logger, db, calibre_db, config, ub
+from . import logger, db, calibre_db, config, ub, search_index
 from .string_helper import strip_whitespaces
 from .usermanagement import login_required_if_no_ano
 from .render_template import render_title_template
@@ -334,9 +334,10 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
                                                              rating_low,
                                                              read_status)
         if author_name:
-            q = q.filter(db.Books.authors.any(func.lower(db.Authors.name).ilike("%" + author_name + "%")))
+            q = q.filter(db.Books.authors.any(search_index.key_filter('authors', db.Authors.id, db.Authors.name,
+                                                                      author_name)))
         if book_title:
-            q = q.filter(func.lower(db.Books.title).ilike("%" + book_title + "%"))
+            q = q.filter(search_index.key_filter('books', db.Books.id, db.Books.title, book_title))
         if pub_start:
             q = q.filter(func.datetime(db.Books.pubdate) > func.datetime(pub_start))
         if pub_end:
@@ -344,7 +345,8 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
         if read_status != "Any":
             q = q.filter(adv_search_read_status(read_status))
         if publisher:
-            q = q.filter(db.Books.publishers.any(func.lower(db.Publishers.name).ilike("%" + publisher + "%")))
+            q = q.filter(db.Books.publishers.any(search_index.key_filter('publishers', db.Publishers.id,
+                                                                         db.Publishers.name, publisher)))
         q = adv_search_tag(q, tags['include_tag'], tags['exclude_tag'])
         q = adv_search_serie(q, tags['include_serie'], tags['exclude_serie'])
         q = adv_search_shelf(q, tags['include_shelf'], tags['exclude_shelf'])
@@ -364,18 +366,18 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
             log.debug_or_exception(ex)
             flash(_("Error on search for custom columns, please restart Calibre-Web"), category="error")
 
-    q = q.order_by(*sort).all()
+    q = q.order_by(*sort)
     flask_session['query'] = json.dumps(term)
-    ub.store_combo_ids(q)
-    result_count = len(q)
+    # only the ids of all matching books are loaded (for adding the results to a shelf), complete books are loaded
+    # for the displayed page only
+    book_ids = q.with_entities(db.Books.id).all()
+    ub.store_ids(book_ids)
+    result_count = len(book_ids)
     if offset is not None and limit is not None:
         offset = int(offset)
-        limit_all = offset + int(limit)
         pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-    else:
-        offset = 0
-        limit_all = result_count
-    entries = calibre_db.order_authors(q[offset:limit_all], list_return=True, combined=True)
+        q = q.offset(offset).limit(int(limit))
+    entries = calibre_db.order_authors(q.all(), list_return=True, combined=True)
     return render_title_template('search.html',
                                  adv_searchterm=search_term,
                                  pagination=pagination,
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Full text search index and normalized search keys for the calibre library. Both live in a sidecar database next
+# to app.db which is attached as "search_index" to every calibre database connection, metadata.db is never written to.
+
+import os
+import re
+
+import unidecode
+from sqlalchemy import text, column, Table, Column, MetaData, Integer, String
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import select, and_, or_, func, tuple_
+
+from . import logger
+from .constants import SEARCH_INDEX_FILE
+
+log = logger.create()
+
+BATCH_SIZE = 500
+
+# custom column types which are searched as text
+CC_TEXT_TYPES = ['text', 'comments', 'enumeration']
+
+# the index holds the normalized text and is searched for substrings like the LIKE searches it replaces,
+# terms shorter than 3 characters can't be looked up in a trigram index
+FTS_TOKENIZER = "trigram"
+FTS_MIN_TOKEN_LENGTH = 3
+
+# normalized (lowercased and transliterated) search keys, compared with LIKE instead of calling lower() per row
+# (table, name column, link table and its column pointing to the table)
+KEY_SOURCES = [('books', 'title', None, None),
+               ('authors', 'name', 'books_authors_link', 'author'),
+               ('tags', 'name', 'books_tags_link', 'tag'),
+               ('series', 'name', 'books_series_link', 'series'),
+               ('publishers', 'name', 'books_publishers_link', 'publisher')]
+
+search_keys = Table('search_keys', MetaData(),
+                    Column('type', String, primary_key=True),
+                    Column('id', Integer, primary_key=True),
+                    Column('name', String),
+                    Column('key', String),
+                    schema='search_index')
+
+_html_tags = re.compile(r'<[^>]+>')
+
+
+def get_index_path(app_db_path):
+    return os.path.join(os.path.dirname(app_db_path), SEARCH_INDEX_FILE)
+
+
+def normalize(value):
+    try:
+        return unidecode.unidecode(value.lower())
+    except Exception as ex:
+        log.error_or_exception(ex)
+        return value.lower()
+
+
+def create_key_table(connection):
+    connection.execute(text("CREATE TABLE IF NOT EXISTS search_index.search_keys "
+                            "(type TEXT NOT NULL, id INTEGER NOT NULL, name TEXT, key TEXT, PRIMARY KEY (type, id))"))
+
+
+def _changed_keys(session, key_type, name_column, condition=""):
+    return session.execute(text(
+        "SELECT t.id, t.{1} FROM {0} t LEFT JOIN search_index.search_keys k ON k.type = :type AND k.id = t.id "
+        "WHERE (k.id IS NULL OR k.name IS NOT t.{1}){2}".format(key_type, name_column, condition)),
+        {"type": key_type}).fetchall()
+
+
+def update_keys(session, book_ids=None):
+    """Creates the search keys for all new or renamed entries and removes keys of deleted entries,
+    only the entries of the given books are updated if book_ids is set"""
+    for key_type, name_column, link_table, link_column in KEY_SOURCES:
+        if book_ids is None:
+            changed = _changed_keys(session, key_type, name_column)
+        else:
+            changed = list()
+            for start in range(0, len(book_ids), BATCH_SIZE):
+                ids = ",".join(str(int(book_id)) for book_id in book_ids[start:start + BATCH_SIZE])
+                if link_table:
+                    condition = " AND t.id IN (SELECT {} FROM {} WHERE book IN ({}))".format(link_column, link_table,
+                                                                                             ids)
+                else:
+                    condition = " AND t.id IN ({})".format(ids)
+                changed.extend(_changed_keys(session, key_type, name_column, condition))
+        for start in range(0, len(changed), BATCH_SIZE):
+            session.execute(text("INSERT OR REPLACE INTO search_index.search_keys (type, id, name, key) "
+                                 "VALUES (:type, :id, :name, :key)"),
+                            [{"type": key_type, "id": row[0], "name": row[1], "key": normalize(row[1] or "")}
+                             for row in changed[start:start + BATCH_SIZE]])
+        if book_ids is None:
+            session.execute(text("DELETE FROM search_index.search_keys WHERE type = :type "
+                                 "AND id NOT IN (SELECT id FROM {})".format(key_type)), {"type": key_type})
+    session.commit()
+
+
+def key_filter(key_type, id_column, name_column, term):
+    """Filter expression matching all rows whose search key contains the term. Rows without a search key
+    or whose key was created for another name (added or renamed since the last key update) are compared using lower()"""
+    keys = select(search_keys.c.id, search_keys.c.name).where(search_keys.c.type == key_type)
+    matching = keys.where(search_keys.c.key.like("%" + normalize(term) + "%"))
+    return or_(tuple_(id_column, name_column).in_(matching),
+               and_(tuple_(id_column, name_column).notin_(keys), func.lower(name_column).ilike("%" + term + "%")))
+
+
+def create_index(session):
+    """Creates the index, an index built with another tokenizer is dropped and rebuilt.
+    Returns False if the SQLite library doesn't support the trigram tokenizer (before 3.34)"""
+    session.execute(text("CREATE TABLE IF NOT EXISTS search_index.books_fts_state "
+                         "(key TEXT PRIMARY KEY, value TEXT)"))
+    if _get_state(session, "tokenizer") != FTS_TOKENIZER:
+        session.execute(text("DROP TABLE IF EXISTS search_index.books_fts"))
+        _set_state(session, "complete", "0")
+    try:
+        session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS search_index.books_fts USING fts5("
+                             "title, authors, tags, series, publishers, comments, custom, "
+                             "tokenize = '{}')".format(FTS_TOKENIZER)))
+    except OperationalError as ex:
+        log.warning("Full text search index not available, searches compare all books: {}".format(ex))
+        return False
+    _set_state(session, "tokenizer", FTS_TOKENIZER)
+    return True
+
+
+def _get_state(session, key):
+    row = session.execute(text("SELECT value FROM search_index.books_fts_state WHERE key = :key"),
+                          {"key": key}).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(session, key, value):
+    session.execute(text("INSERT OR REPLACE INTO search_index.books_fts_state (key, value) VALUES (:key, :value)"),
+                    {"key": key, "value": value})
+
+
+def _columns_signature(cc):
+    return ",".join(str(c.id) for c in cc)
+
+
+def is_ready(session):
+    try:
+        return _get_state(session, "complete") == "1"
+    except OperationalError:
+        return False
+
+
+def _custom_column_expression(cc):
+    expressions = list()
+    for c in cc:
+        if c.datatype == 'comments':
+            expressions.append("coalesce((SELECT group_concat(value, ' ') FROM custom_column_{0} "
+                               "WHERE book = b.id), '')".format(c.id))
+        else:
+            expressions.append("coalesce((SELECT group_concat(c.value, ' ') FROM books_custom_column_{0}_link l "
+                               "JOIN custom_column_{0} c ON c.id = l.value WHERE l.book = b.id), '')".format(c.id))
+    return " || ' ' || ".join(expressions) if expressions else "''"
+
+
+def _index_rows(session, book_ids, cc):
+    rows = session.execute(text(
+        "SELECT b.id, b.title, "
+        "(SELECT group_concat(a.name, ' ') FROM books_authors_link l JOIN authors a ON a.id = l.author "
+        "WHERE l.book = b.id), "
+        "(SELECT group_concat(t.name, ' ') FROM books_tags_link l JOIN tags t ON t.id = l.tag "
+        "WHERE l.book = b.id), "
+        "(SELECT group_concat(s.name, ' ') FROM books_series_link l JOIN series s ON s.id = l.series "
+        "WHERE l.book = b.id), "
+        "(SELECT group_concat(p.name, ' ') FROM books_publishers_link l JOIN publishers p ON p.id = l.publisher "
+        "WHERE l.book = b.id), "
+        "(SELECT group_concat(text, ' ') FROM comments WHERE book = b.id), "
+        "{} "
+        "FROM books b WHERE b.id IN ({})".format(_custom_column_expression(cc),
+                                                 ",".join(str(int(book_id)) for book_id in book_ids))))
+    for row in rows:
+        yield {"rowid": row[0],
+               "title": normalize(row[1] or ""),
+               "authors": normalize((row[2] or "").replace('|', ',')),
+               "tags": normalize(row[3] or ""),
+               "series": normalize(row[4] or ""),
+               "publishers": normalize(row[5] or ""),
+               "comments": normalize(_html_tags.sub(" ", row[6] or "")),
+               "custom": normalize(_html_tags.sub(" ", row[7] or ""))}
+
+
+def index_books(session, book_ids, cc):
+    """(Re-)indexes the given books, books no longer present in the library are removed from the index"""
+    for start in range(0, len(book_ids), BATCH_SIZE):
+        batch = book_ids[start:start + BATCH_SIZE]
+        session.execute(text("DELETE FROM search_index.books_fts WHERE rowid IN ({})".format(
+            ",".join(str(int(book_id)) for book_id in batch))))
+        rows = list(_index_rows(session, batch, cc))
+        if rows:
+            session.execute(text("INSERT INTO search_index.books_fts "
+                                 "(rowid, title, authors, tags, series, publishers, comments, custom) "
+                                 "VALUES (:rowid, :title, :authors, :tags, :series, :publishers, :comments, :custom)"),
+                            rows)
+        yield len(batch)
+
+
+def update_index(session, cc, book_ids=None):
+    """Brings the search keys and the index up to date, either for the given books or for all books changed
+    since the last run.
+    The index is rebuilt from scratch if it was never completed or the set of indexed custom columns changed.
+    Yields the progress as a value between 0 and 1 after every committed batch."""
+    update_keys(session, list(book_ids) if book_ids is not None else None)
+    indexed = create_index(session)
+    session.commit()
+    if not indexed:
+        yield 1
+        return
+    complete = _get_state(session, "complete") == "1"
+    columns_changed = _get_state(session, "columns") != _columns_signature(cc)
+    if book_ids is not None and complete and not columns_changed:
+        book_ids = list(book_ids)
+        for __ in index_books(session, book_ids, cc):
+            session.commit()
+        yield 1
+        return
+
+    watermark = session.execute(text("SELECT max(last_modified) FROM books")).scalar()
+    if not complete or columns_changed:
+        _set_state(session, "complete", "0")
+        session.execute(text("DELETE FROM search_index.books_fts"))
+        session.commit()
+        changed_ids = [r[0] for r in session.execute(text("SELECT id FROM books"))]
+    else:
+        last_modified = _get_state(session, "last_modified") or ""
+        changed_ids = [r[0] for r in session.execute(text("SELECT id FROM books WHERE last_modified > :last"),
+                                                     {"last": last_modified})]
+        # remove books deleted outside of Calibre-Web
+        session.execute(text("DELETE FROM search_index.books_fts WHERE rowid NOT IN (SELECT id FROM books)"))
+        session.commit()
+    done = 0
+    for count in index_books(session, changed_ids, cc):
+        session.commit()
+        done += count
+        yield done / len(changed_ids)
+    _set_state(session, "last_modified", str(watermark or ""))
+    _set_state(session, "columns", _columns_signature(cc))
+    _set_state(session, "complete", "1")
+    session.commit()
+    yield 1
+
+
+def _match_expression(term):
+    tokens = re.findall(r'\w+', normalize(term))
+    if not tokens or any(len(token) < FTS_MIN_TOKEN_LENGTH for token in tokens):
+        return None
+    return " ".join('"{}"'.format(token) for token in tokens)
+
+
+def search(session, term):
+    """Returns a subquery selecting the ids of all indexed books containing every word of the term,
+    None if the index can't be used for the term"""
+    match = _match_expression(term)
+    if not match or not is_ready(session):
+        return None
+    return text("SELECT rowid FROM search_index.books_fts WHERE books_fts MATCH :term") \
+        .bindparams(term=match).columns(column("rowid"))
+
+
+def indexed_books():
+    """Subquery selecting the ids of all indexed books, books added outside of Calibre-Web since the last
+    index update are missing"""
+    return text("SELECT rowid FROM search_index.books_fts").columns(column("rowid"))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Journal of the background task queue in app.db. Tasks providing journal_args are recorded when they are queued
+# and removed once they are done, tasks still waiting or running at shutdown are queued again on the next start.
+
+import json
+import importlib
+from datetime import datetime, timezone
+
+from sqlalchemy import exc
+
+from .. import logger, ub
+from . import worker
+
+log = logger.create()
+
+# tasks interrupted this often are not queued again
+MAX_ATTEMPTS = 3
+
+_session = None
+# journal ids of the tasks queued again on startup, only these are not queued twice
+_restored = set()
+
+
+def _get_session():
+    global _session
+    if _session is None and ub.app_DB_path:
+        _session = ub.get_new_session_instance()
+    return _session
+
+
+def _write(func):
+    session = _get_session()
+    if session is None:
+        return None
+    try:
+        result = func(session)
+        session.commit()
+        return result
+    except exc.SQLAlchemyError as ex:
+        session.rollback()
+        log.error_or_exception("Settings Database error: {}".format(ex))
+    finally:
+        # every runner thread gets its own session, it's closed after each write
+        session.remove()
+
+
+def record(item):
+    """Adds a newly queued task to the journal, returns False if the same task was restored on startup and is
+    still pending (e.g. a restored metadata extraction queues the downloads of a playlist again)"""
+    task = item.task
+    if task.journal_args is None or task.journal_id is not None or task.stat != worker.STAT_WAITING:
+        return True
+    task_class = "{}.{}".format(type(task).__module__, type(task).__name__)
+    args = json.dumps(task.journal_args, default=str, sort_keys=True)
+
+    def _record(session):
+        if _restored and session.query(ub.TaskJournal.id).filter(ub.TaskJournal.id.in_(list(_restored)),
+                                                                 ub.TaskJournal.task_class == task_class,
+                                                                 ub.TaskJournal.args == args).first():
+            return False
+        entry = ub.TaskJournal(task_class=task_class, args=args, user=item.user, hidden=item.hidden)
+        session.add(entry)
+        session.flush()
+        return entry.id
+    result = _write(_record)
+    if result is False:
+        return False
+    task.journal_id = result
+    return True
+
+
+def update(task):
+    """Stores the state of a journaled task, finished tasks are removed from the journal"""
+    if task.journal_id is None:
+        return
+
+    def _update(session):
+        query = session.query(ub.TaskJournal).filter(ub.TaskJournal.id == task.journal_id)
+        if task.stat in (worker.STAT_WAITING, worker.STAT_STARTED):
+            values = {"status": task.stat,
+                      "progress": task.progress,
+                      "updated": datetime.now(timezone.utc)}
+            if task.stat == worker.STAT_STARTED:
+                values["attempts"] = ub.TaskJournal.attempts + 1
+            query.update(values, synchronize_session=False)
+        else:
+            query.delete(synchronize_session=False)
+    _write(_update)
+    if task.stat not in (worker.STAT_WAITING, worker.STAT_STARTED):
+        _restored.discard(task.journal_id)
+
+
+def _create_task(entry):
+    module_name, __, class_name = entry.task_class.rpartition(".")
+    if not module_name.startswith("cps.tasks."):
+        raise ValueError("Invalid task class {}".format(entry.task_class))
+    task_class = getattr(importlib.import_module(module_name), class_name)
+    return task_class.from_journal(json.loads(entry.args))
+
+
+def restore(worker_thread):
+    """Queues all tasks which were waiting or running when Calibre-Web was stopped"""
+    def _restore(session):
+        # entries of tasks given up by earlier versions
+        session.query(ub.TaskJournal)\
+            .filter(ub.TaskJournal.status.notin_([worker.STAT_WAITING, worker.STAT_STARTED]))\
+            .delete(synchronize_session=False)
+        entries = session.query(ub.TaskJournal).order_by(ub.TaskJournal.id).all()
+        restored = list()
+        for entry in entries:
+            if entry.attempts >= MAX_ATTEMPTS:
+                log.error("Task {} was interrupted {} times, not queued again: {}".format(entry.task_class,
+                                                                                          entry.attempts,
+                                                                                          entry.args))
+                session.delete(entry)
+                continue
+            try:
+                task = _create_task(entry)
+            except Exception as ex:
+                log.error_or_exception("Could not restore task {} {}: {}".format(entry.task_class, entry.args, ex))
+                session.delete(entry)
+                continue
+            task.journal_id = entry.id
+            restored.append((entry.user, task, entry.hidden))
+        # entries of finished tasks are deleted when the task ends
+        return restored
+    restored = _write(_restore) or list()
+    _restored.update(task.journal_id for __, task, __ in restored)
+    for user, task, hidden in restored:
+        worker_thread.add(None if user == 'System' else user, task, hidden)
+    if restored:
+        log.info("Queued {} interrupted tasks again".format(len(restored)))
@@ -19,16 +19,13 @@
 import threading
 import abc
 import uuid
-import time
 
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 from datetime import datetime
 from collections import namedtuple
 
 from cps import logger
+from cps.constants import TASK_LANE_LIMITS
+from cps.services import task_journal
 
 log = logger.create()
 
@@ -43,6 +40,11 @@ STAT_CANCELLED = 5
 # Only retain this many tasks in dequeued list
 TASK_CLEANUP_TRIGGER = 101
 
+# task priorities, lower values are started first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task, hidden')
 
 
@@ -53,17 +55,10 @@ def _get_main_thread():
     raise Exception("main thread not found?!")
 
 
-class ImprovedQueue(queue.Queue):
-    def to_list(self):
-        """
-        Returns a copy of all items in the queue without removing them.
-        """
-
-        with self.mutex:
-            return list(self.queue)
-
-
 # Class for all worker tasks in the background
+# The worker thread dispatches the queued tasks to runner threads. Every task class belongs to a lane, the number of
+# tasks running concurrently per lane is limited by TASK_LANE_LIMITS. Waiting tasks are started by priority, tasks of
+# users with fewer running tasks first, then in the order they were added
 class WorkerThread(threading.Thread):
     _instance = None
 
@@ -77,30 +72,44 @@ class WorkerThread(threading.Thread):
         threading.Thread.__init__(self)
 
         self.dequeued = list()
+        self.waiting = list()
+        self.running = list()
+        self.lane_limits = dict(TASK_LANE_LIMITS)
 
         self.doLock = threading.Lock()
-        self.queue = ImprovedQueue()
+        self.changed = threading.Condition(self.doLock)
         self.num = 0
         self.start()
 
     @classmethod
     def add(cls, user, task, hidden=False):
         ins = cls.get_instance()
-        ins.num += 1
         username = user if user is not None else 'System'
         log.debug("Add Task for user: {} - {}".format(username, task))
-        ins.queue.put(QueuedTask(
-            num=ins.num,
-            user=username,
-            added=datetime.now(),
-            task=task,
-            hidden=hidden
-        ))
+        with ins.changed:
+            ins.num += 1
+            item = QueuedTask(
+                num=ins.num,
+                user=username,
+                added=datetime.now(),
+                task=task,
+                hidden=hidden
+            )
+        if not task_journal.record(item):
+            log.info("Task restored from the last run is already queued: {}".format(task))
+            return
+        with ins.changed:
+            ins.waiting.append(item)
+            ins.changed.notify()
+
+    def restore_tasks(self):
+        """Queues the tasks interrupted by the last shutdown again"""
+        task_journal.restore(self)
 
     @property
     def tasks(self):
         with self.doLock:
-            tasks = self.queue.to_list() + self.dequeued
+            tasks = self.waiting + self.dequeued
             return sorted(tasks, key=lambda x: x.num)
 
     def cleanup_tasks(self):
@@ -120,22 +129,44 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda y: y.num)
 
+    def _lane_limit(self, task):
+        return self.lane_limits.get(task.lane, self.lane_limits.get('default', 1))
+
+    def _next_task(self):
+        """Returns the next startable waiting task, has to be called with doLock held"""
+        running_per_lane = dict()
+        running_per_user = dict()
+        for item in self.running:
+            running_per_lane[item.task.lane] = running_per_lane.get(item.task.lane, 0) + 1
+            running_per_user[item.user] = running_per_user.get(item.user, 0) + 1
+        candidates = list()
+        for index, item in enumerate(self.waiting):
+            # finished or cancelled tasks are handed out immediately, they are only listed
+            if item.task.stat is not STAT_WAITING:
+                return item
+            if running_per_lane.get(item.task.lane, 0) >= self._lane_limit(item.task):
+                continue
+            # tasks sharing a resource run one after another in the order they were added
+            if any(item.task.conflicts_with(other.task) for other in self.running + self.waiting[:index]):
+                continue
+            candidates.append(item)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: (x.task.priority, running_per_user.get(x.user, 0), x.num))
+
     # Main thread loop starting the different tasks
     def run(self):
         main_thread = _get_main_thread()
         while main_thread.is_alive():
-            try:
-                # this blocks until something is available. This can cause issues when the main thread dies - this
-                # thread will remain alive. We implement a timeout to unblock every second which allows us to check if
-                # the main thread is still alive.
-                # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
-                # possible file / database corruption
-                item = self.queue.get(timeout=1)
-            except queue.Empty:
-                time.sleep(1)
-                continue
-
-            with self.doLock:
+            with self.changed:
+                item = self._next_task()
+                if item is None:
+                    # We implement a timeout to unblock every second which allows us to check if the main thread is
+                    # still alive. We don't use daemon threads here because we don't want the tasks to just be
+                    # abruptly halted, leading to possible file / database corruption
+                    self.changed.wait(timeout=1)
+                    continue
+                self.waiting.remove(item)
                 # add to list so that in-progress tasks show up
                 self.dequeued.append(item)
 
@@ -145,14 +176,32 @@ class WorkerThread(threading.Thread):
 
             # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
             if item.task.stat is STAT_WAITING:
-                # CalibreTask.start() should wrap all exceptions in its own error handling
-                item.task.start(self)
-
-            # remove self_cleanup tasks and hidden "System Tasks" from list
-            if item.task.self_cleanup or item.hidden:
-                self.dequeued.remove(item)
+                with self.doLock:
+                    self.running.append(item)
+                threading.Thread(target=self._run_task, args=(item,),
+                                 name="{}-{}".format(item.task.lane, item.num)).start()
+            else:
+                self._finish_task(item)
 
-            self.queue.task_done()
+    def _run_task(self, item):
+        # CalibreTask.start() should wrap all exceptions in its own error handling
+        try:
+            item.task.stat = STAT_STARTED
+            task_journal.update(item.task)
+            item.task.start(self)
+        finally:
+            with self.changed:
+                self.running.remove(item)
+                self.changed.notify()
+            self._finish_task(item)
+
+    def _finish_task(self, item):
+        task_journal.update(item.task)
+        # remove self_cleanup tasks and hidden "System Tasks" from list
+        if item.task.self_cleanup or item.hidden:
+            with self.doLock:
+                if item in self.dequeued:
+                    self.dequeued.remove(item)
 
     def end_task(self, task_id):
         ins = self.get_instance()
@@ -164,6 +213,16 @@ class WorkerThread(threading.Thread):
 class CalibreTask:
     __metaclass__ = abc.ABCMeta
 
+    # lane limiting the number of concurrently running tasks of this kind, see TASK_LANE_LIMITS
+    lane = 'default'
+    priority = PRIORITY_NORMAL
+    # tasks with the same resource are never running at the same time
+    resource = None
+    # exclusive tasks wait for all running tasks to finish and no other task is started while they run
+    exclusive = False
+    # constructor arguments of tasks which are queued again after a restart, None for tasks which are not
+    journal_args = None
+
     def __init__(self, message):
         self._progress = 0
         self.stat = STAT_WAITING
@@ -174,6 +233,12 @@ class CalibreTask:
         self.id = uuid.uuid4()
         self.self_cleanup = False
         self._scheduled = False
+        self.journal_id = None
+
+    @classmethod
+    def from_journal(cls, args):
+        """Creates the task from the journal_args stored before the restart"""
+        return cls(**args)
 
     @abc.abstractmethod
     def run(self, worker_thread):
@@ -258,6 +323,12 @@ class CalibreTask:
     def scheduled(self, is_scheduled):
         self._scheduled = is_scheduled
 
+    def conflicts_with(self, other):
+        """Returns True if this task must not run while the other task is running or queued before it"""
+        if self.exclusive or other.exclusive:
+            return True
+        return self.resource is not None and self.resource == other.resource
+
     def _handleError(self, error_message):
         self.stat = STAT_FAIL
         self.progress = 1
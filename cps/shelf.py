@@ -29,7 +29,7 @@ from .cw_login import current_user
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 from sqlalchemy.sql.expression import func, true
 
-from . import calibre_db, config, db, logger, ub
+from . import calibre_db, config, db, logger, ub, helper
 from .render_template import render_title_template
 from .usermanagement import login_required_if_no_ano, user_login_required
 
@@ -116,12 +116,13 @@ def search_from_shelf(shelf_id):
         flash(_("You are not allowed to remove a book from the shelf"), category="error")
         return redirect(url_for('web.index'))
 
-    if current_user.id in ub.searched_ids and ub.searched_ids[current_user.id]:
+    searched_ids = ub.searched_ids.get(current_user.id)
+    if searched_ids:
         books_from_shelf = list()
         books_in_shelf = ub.session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id).all()
         if books_in_shelf:
             book_ids = [book_id.book_id for book_id in books_in_shelf]
-            for searchid in ub.searched_ids[current_user.id]:
+            for searchid in searched_ids:
                 if searchid in book_ids:
                     books_from_shelf.append(searchid)
         else:
@@ -162,16 +163,17 @@ def search_to_shelf(shelf_id):
         flash(_("You are not allowed to add a book to the shelf"), category="error")
         return redirect(url_for('web.index'))
 
-    if current_user.id in ub.searched_ids and ub.searched_ids[current_user.id]:
+    searched_ids = ub.searched_ids.get(current_user.id)
+    if searched_ids:
         books_for_shelf = list()
         books_in_shelf = ub.session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id).all()
         if books_in_shelf:
             book_ids = [book_id.book_id for book_id in books_in_shelf]
-            for searchid in ub.searched_ids[current_user.id]:
+            for searchid in searched_ids:
                 if searchid not in book_ids:
                     books_for_shelf.append(searchid)
         else:
-            books_for_shelf = ub.searched_ids[current_user.id]
+            books_for_shelf = searched_ids
 
         if not books_for_shelf:
             log.error("Books are already part of {}".format(shelf.name))
@@ -419,6 +421,8 @@ def create_edit_shelf(shelf, page_title, page, shelf_id=False):
             try:
                 ub.session.commit()
                 log.info("Shelf {} {}".format(shelf_title, shelf_action))
+                if shelf.kobo_sync:
+                    helper.generate_kepubs([book_shelf.book_id for book_shelf in shelf.books])
                 flash(flash_text, category="success")
                 return redirect(url_for('shelf.show_shelf', shelf_id=shelf.id))
             except (OperationalError, InvalidRequestError) as ex:
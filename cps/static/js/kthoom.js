@@ -16,7 +16,7 @@
 
 */
 /* global screenfull, bitjs, Uint8Array, opera, loadArchiveFormats, archiveOpenFile */
-/* exported init, event */
+/* exported init, initPages, event */
 
 
 if (window.opera) {
@@ -63,6 +63,11 @@ var imageFiles = [];
 var imageFilenames = [];
 var totalImages = 0;
 var prevScrollPosition = 0;
+// pages loaded one by one from the server: pages loaded ahead of the current one, pages the server reads ahead
+// and width of the pages shown in the table of contents
+var PAGE_PRELOAD = 2;
+var PAGE_PREFETCH = 3;
+var THUMBNAIL_WIDTH = 200;
 
 var settings = {
     hflip: false,
@@ -173,8 +178,13 @@ kthoom.ImageFile = function(file) {
         this.mimeType = undefined;
     }
 
-    if ( this.mimeType !== undefined) {
+    if (file.url) {
+        // page served by the server, it's drawn once it's close to the current page
+        this.dataURI = file.url;
+        this.loaded = false;
+    } else if ( this.mimeType !== undefined) {
         this.dataURI = createURLFromArray(file.fileData, this.mimeType);
+        this.loaded = true;
     }
 };
 
@@ -260,6 +270,39 @@ function loadFromArrayBuffer(ab) {
     });
 }
 
+function loadFromPageIndex(indexUrl, index) {
+    totalImages = index.pages;
+    index.names.forEach(function(name, i) {
+        var pageUrl = indexUrl + "/" + i;
+        var page = new kthoom.ImageFile({filename: name, url: pageUrl + "?prefetch=" + PAGE_PREFETCH});
+        imageFilenames.push(name);
+        imageFiles.push(page);
+        $("#thumbnails").append(
+            "<li>" +
+            "<a data-page='" + (i + 1) + "'>" +
+            "<img loading='lazy' src='" + pageUrl + "?width=" + THUMBNAIL_WIDTH + "'/>" +
+            "<span>" + (i + 1) + "</span>" +
+            "</a>" +
+            "</li>"
+        );
+        drawCanvas();
+    });
+    updateProgress(100);
+    updateDirectionButtons();
+    updatePage();
+}
+
+// draws the current page and the pages around it if they are not loaded yet
+function loadPages() {
+    var last = Math.min(imageFiles.length, currentImage + 1 + PAGE_PRELOAD);
+    for (var i = Math.max(0, currentImage - 1); i < last; i++) {
+        if (imageFiles[i].loaded === false) {
+            imageFiles[i].loaded = true;
+            setImage(imageFiles[i].dataURI, $(".mainImage")[i]);
+        }
+    }
+}
+
 function scrollTocToActive() {
     $(".page").text((currentImage + 1 ) + "/" + totalImages);
 
@@ -279,6 +322,7 @@ function scrollTocToActive() {
 }
 
 function updatePage() {
+    loadPages();
     scrollTocToActive();
     scrollCurrentImageIntoView();
     updateProgress();
@@ -423,7 +467,9 @@ function setImage(url, _canvas) {
 // reloadImages is a slow process when multiple images are involved. Only used when rotating/mirroring
 function reloadImages() {
     for(i=0; i < imageFiles.length; i++) {
-        setImage(imageFiles[i].dataURI, $(".mainImage")[i]);
+        if (imageFiles[i].loaded) {
+            setImage(imageFiles[i].dataURI, $(".mainImage")[i]);
+        }
     }
 }
 
@@ -674,6 +720,23 @@ function init(filename) {
     setTheme();
     updateScale();
     request.send();
+    initControls();
+}
+
+// reads the comic page by page, indexUrl returns the number and names of the pages
+function initPages(indexUrl) {
+    kthoom.loadSettings();
+    setTheme();
+    updateScale();
+    $.getJSON(indexUrl, function(index) {
+        loadFromPageIndex(indexUrl, index);
+    }).fail(function(xhr) {
+        console.warn(xhr.statusText, xhr.responseText);
+    });
+    initControls();
+}
+
+function initControls() {
     initProgressClick();
     document.body.className += /AppleWebKit/.test(navigator.userAgent) ? " webkit" : "";
 
@@ -818,6 +881,7 @@ function init(filename) {
                         currentImage = imageFiles.length - 1;
                     }
                     console.log(currentImage);
+                    loadPages();
                     scrollTocToActive();
                     updateProgress();
                 }
@@ -828,6 +892,7 @@ function init(filename) {
                 if (currentImageOffset(currentImage - 1) >= 0) {
                     currentImage = Math.floor((imageFiles.length) / (viewLength-viewLength/(imageFiles.length)) * scroll, 0);
                     console.log(currentImage);
+                    loadPages();
                     scrollTocToActive();
                     updateProgress();
                 }
@@ -20,6 +20,8 @@ import sys
 import os
 import subprocess
 import re
+import codecs
+import selectors
 
 def process_open(command, quotes=(), env=None, sout=subprocess.PIPE, serr=subprocess.PIPE, newlines=True):
     # Linux py2.7 encode as list without quotes no empty element for parameters
@@ -54,3 +56,40 @@ def process_wait(command, serr=subprocess.PIPE, pattern=""):
     p.stdout.close()
     p.stderr.close()
     return ret_val
+
+
+def process_readlines(p, timeout=None, streams=None):
+    """Yields the output lines of the running process as soon as they are written, without polling.
+    Lines ended by a carriage return (progress bars) are yielded as well. All streams are read, so the process
+    never blocks on a full pipe. None is yielded every time no output arrived within timeout seconds.
+    Ends when all streams are closed"""
+    streams = [stream for stream in (streams or [p.stdout]) if stream]
+    if os.name == 'nt':
+        # pipes can't be used with select on windows
+        for line in iter(streams[0].readline, ''):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', errors="replace")
+            yield line.rstrip('\r\n')
+        return
+    selector = selectors.DefaultSelector()
+    for stream in streams:
+        selector.register(stream, selectors.EVENT_READ, [codecs.getincrementaldecoder('utf-8')(errors="replace"), ""])
+    try:
+        while selector.get_map():
+            events = selector.select(timeout)
+            if not events:
+                yield None
+                continue
+            for key, __ in events:
+                decoder, rest = key.data
+                # read the pipe directly, the buffered stream object would block until a whole line is there
+                data = os.read(key.fd, 65536)
+                lines = re.split(r'[\r\n]', rest + decoder.decode(data, final=not data))
+                key.data[1] = lines.pop() if data else ""
+                if not data:
+                    selector.unregister(key.fileobj)
+                for line in lines:
+                    if line:
+                        yield line
+    finally:
+        selector.close()
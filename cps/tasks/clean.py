@@ -26,6 +26,9 @@ from cps.services.worker import CalibreTask
 
 
 class TaskClean(CalibreTask):
+    # the temp folder is used by running conversions
+    exclusive = True
+
     def __init__(self, task_message=N_('Delete temp folder contents')):
         super(TaskClean, self).__init__(task_message)
         self.log = logger.create()
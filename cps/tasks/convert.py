@@ -32,7 +32,7 @@ from cps import db, app
 from cps import logger, config
 from cps.subproc_wrapper import process_open
 from flask_babel import gettext as _
-from cps.kobo_sync_status import remove_synced_book
+from cps.kobo_sync_status import remove_synced_book, record_kobo_format
 from cps.ub import init_db_thread
 from cps.file_helper import get_temp_dir
 
@@ -47,6 +47,8 @@ current_milli_time = lambda: int(round(time() * 1000))
 
 
 class TaskConvert(CalibreTask):
+    lane = 'convert'
+
     def __init__(self, file_path, book_id, task_message, settings, ereader_mail, user=None):
         super(TaskConvert, self).__init__(task_message)
         self.worker_thread = None
@@ -56,9 +58,19 @@ class TaskConvert(CalibreTask):
         self.settings = settings
         self.ereader_mail = ereader_mail
         self.user = user
+        # mail server settings are not journaled, they are read again if the task is restored
+        self.journal_args = dict(file_path=file_path, book_id=book_id, task_message=task_message,
+                                 settings={k: v for k, v in settings.items() if not k.startswith('mail_')},
+                                 ereader_mail=ereader_mail, user=user)
 
         self.results = dict()
 
+    @classmethod
+    def from_journal(cls, args):
+        if args['ereader_mail']:
+            args['settings'].update(config.get_mail_settings())
+        return cls(**args)
+
     def run(self, worker_thread):
         df_cover = None
         cur_book = None
@@ -153,6 +165,9 @@ class TaskConvert(CalibreTask):
                     try:
                         local_db.session.merge(new_format)
                         local_db.session.commit()
+                        ub_session = init_db_thread()
+                        record_kobo_format(book_id, self.settings['new_book_format'], ub_session)
+                        ub_session.close()
                     except SQLAlchemyError as e:
                         local_db.session.rollback()
                         log.error("Database error: %s", e)
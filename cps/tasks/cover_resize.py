@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Resizing of cover thumbnails in the worker processes of TaskGenerateCoverThumbnails. The processes are started
+# without the state of the running server, nothing here may depend on the app, the config or the databases.
+
+from io import BytesIO
+from shutil import copyfile, copyfileobj
+
+try:
+    from wand.image import Image
+except (ImportError, RuntimeError) as e:
+    Image = None
+
+
+def get_resize_height(resolution):
+    return int(255 * resolution)
+
+
+def get_resize_width(resolution, original_width, original_height):
+    height = get_resize_height(resolution)
+    percent = (height / float(original_height))
+    width = int((float(original_width) * float(percent)))
+    return width if width % 2 == 0 else width + 1
+
+
+def generate_cover_thumbnail(source, filename, resolution, image_format):
+    """Writes the thumbnail of a cover, given as file path or image content, to filename.
+    Runs in a worker process, so everything needed is passed as arguments"""
+    stream = BytesIO(source) if isinstance(source, bytes) else None
+    try:
+        with Image(file=stream) if stream else Image(filename=source) as img:
+            height = get_resize_height(resolution)
+            if img.height > height or image_format != 'jpeg':
+                if img.height > height:
+                    width = get_resize_width(resolution, img.width, img.height)
+                    img.resize(width=width, height=height, filter='lanczos')
+                img.format = image_format
+                img.save(filename=filename)
+                return
+        # take cover as is
+        if stream:
+            stream.seek(0)
+            with open(filename, 'wb') as fd:
+                copyfileobj(stream, fd)
+        else:
+            copyfile(source, filename)
+    finally:
+        if stream is not None:
+            stream.close()
@@ -23,6 +23,9 @@ from cps.services.worker import CalibreTask
 
 
 class TaskReconnectDatabase(CalibreTask):
+    # the connections of the running tasks are disposed
+    exclusive = True
+
     def __init__(self, task_message=N_('Reconnecting Calibre database')):
         super(TaskReconnectDatabase, self).__init__(task_message)
         self.log = logger.create()
@@ -1,21 +1,74 @@
 import os
 import re
-import requests
-import select
+import json
 import sqlite3
+import threading
 from datetime import datetime
 from flask_babel import lazy_gettext as N_, gettext as _
 
 from cps.constants import XKLB_DB_FILE
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, STAT_FAIL, STAT_STARTED, STAT_WAITING
-from cps.subproc_wrapper import process_open
+from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, STAT_FAIL, STAT_STARTED, STAT_WAITING, \
+    STAT_CANCELLED, STAT_ENDED
+from cps.subproc_wrapper import process_open, process_readlines
 from .. import logger
-from time import sleep
 
 log = logger.create()
 
+# yt-dlp progress lines as printed with --progress-template "download:downloading %(progress)j" (see lb-wrapper),
+# xklb's own progress lines look like "downloading  59.8%    2.29MiB/s"
+PROGRESS_JSON_PREFIX = "downloading {"
+PROGRESS_PERCENT = re.compile(r"^downloading\s+(\d+(?:\.\d+)?)%")
+
+# format requested by lb-wrapper dl (--video with yt-dlp's best format), part of the key of a downloaded media file
+MEDIA_FORMAT = "video"
+
+
+def parse_progress(line):
+    """Returns the progress of the download reported by the line, None if the line is no progress line"""
+    if line.startswith(PROGRESS_JSON_PREFIX):
+        try:
+            status = json.loads(line[len("downloading "):])
+        except ValueError:
+            return None
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        downloaded = status.get("downloaded_bytes")
+        return dict(fraction=downloaded / total if downloaded is not None and total else None,
+                    finished=status.get("status") == "finished",
+                    downloaded_bytes=downloaded,
+                    total_bytes=total,
+                    speed=status.get("speed"),
+                    eta=status.get("eta"))
+    match = PROGRESS_PERCENT.match(line)
+    if match:
+        percentage = float(match.group(1))
+        return dict(fraction=percentage / 100, finished=percentage >= 100)
+    return None
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def format_transfer(transfer):
+    parts = []
+    if transfer["downloaded_bytes"] is not None:
+        parts.append(format_bytes(transfer["downloaded_bytes"]) +
+                     (" / " + format_bytes(transfer["total_bytes"]) if transfer["total_bytes"] else ""))
+    if transfer["speed"]:
+        parts.append(format_bytes(transfer["speed"]) + "/s")
+    if transfer["eta"] is not None:
+        parts.append("ETA " + datetime.utcfromtimestamp(int(transfer["eta"])).strftime("%H:%M:%S"))
+    return "<br>" + ", ".join(parts) if parts else ""
+
 class TaskDownload(CalibreTask):
-    def __init__(self, task_message, media_url, original_url, current_user_name, shelf_id, duration, live_status):
+    lane = 'download'
+
+    def __init__(self, task_message, media_url, original_url, current_user_name, shelf_id, duration, live_status,
+                 extractor_id=None):
         super(TaskDownload, self).__init__(task_message)
         self.message = task_message
         self.media_url = media_url
@@ -25,9 +78,22 @@ class TaskDownload(CalibreTask):
         self.shelf_id = shelf_id
         self.duration = datetime.utcfromtimestamp(int(duration)).strftime("%H:%M:%S") if duration else "unknown"
         self.live_status = live_status
+        self.journal_args = dict(task_message=task_message, media_url=media_url, original_url=original_url,
+                                 current_user_name=current_user_name, shelf_id=shelf_id, duration=duration,
+                                 live_status=live_status, extractor_id=extractor_id)
+        self.extractor_id = extractor_id if extractor_id is not None else self.read_extractor_id()
+        if self.extractor_id:
+            # the same video requested twice (several playlists, retries) is never downloaded at the same time
+            self.resource = self.download_key
+        # shelves of further requests of the same video, coalesced into this task while it's not imported yet
+        self._shelves_lock = threading.Lock()
+        self.extra_shelf_ids = list()
+        self.ingested = False
         self.start_time = self.end_time = datetime.now()
         self.stat = STAT_WAITING
         self.progress = 0
+        # bytes downloaded, total size, speed (bytes/s) and eta (s) of the file currently downloaded
+        self.transfer = dict(downloaded_bytes=None, total_bytes=None, speed=None, eta=None)
 
     def run(self, worker_thread):
         """Run the download task"""
@@ -36,9 +102,13 @@ class TaskDownload(CalibreTask):
         self.stat = STAT_STARTED
         self.progress = 0
 
+        # cps.media_ingest imports cps.editbooks which imports this module
+        from cps import media_ingest
         lb_executable = os.getenv("LB_WRAPPER", "lb-wrapper")
 
         if self.media_url:
+            if self.import_existing_download(media_ingest):
+                return
             subprocess_args = [lb_executable, "dl", self.media_url]
             log.info("Subprocess args: %s", subprocess_args)
 
@@ -48,10 +118,10 @@ class TaskDownload(CalibreTask):
 
                 # Define the patterns for the subprocess output
                 # Equivalent Regex's: https://github.com/iiab/calibre-web/blob/8684ffb491244e15ab927dfb390114240e483eb3/scripts/lb-wrapper#L59-L60
-                pattern_progress = r"^downloading"
-                pattern_success = r"\[{}\]:".format(self.media_url)
+                pattern_success = "[{}]:".format(self.media_url)
 
                 complete_progress_cycle = 0
+                finished = False
 
                 last_progress_time = datetime.now()
                 timeout = 120  # seconds
@@ -59,30 +129,41 @@ class TaskDownload(CalibreTask):
                 self.message = f"Downloading {self.media_url_link}..."
                 if self.live_status == "was_live":
                     self.message += f" (formerly live video, length/duration {self.duration})"
-                while p.poll() is None:
+                download_message = self.message
+                # all output is read until the process ends, it would block on a full pipe otherwise
+                for line in process_readlines(p, timeout=1, streams=[p.stdout, p.stderr]):
                     self.end_time = datetime.now()
-                    # Check if there's data available to read
-                    rlist, _, _ = select.select([p.stdout], [], [], 0.1)
-                    if rlist:
-                        line = p.stdout.readline()
-                        if line:
-                            if re.search(pattern_success, line) or complete_progress_cycle == 4:
-                                # 2024-01-10: 99% (a bit arbitrary) is explained here...
-                                # https://github.com/iiab/calibre-web/pull/88#issuecomment-1885916421
-                                self.progress = 0.99
-                                break
-                            elif re.search(pattern_progress, line):
-                                percentage = int(re.search(r'\d+', line).group())
-                                if percentage < 100:
-                                    self.progress = min(0.99, (complete_progress_cycle + (percentage / 100)) / 4)
-                                if percentage == 100:
-                                    complete_progress_cycle += 1
-                                    last_progress_time = datetime.now()
-                    else:
+                    if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                        # nothing is imported, the download is resumed from the partial file if it's requested again
+                        p.terminate()
+                        p.wait()
+                        log.info("Download of %s cancelled", self.media_url)
+                        return
+                    if line is None:
                         elapsed_time = (datetime.now() - last_progress_time).total_seconds()
-                        if elapsed_time >= timeout:
+                        if not finished and elapsed_time >= timeout:
                             self.message = f"{self.media_url_link} is taking longer than expected. It could be a stuck download due to unavailable fragments (<a href='https://github.com/yt-dlp/yt-dlp/issues/2137' target='_blank'>yt-dlp/yt-dlp#2137</a>) and/or an error in xklb's media_check. Please wait as we keep trying. See <a href='https://github.com/iiab/calibre-web/pull/223' target='_blank'>#223</a> for more info."
-                    sleep(0.1)
+                        continue
+                    if finished:
+                        continue
+                    if pattern_success in line or complete_progress_cycle == 4:
+                        # 2024-01-10: 99% (a bit arbitrary) is explained here...
+                        # https://github.com/iiab/calibre-web/pull/88#issuecomment-1885916421
+                        self.progress = 0.99
+                        finished = True
+                        continue
+                    progress = parse_progress(line)
+                    if progress is None:
+                        continue
+                    last_progress_time = datetime.now()
+                    fraction, file_finished = progress.pop("fraction"), progress.pop("finished")
+                    self.transfer.update(progress)
+                    if file_finished:
+                        # video, audio, subtitles and thumbnail are downloaded one after the other
+                        complete_progress_cycle += 1
+                    elif fraction is not None:
+                        self.progress = min(0.99, (complete_progress_cycle + fraction) / 4)
+                    self.message = download_message + format_transfer(self.transfer)
 
                 p.wait()
 
@@ -110,20 +191,34 @@ class TaskDownload(CalibreTask):
                         self.message = f"{self.media_url_link} failed to download: {db_error}"
 
                     self.message = self.message + "\n" + f"Almost done..."
-                    response = requests.get(self.original_url, params={"requested_file": requested_file, "current_user_name": self.current_user_name, "shelf_id": self.shelf_id})
-                    if response.status_code == 200:
-                        log.info("Successfully sent the requested file to %s", self.original_url)
-                        file_downloaded = response.json()["file_downloaded"]
+                    with self._shelves_lock:
+                        self.ingested = True
+                    base_url = media_ingest.server_url(self.original_url)
+                    try:
+                        response = media_ingest.import_media_file(requested_file, self.current_user_name,
+                                                                  self.shelf_id, base_url=base_url)
+                    except Exception as e:
+                        log.error_or_exception(e)
+                        response = None
+                    if response is not None:
+                        if self.extra_shelf_ids:
+                            media_ingest.add_to_shelves(response["book_id"], self.extra_shelf_ids, base_url=base_url)
+                        log.info("Successfully imported the requested file %s", requested_file)
+                        file_downloaded = response["file_downloaded"]
                         self.message = f"Successfully downloaded {self.media_url_link} to <br><br>{file_downloaded}"
-                        new_video_path = response.json()["new_book_path"]
+                        new_video_path = response["new_book_path"]
                         new_video_path = next((os.path.join(new_video_path, file) for file in os.listdir(new_video_path) if file.endswith((".webm", ".mp4"))), None)
                         # 2024-02-17: Dedup Design Evolving... https://github.com/iiab/calibre-web/pull/125
                         conn.execute("UPDATE media SET path = ? WHERE webpath = ?", (new_video_path, self.media_url))
                         conn.execute("UPDATE media SET webpath = ? WHERE path = ?", (f"{self.media_url}&timestamp={int(datetime.now().timestamp())}", new_video_path))
                         self.progress = 1.0
                     else:
-                        log.error("Failed to send the requested file to %s", self.original_url)
-                        self.message = f"{self.media_url_link} failed to download: {response.status_code} {response.reason}"
+                        log.error("Failed to import the requested file %s", requested_file)
+                        self.message = f"{self.media_url_link} failed to download: the file could not be added to the library"
+                        if self.extra_shelf_ids:
+                            # the requests of these shelves were coalesced into this task, they don't get the video either
+                            log.error("%s is missing on the shelves %s as well", self.media_url, self.extra_shelf_ids)
+                            self.message += f"<br><br>It was requested for {len(self.extra_shelf_ids)} more shelves, please request it again."
 
                 conn.close()
 
@@ -133,7 +228,9 @@ class TaskDownload(CalibreTask):
 
             finally:
                 self.end_time = datetime.now()
-                if p.returncode == 0 or self.progress == 1.0:
+                if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                    pass
+                elif p.returncode == 0 or self.progress == 1.0:
                     self.stat = STAT_FINISH_SUCCESS
                     log.info("Download task for %s completed successfully", self.media_url)
                 else:
@@ -142,6 +239,61 @@ class TaskDownload(CalibreTask):
         else:
             log.info("No media URL provided - skipping download task")
 
+    @property
+    def download_key(self):
+        """Key of the downloaded file, the same video in the same format is downloaded only once"""
+        return f"media:{self.extractor_id}:{MEDIA_FORMAT}" if self.extractor_id else None
+
+    def add_shelf(self, shelf_id):
+        """Adds the video to one more shelf once it's imported, False if it's too late (already imported)"""
+        with self._shelves_lock:
+            if self.ingested:
+                return False
+            if shelf_id != self.shelf_id and shelf_id not in self.extra_shelf_ids:
+                self.extra_shelf_ids.append(shelf_id)
+            return True
+
+    def read_extractor_id(self):
+        """Read the id of the video on its site from the database"""
+        try:
+            with sqlite3.connect(XKLB_DB_FILE) as conn:
+                row = conn.execute("SELECT extractor_id FROM media WHERE path = ?", (self.media_url,)).fetchone()
+            conn.close()
+        except sqlite3.Error as db_error:
+            log.error("An error occurred while trying to connect to the database: %s", db_error)
+            return None
+        return row[0] if row else None
+
+    def import_existing_download(self, media_ingest):
+        """Skips the download if the video was already downloaded and imported into the library
+        (requested by another playlist), the book is added to the shelf instead"""
+        if not self.extractor_id:
+            return False
+        try:
+            with sqlite3.connect(XKLB_DB_FILE) as conn:
+                paths = [row[0] for row in conn.execute(
+                    "SELECT path FROM media WHERE extractor_id = ? AND path NOT LIKE 'http%'", (self.extractor_id,))]
+            conn.close()
+        except sqlite3.Error as db_error:
+            log.error("An error occurred while trying to connect to the database: %s", db_error)
+            return False
+        with self._shelves_lock:
+            self.ingested = True
+            shelf_ids = [self.shelf_id] + self.extra_shelf_ids
+        base_url = media_ingest.server_url(self.original_url)
+        for path in paths:
+            response = media_ingest.find_ingested_book(path, shelf_ids, base_url=base_url)
+            if response is not None:
+                log.info("%s is already part of the library, skipping the download", self.media_url)
+                self.message = f"{self.media_url_link} is already in the library: <br><br>{response['file_downloaded']}"
+                self.progress = 1.0
+                self.end_time = datetime.now()
+                self.stat = STAT_FINISH_SUCCESS
+                return True
+        with self._shelves_lock:
+            self.ingested = False
+        return False
+
     def read_error_from_database(self):
         """Read the error from the database"""
         with sqlite3.connect(XKLB_DB_FILE) as conn:
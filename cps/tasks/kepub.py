@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from flask_babel import lazy_gettext as N_
+
+from cps import config, db, logger, app
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, PRIORITY_LOW
+
+
+class TaskGenerateKepubs(CalibreTask):
+    """Converts EPUB books without KEPUB format with kepubify ahead of the Kobo sync,
+    finished books are synced again with the new format"""
+    lane = 'convert'
+    priority = PRIORITY_LOW
+    resource = 'kepubs'
+
+    def __init__(self, book_ids=None, task_message=N_('Generating kepub files')):
+        super(TaskGenerateKepubs, self).__init__(task_message)
+        self.log = logger.create()
+        self.book_ids = book_ids
+        self.journal_args = dict(book_ids=book_ids)
+
+    def run(self, worker_thread):
+        # cps.tasks.convert imports cps.helper which imports this module
+        from cps.tasks.convert import TaskConvert
+        if not config.config_kepubifypath:
+            self._handleSuccess()
+            return
+        if config.config_use_google_drive:
+            self.log.info('Generating kepub files is not supported for books stored on Google Drive')
+            self._handleSuccess()
+            return
+        with app.app_context():
+            calibre_db = db.CalibreDB(app)
+            if not calibre_db.session:
+                self._handleError('Calibre database is not configured')
+                return
+            books = self.get_books_without_kepub(calibre_db)
+            calibre_db.session.close()
+
+        failed = 0
+        for index, (book_id, book_path, name) in enumerate(books):
+            if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                self.log.info('Generating kepub files has been stopped, it will be continued on next run')
+                return
+            converter = TaskConvert(os.path.join(config.get_book_path(), book_path, name), book_id, "",
+                                    {'old_book_format': 'EPUB', 'new_book_format': 'KEPUB'}, None)
+            if not converter._convert_ebook_format():
+                failed += 1
+                self.log.error("Generating kepub file for book id %d failed: %s", book_id, converter.error)
+            self.progress = (1.0 / len(books)) * (index + 1)
+        if failed:
+            self.log.info("Generating kepub files failed for %d of %d books", failed, len(books))
+        self._handleSuccess()
+
+    def get_books_without_kepub(self, calibre_db):
+        query = (calibre_db.session.query(db.Books.id, db.Books.path, db.Data.name)
+                 .join(db.Data)
+                 .filter(db.Data.format == 'EPUB')
+                 .filter(~db.Books.data.any(db.Data.format == 'KEPUB')))
+        if self.book_ids:
+            query = query.filter(db.Books.id.in_(self.book_ids))
+        return query.order_by(db.Books.id).all()
+
+    @property
+    def name(self):
+        return N_('Convert')
+
+    def __str__(self):
+        if self.book_ids:
+            return "Generate kepub files for books {}".format(self.book_ids)
+        return "Generate kepub files"
+
+    @property
+    def is_cancellable(self):
+        return True
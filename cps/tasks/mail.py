@@ -29,7 +29,7 @@ from email.utils import formatdate, parseaddr, make_msgid
 from email.generator import Generator
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_HIGH
 from cps.services import gmail
 from cps.embed_helper import do_calibre_export
 from cps import logger, config
@@ -110,6 +110,9 @@ class EmailSSL(EmailBase, smtplib.SMTP_SSL):
 
 
 class TaskEmail(CalibreTask):
+    lane = 'mail'
+    priority = PRIORITY_HIGH
+
     def __init__(self, subject, filepath, attachment, settings, recipient, task_message, text, id=0, internal=False):
         super(TaskEmail, self).__init__(task_message)
         self.subject = subject
@@ -121,6 +124,14 @@ class TaskEmail(CalibreTask):
         self.asyncSMTP = None
         self.book_id = id
         self.results = dict()
+        # only books sent to eReaders are journaled, other mails may contain passwords
+        if filepath:
+            self.journal_args = dict(subject=subject, filepath=filepath, attachment=attachment, recipient=recipient,
+                                     task_message=task_message, text=text, id=id, internal=internal)
+
+    @classmethod
+    def from_journal(cls, args):
+        return cls(settings=config.get_mail_settings(), **args)
 
     # from calibre code:
     # https://github.com/kovidgoyal/calibre/blob/731ccd92a99868de3e2738f65949f19768d9104c/src/calibre/utils/smtp.py#L60
@@ -1,20 +1,25 @@
 import os
 import re
-import requests
+import json
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 from datetime import datetime
 from flask_babel import lazy_gettext as N_, gettext as _
 
-from cps.constants import XKLB_DB_FILE, MAX_VIDEOS_PER_DOWNLOAD
+from cps.constants import XKLB_DB_FILE, MAX_VIDEOS_PER_DOWNLOAD, METADATA_FETCH_WORKERS, METADATA_FETCH_RETRIES
 from cps.services.worker import WorkerThread
 from cps.tasks.download import TaskDownload
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, STAT_FAIL, STAT_STARTED, STAT_WAITING
-from cps.subproc_wrapper import process_open
+from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, STAT_FAIL, STAT_STARTED, STAT_WAITING, \
+    STAT_CANCELLED, STAT_ENDED
+from cps.subproc_wrapper import process_open, process_readlines
 from .. import logger
 
 log = logger.create()
 
 class TaskMetadataExtract(CalibreTask):
+    lane = 'metadata'
+
     def __init__(self, task_message, media_url, original_url, current_user_name):
         super(TaskMetadataExtract, self).__init__(task_message)
         self.message = task_message
@@ -23,6 +28,8 @@ class TaskMetadataExtract(CalibreTask):
         self.original_url = self._format_original_url(original_url)
         self.is_playlist = None
         self.current_user_name = current_user_name
+        self.journal_args = dict(task_message=task_message, media_url=media_url, original_url=original_url,
+                                 current_user_name=current_user_name)
         self.start_time = self.end_time = datetime.now()
         self.stat = STAT_WAITING
         self.progress = 0
@@ -67,12 +74,13 @@ class TaskMetadataExtract(CalibreTask):
                 conn.execute("ALTER TABLE media ADD COLUMN live_status TEXT")
             if "error" not in self.columns:
                 conn.execute("ALTER TABLE media ADD COLUMN error TEXT")
-            query = "SELECT path, duration, live_status FROM media WHERE path LIKE 'http%' AND (error IS NULL OR error = '')"
+            query = "SELECT path, duration, live_status, extractor_id FROM media WHERE path LIKE 'http%' AND (error IS NULL OR error = '')"
             rows = conn.execute(query).fetchall()
             requested_urls = {}
-            for path, duration, live_status in rows:
+            for path, duration, live_status, extractor_id in rows:
                 if duration is not None and duration > 0:
-                    requested_urls[path] = {"duration": duration, "live_status": live_status}
+                    requested_urls[path] = {"duration": duration, "live_status": live_status,
+                                            "extractor_id": extractor_id}
                 else:
                     self.unavailable.append(path)
             return requested_urls
@@ -82,56 +90,112 @@ class TaskMetadataExtract(CalibreTask):
             return {}
 
     def _send_shelf_title(self):
+        # cps.media_ingest imports cps.editbooks which imports this module
+        from cps import media_ingest
         try:
-            response = requests.get(self.original_url, params={"current_user_name": self.current_user_name, "shelf_title": self.shelf_title})
-            if response.status_code == 200:
-                self.shelf_id = response.json()["shelf_id"]
-                self.shelf_title = response.json()["shelf_title"]
-            else:
-                log.error("Received unexpected status code %s while sending the shelf title to %s", response.status_code, self.original_url)
+            response = media_ingest.create_shelf(self.shelf_title, self.current_user_name,
+                                                 base_url=media_ingest.server_url(self.original_url))
+            self.shelf_id = response["shelf_id"]
+            self.shelf_title = response["shelf_title"]
         except Exception as e:
-            log.error("An error occurred during the shelf title sending: %s", e)
-
-    def _update_metadata(self, requested_urls):
-        failed_urls = []
-        subprocess_args_list = [[os.getenv("LB_WRAPPER", "lb-wrapper"), "tubeadd", requested_url] for requested_url in requested_urls.keys()]
+            log.error("An error occurred during the shelf creation: %s", e)
 
-        for index, subprocess_args in enumerate(subprocess_args_list):
+    @staticmethod
+    def _refresh_metadata(requested_url):
+        """Runs tubeadd for one video, returns None on success and the error otherwise.
+        Runs in the threads of _update_metadata, so it must not change the task"""
+        for attempt in range(METADATA_FETCH_RETRIES + 1):
             try:
-                p = self._execute_subprocess(subprocess_args)
-                if p is not None:
-                    self.progress = (index + 1) / len(subprocess_args_list)
-                else:
-                    failed_urls.append(subprocess_args[2])
+                p = process_open([os.getenv("LB_WRAPPER", "lb-wrapper"), "tubeadd", requested_url], newlines=True)
+                output = [line for line in process_readlines(p, streams=[p.stdout, p.stderr]) if line]
                 p.wait()
             except Exception as e:
-                log.error("An error occurred during updating the metadata of %s: %s", subprocess_args[2], e)
-                self.message = f"{subprocess_args[2]} failed: {e}"
-                failed_urls.append(subprocess_args[2])
+                return str(e)
+            if p.returncode == 0:
+                return None
+            # the concurrent tubeadd calls write to the same xklb database
+            if not any("database is locked" in line for line in output):
+                return output[-1] if output else f"tubeadd exited with {p.returncode}"
+            time.sleep(attempt + 1)
+        return "database is locked"
 
-        requested_urls = {url: requested_urls[url] for url in requested_urls.keys() if "shorts" not in url and url not in failed_urls}
+    def _update_metadata(self, requested_urls):
+        """Refreshes the metadata of the videos, returns the requested urls without shorts and failed urls"""
+        failed_urls = []
+        urls = list(requested_urls.keys())
 
-    def _calculate_views_per_day(self, requested_urls, conn):
-        now = datetime.now()
-        for requested_url in requested_urls.keys():
-            try:
-                view_count = conn.execute("SELECT view_count FROM media WHERE path = ?", (requested_url,)).fetchone()[0]
-                time_uploaded = datetime.utcfromtimestamp(conn.execute("SELECT time_uploaded FROM media WHERE path = ?", (requested_url,)).fetchone()[0])
-                days_since_publish = (now - time_uploaded).days or 1
-                requested_urls[requested_url]["views_per_day"] = view_count / days_since_publish
-            except Exception as e:
-                log.error("An error occurred during the calculation of views per day for %s: %s", requested_url, e)
-                self.message = f"{requested_url} failed: {e}"
+        # every tubeadd call waits for the network, run up to METADATA_FETCH_WORKERS of them at the same time
+        with ThreadPoolExecutor(max_workers=max(1, METADATA_FETCH_WORKERS)) as executor:
+            futures = {executor.submit(self._refresh_metadata, url): url for url in urls}
+            for index, future in enumerate(as_completed(futures)):
+                url = futures[future]
+                try:
+                    error = future.result()
+                except CancelledError:
+                    continue
+                if error:
+                    log.error("An error occurred during updating the metadata of %s: %s", url, error)
+                    self.message = f"{url} failed: {error}"
+                    failed_urls.append(url)
+                self.progress = (index + 1) / len(urls)
+                if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                    for pending in futures:
+                        pending.cancel()
 
-    def _sort_and_limit_requested_urls(self, requested_urls):
-        return dict(sorted(requested_urls.items(), key=lambda item: item[1]["views_per_day"], reverse=True)[:min(MAX_VIDEOS_PER_DOWNLOAD, len(requested_urls))])
+        return {url: requested_urls[url] for url in requested_urls.keys() if "shorts" not in url and url not in failed_urls}
+
+    def _create_indexes(self, conn):
+        # media is filtered by path, webpath and extractor_id here, in TaskDownload and in uploader.video_metadata
+        try:
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_path ON media (path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_webpath ON media (webpath)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_extractor_id ON media (extractor_id)")
+            conn.commit()
+        except sqlite3.Error as db_error:
+            log.error("An error occurred while creating the indexes of the media table: %s", db_error)
+
+    def _rank_requested_urls(self, requested_urls, conn):
+        """Returns the MAX_VIDEOS_PER_DOWNLOAD requested urls with the most views per day, most viewed first"""
+        try:
+            rows = conn.execute("SELECT path, CAST(view_count AS REAL) / "
+                                "MAX(CAST((strftime('%s', 'now') - time_uploaded) / 86400 AS INTEGER), 1) "
+                                "AS views_per_day FROM media "
+                                "WHERE path IN (SELECT value FROM json_each(?)) "
+                                "ORDER BY views_per_day DESC LIMIT ?",
+                                (json.dumps(list(requested_urls.keys())), MAX_VIDEOS_PER_DOWNLOAD)).fetchall()
+        except sqlite3.Error as e:
+            log.error("An error occurred during the calculation of views per day: %s", e)
+            self.message = f"{self.media_url_link} failed: {e}"
+            return dict(list(requested_urls.items())[:MAX_VIDEOS_PER_DOWNLOAD])
+        ranked_urls = {}
+        for path, views_per_day in rows:
+            ranked_urls[path] = requested_urls[path]
+            ranked_urls[path]["views_per_day"] = views_per_day
+        return ranked_urls
+
+    def _find_queued_download(self, download_key):
+        """Returns the waiting or running download task of the same video, None if there is none"""
+        if download_key is None:
+            return None
+        for queued_task in WorkerThread.get_instance().tasks:
+            task = queued_task.task
+            if isinstance(task, TaskDownload) and task.stat in (STAT_WAITING, STAT_STARTED) \
+                    and task.download_key == download_key:
+                return task
+        return None
 
     def _add_download_tasks_to_worker(self, requested_urls):
         for index, (requested_url, url_data) in enumerate(requested_urls.items()):
             task_download = TaskDownload(_("Downloading %(url)s...", url=requested_url),
                                          requested_url, self.original_url,
-                                         self.current_user_name, self.shelf_id, duration=str(url_data["duration"]), live_status=url_data["live_status"])
-            WorkerThread.add(self.current_user_name, task_download)
+                                         self.current_user_name, self.shelf_id, duration=str(url_data["duration"]), live_status=url_data["live_status"],
+                                         extractor_id=url_data.get("extractor_id"))
+            queued_download = self._find_queued_download(task_download.download_key)
+            if queued_download is not None and queued_download.add_shelf(self.shelf_id):
+                # the video is already being downloaded for another request, it's added to this shelf afterwards
+                log.info("%s is already queued for download, skipping", requested_url)
+            else:
+                WorkerThread.add(self.current_user_name, task_download)
             num_requested_urls = len(requested_urls)
             total_duration = sum(url_data["duration"] for url_data in requested_urls.values())
             self.message = self.media_url_link + f"<br><br>" \
@@ -166,6 +230,7 @@ class TaskMetadataExtract(CalibreTask):
             return
 
         with sqlite3.connect(XKLB_DB_FILE) as conn:
+            self._create_indexes(conn)
             self._remove_shorts_from_db(conn)
             requested_urls = self._fetch_requested_urls(conn)
             if not requested_urls:
@@ -182,9 +247,11 @@ class TaskMetadataExtract(CalibreTask):
 
             elif self.is_playlist:
                 self._send_shelf_title()
-                self._update_metadata(requested_urls)
-                self._calculate_views_per_day(requested_urls, conn)
-                requested_urls = self._sort_and_limit_requested_urls(requested_urls)
+                requested_urls = self._update_metadata(requested_urls)
+                if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                    log.info("Metadata fetch for %s cancelled", self.media_url)
+                    return
+                requested_urls = self._rank_requested_urls(requested_urls, conn)
                 conn.execute("UPDATE playlists SET path = ? WHERE path = ?", (f"{self.media_url}&timestamp={int(datetime.now().timestamp())}", self.media_url))
             else:
                 try:
@@ -198,8 +265,10 @@ class TaskMetadataExtract(CalibreTask):
             self._add_download_tasks_to_worker(requested_urls)
         conn.close()
 
-        self.progress = 1.0
-        self.stat = STAT_FINISH_SUCCESS
+        # the task may have failed or been ended by the user meanwhile
+        if self.stat == STAT_STARTED:
+            self.progress = 1.0
+            self.stat = STAT_FINISH_SUCCESS
 
     @property
     def name(self):
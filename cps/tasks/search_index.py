@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+
+from cps import config, db, logger, app, search_index
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, PRIORITY_LOW
+
+
+class TaskUpdateSearchIndex(CalibreTask):
+    priority = PRIORITY_LOW
+
+    def __init__(self, book_ids=None, task_message=N_('Updating search index')):
+        super(TaskUpdateSearchIndex, self).__init__(task_message)
+        self.log = logger.create()
+        self.book_ids = book_ids
+
+    def run(self, worker_thread):
+        with app.app_context():
+            calibre_db = db.CalibreDB(app)
+            if not calibre_db.session:
+                self._handleError('Calibre database is not configured')
+                return
+            cc = [c for c in calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+                  if c.datatype in search_index.CC_TEXT_TYPES]
+            try:
+                for progress in search_index.update_index(calibre_db.session, cc, self.book_ids):
+                    self.progress = progress
+                    if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                        self.log.info('Search index update has been stopped, it will be continued on next run')
+                        return
+            except Exception as ex:
+                calibre_db.session.rollback()
+                self.log.error_or_exception(ex)
+                self._handleError('Error updating search index: ' + str(ex))
+                return
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return N_('Search Index')
+
+    def __str__(self):
+        if self.book_ids:
+            return "Update search index for books {}".format(self.book_ids)
+        return "Update search index"
+
+    @property
+    def is_cancellable(self):
+        return True
@@ -17,33 +17,31 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from shutil import copyfile, copyfileobj
+import multiprocessing
 from urllib.request import urlopen
-from io import BytesIO
 from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from .. import constants
-from cps import config, db, fs, gdriveutils, logger, ub, app
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from .cover_resize import get_resize_height, get_resize_width, generate_cover_thumbnail
+from cps import config, db, fs, gdriveutils, logger, ub, app, cover_cache
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, PRIORITY_LOW
 from sqlalchemy import func, text, or_
 from flask_babel import lazy_gettext as N_
 
 try:
     from wand.image import Image
+    from wand.version import formats as wand_formats
     use_IM = True
 except (ImportError, RuntimeError) as e:
     use_IM = False
 
+# number of books whose thumbnails are stored with one commit
+THUMBNAIL_BATCH_SIZE = 100
 
-def get_resize_height(resolution):
-    return int(255 * resolution)
-
-
-def get_resize_width(resolution, original_width, original_height):
-    height = get_resize_height(resolution)
-    percent = (height / float(original_height))
-    width = int((float(original_width) * float(percent)))
-    return width if width % 2 == 0 else width + 1
+# forking the multithreaded server could copy locks held by other threads into the worker processes,
+# they are started from a fresh process instead
+PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
 
 
 def get_best_fit(width, height, image_width, image_height):
@@ -64,7 +62,27 @@ def get_best_fit(width, height, image_width, image_height):
     return {'width': resize_width, 'height': resize_height}
 
 
+def get_thumbnail_formats():
+    """Returns the configured cover thumbnail formats ImageMagick is able to write"""
+    formats = list()
+    for image_format in constants.COVER_THUMBNAIL_FORMATS:
+        if image_format == 'jpeg' or (use_IM and wand_formats(image_format.upper())):
+            formats.append(image_format)
+    return formats
+
+
+def cover_tasks_conflict(task, other):
+    # cover thumbnail tasks for different books can run concurrently, tasks for all books (book_id <= 0) can't
+    if task.resource != other.resource:
+        return False
+    return task.book_id <= 0 or other.book_id <= 0 or task.book_id == other.book_id
+
+
 class TaskGenerateCoverThumbnails(CalibreTask):
+    lane = 'thumbnail'
+    priority = PRIORITY_LOW
+    resource = 'cover_thumbnails'
+
     def __init__(self, book_id=-1, task_message=''):
         super(TaskGenerateCoverThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -74,8 +92,10 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         self.resolutions = [
             constants.COVER_THUMBNAIL_SMALL,
             constants.COVER_THUMBNAIL_MEDIUM,
+            constants.COVER_THUMBNAIL_MEDIUM_LARGE,
             constants.COVER_THUMBNAIL_LARGE
         ]
+        self.formats = get_thumbnail_formats()
 
     def run(self, worker_thread):
         if use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
@@ -83,27 +103,37 @@ class TaskGenerateCoverThumbnails(CalibreTask):
             books_with_covers = self.get_books_with_covers(self.book_id)
             count = len(books_with_covers)
 
+            # resize covers in worker processes, unless there is only a single book or a single core
+            workers = min(os.cpu_count() or 1, count)
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context(PROCESS_START_METHOD)) \
+                if workers > 1 else None
             total_generated = 0
-            for i, book in enumerate(books_with_covers):
+            try:
+                for start in range(0, count, THUMBNAIL_BATCH_SIZE):
+                    books = books_with_covers[start:start + THUMBNAIL_BATCH_SIZE]
 
-                # Generate new thumbnails for missing covers
-                generated = self.create_book_cover_thumbnails(book)
+                    # Generate new thumbnails for missing covers
+                    generated = self.create_book_cover_thumbnails(books, executor)
 
-                # Increment the progress
-                self.progress = (1.0 / count) * i
+                    # Increment the progress
+                    self.progress = (1.0 / count) * (start + len(books))
 
-                if generated > 0:
-                    total_generated += generated
-                    self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+                    if generated > 0:
+                        total_generated += generated
+                        self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
 
-                # Check if job has been cancelled or ended
-                if self.stat == STAT_CANCELLED:
-                    self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
-                    return
+                    # Check if job has been cancelled or ended
+                    if self.stat == STAT_CANCELLED:
+                        self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
+                        return
 
-                if self.stat == STAT_ENDED:
-                    self.log.info(f'GenerateCoverThumbnails task has been ended.')
-                    return
+                    if self.stat == STAT_ENDED:
+                        self.log.info(f'GenerateCoverThumbnails task has been ended.')
+                        return
+            finally:
+                if executor:
+                    executor.shutdown(wait=True)
 
             if total_generated == 0:
                 self.self_cleanup = True
@@ -120,113 +150,107 @@ class TaskGenerateCoverThumbnails(CalibreTask):
             # calibre_db.session.close()
         return books_cover
 
-    def get_book_cover_thumbnails(self, book_id):
-        return self.app_db_session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
-            .filter(ub.Thumbnail.entity_id == book_id) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc))) \
-            .all()
-
-    def create_book_cover_thumbnails(self, book):
-        generated = 0
-        book_cover_thumbnails = self.get_book_cover_thumbnails(book.id)
-
-        # Generate new thumbnails for missing covers
-        resolutions = list(map(lambda t: t.resolution, book_cover_thumbnails))
-        missing_resolutions = list(set(self.resolutions).difference(resolutions))
-        for resolution in missing_resolutions:
-            generated += 1
-            self.create_book_cover_single_thumbnail(book, resolution)
-
-        # Replace outdated or missing thumbnails
-        for thumbnail in book_cover_thumbnails:
-            if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at:
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-
-            elif not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-        return generated
-
-    def create_book_cover_single_thumbnail(self, book, resolution):
-        thumbnail = ub.Thumbnail()
-        thumbnail.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail.entity_id = book.id
-        thumbnail.format = 'jpeg'
-        thumbnail.resolution = resolution
-
-        self.app_db_session.add(thumbnail)
+    def get_book_cover_thumbnails(self, book_ids):
+        thumbnails = dict()
+        for thumbnail in self.app_db_session \
+                .query(ub.Thumbnail) \
+                .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
+                .filter(ub.Thumbnail.entity_id.in_(book_ids)) \
+                .filter(or_(ub.Thumbnail.expiration.is_(None),
+                            ub.Thumbnail.expiration > datetime.now(timezone.utc))) \
+                .all():
+            thumbnails.setdefault(thumbnail.entity_id, list()).append(thumbnail)
+        return thumbnails
+
+    def create_book_cover_thumbnails(self, books, executor=None):
+        book_cover_thumbnails = self.get_book_cover_thumbnails([book.id for book in books])
+        jobs = list()
+        for book in books:
+            thumbnails = book_cover_thumbnails.get(book.id, list())
+
+            # Generate new thumbnails for missing covers
+            variants = list(map(lambda t: (t.resolution, t.format), thumbnails))
+            missing_variants = [(resolution, image_format) for resolution in self.resolutions
+                                for image_format in self.formats if (resolution, image_format) not in variants]
+            for resolution, image_format in missing_variants:
+                thumbnail = ub.Thumbnail()
+                thumbnail.type = constants.THUMBNAIL_TYPE_COVER
+                thumbnail.entity_id = book.id
+                thumbnail.format = image_format
+                thumbnail.resolution = resolution
+                self.app_db_session.add(thumbnail)
+                jobs.append((book, thumbnail))
+
+            # Replace outdated or missing thumbnails
+            for thumbnail in thumbnails:
+                if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at \
+                        or not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
+                    thumbnail.generated_at = datetime.now(timezone.utc)
+                    self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+                    jobs.append((book, thumbnail))
+        if not jobs:
+            return 0
+
+        # all thumbnails of the batch are stored with one commit
         try:
             self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail)
         except Exception as ex:
             self.log.debug('Error creating book thumbnail: ' + str(ex))
             self._handleError('Error creating book thumbnail: ' + str(ex))
             self.app_db_session.rollback()
+            return 0
 
-    def update_book_cover_thumbnail(self, book, thumbnail):
-        thumbnail.generated_at = datetime.now(timezone.utc)
-
-        try:
-            self.app_db_session.commit()
-            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def generate_book_thumbnail(self, book, thumbnail):
-        if book and thumbnail:
-            if config.config_use_google_drive:
-                if not gdriveutils.is_gdrive_ready():
-                    raise Exception('Google Drive is configured but not ready')
-
-                content = gdriveutils.get_cover_via_gdrive(book.path)
-                if not content:
-                    raise Exception('Google Drive cover url not found')
-                try:
-                    stream = BytesIO(content)
-                    with Image(file=stream) as img:
-                        filename = self.cache.get_cache_file_path(thumbnail.filename,
-                                                                  constants.CACHE_TYPE_THUMBNAILS)
-                        height = get_resize_height(thumbnail.resolution)
-                        if img.height > height:
-                            width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                            img.resize(width=width, height=height, filter='lanczos')
-                            img.format = thumbnail.format
-                            img.save(filename=filename)
-                        else:
-                            stream.seek(0)
-                            with open(filename, 'wb') as fd:
-                                copyfileobj(stream, fd)
-
-
-                except Exception as ex:
-                    # Bubble exception to calling function
-                    self.log.debug('Error generating thumbnail file: ' + str(ex))
-                    raise ex
-                finally:
-                    if stream is not None:
-                        stream.close()
-            else:
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
+        generated = 0
+        futures = list()
+        for book, thumbnail in jobs:
+            try:
+                args = (self.get_book_cover_source(book),
+                        self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS),
+                        thumbnail.resolution,
+                        thumbnail.format)
+                if executor:
+                    futures.append(executor.submit(generate_cover_thumbnail, *args))
+                else:
+                    generate_cover_thumbnail(*args)
+                    generated += 1
+            except Exception as ex:
+                self.log.debug('Error generating thumbnail file: ' + str(ex))
+                self._handleError('Error creating book thumbnail: ' + str(ex))
+        for future in as_completed(futures):
+            try:
+                future.result()
+                generated += 1
+            except Exception as ex:
+                self.log.debug('Error generating thumbnail file: ' + str(ex))
+                self._handleError('Error creating book thumbnail: ' + str(ex))
+            # stop waiting for the remaining covers if the job has been cancelled or ended
+            if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                for pending in futures:
+                    pending.cancel()
+                break
+        # covers of these books may have been resolved to the original cover while the thumbnails were missing
+        for book in books:
+            cover_cache.invalidate(book.id)
+        return generated
 
-                with Image(filename=book_cover_filepath) as img:
-                    height = get_resize_height(thumbnail.resolution)
-                    filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-                    if img.height > height:
-                        width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                        img.resize(width=width, height=height, filter='lanczos')
-                        img.format = thumbnail.format
-                        img.save(filename=filename)
-                    else:
-                        # take cover as is
-                        copyfile(book_cover_filepath, filename)
+    @staticmethod
+    def get_book_cover_source(book):
+        """Returns the cover of the book as file path or, for Google Drive, as image content"""
+        if config.config_use_google_drive:
+            if not gdriveutils.is_gdrive_ready():
+                raise Exception('Google Drive is configured but not ready')
+
+            content = gdriveutils.get_cover_via_gdrive(book.path)
+            if not content:
+                raise Exception('Google Drive cover url not found')
+            return content
+        book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+        if not os.path.isfile(book_cover_filepath):
+            raise Exception('Book cover file not found')
+        return book_cover_filepath
+
+    def conflicts_with(self, other):
+        return cover_tasks_conflict(self, other)
 
     @property
     def name(self):
@@ -244,6 +268,10 @@ class TaskGenerateCoverThumbnails(CalibreTask):
 
 
 class TaskGenerateSeriesThumbnails(CalibreTask):
+    lane = 'thumbnail'
+    priority = PRIORITY_LOW
+    resource = 'series_thumbnails'
+
     def __init__(self, task_message=''):
         super(TaskGenerateSeriesThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -456,6 +484,10 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
 
 
 class TaskClearCoverThumbnailCache(CalibreTask):
+    lane = 'thumbnail'
+    priority = PRIORITY_LOW
+    resource = 'cover_thumbnails'
+
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
         super(TaskClearCoverThumbnailCache, self).__init__(task_message)
         self.log = logger.create()
@@ -481,6 +513,7 @@ class TaskClearCoverThumbnailCache(CalibreTask):
             else:
                 for thumbnail in thumbnails:
                     self.delete_thumbnail(thumbnail)
+            cover_cache.invalidate(self.book_id)
         self._handleSuccess()
         self.app_db_session.remove()
 
@@ -513,6 +546,9 @@ class TaskClearCoverThumbnailCache(CalibreTask):
             self.log.debug('Error deleting thumbnail directory: ' + str(ex))
             self._handleError('Error deleting thumbnail directory: ' + str(ex))
 
+    def conflicts_with(self, other):
+        return cover_tasks_conflict(self, other)
+
     @property
     def name(self):
         return N_('Cover Thumbnails')
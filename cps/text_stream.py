@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2024 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Text books are delivered as UTF-8 without loading them into memory.
+# The encoding is detected from the beginning of the file and remembered per (file, modification time), files in
+# other encodings are transcoded chunk by chunk. Range requests are answered from a transcoded copy in the cache
+# directory.
+
+import os
+import codecs
+import glob
+import threading
+from collections import OrderedDict
+
+import chardet  # dependency of requests
+from flask import Response, send_from_directory, stream_with_context
+
+from . import logger, fs
+from .constants import CACHE_TYPE_TEXT
+
+log = logger.create()
+
+DETECT_BYTES = 64 * 1024
+CHUNK_SIZE = 256 * 1024
+ENCODING_CACHE_SIZE = 1000
+
+_encodings = OrderedDict()
+_lock = threading.Lock()
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def detect_encoding(data):
+    encoding = chardet.detect(data)['encoding']
+    if not encoding:
+        return 'utf-8'
+    try:
+        encoding = codecs.lookup(encoding).name
+    except LookupError:
+        return 'utf-8'
+    # a plain ascii beginning says nothing about the rest of the file
+    return 'utf-8' if encoding == 'ascii' else encoding
+
+
+def get_encoding(path):
+    key = _file_key(path)
+    with _lock:
+        encoding = _encodings.get(key)
+        if encoding:
+            _encodings.move_to_end(key)
+            return encoding
+    with open(path, "rb") as f:
+        encoding = detect_encoding(f.read(DETECT_BYTES))
+    with _lock:
+        _encodings[key] = encoding
+        if len(_encodings) > ENCODING_CACHE_SIZE:
+            _encodings.popitem(last=False)
+    return encoding
+
+
+def transcode(chunks, encoding):
+    """Decodes the byte chunks incrementally and yields them as UTF-8"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text.encode('utf-8', 'surrogatepass')
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text.encode('utf-8', 'surrogatepass')
+
+
+def read_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _rendition_name(book_id, path):
+    __, mtime, size = _file_key(path)
+    return "{}-{}-{}.txt".format(book_id, mtime, size)
+
+
+def get_utf8_rendition(book_id, path, encoding):
+    """Returns directory and name of the transcoded copy of the file, it's created if necessary"""
+    cache = fs.FileSystem()
+    filename = _rendition_name(book_id, path)
+    directory = cache.get_cache_file_dir(filename, CACHE_TYPE_TEXT)
+    target = os.path.join(directory, filename)
+    if not os.path.isfile(target):
+        for old in glob.glob(os.path.join(directory, "{}-*.txt".format(book_id))):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        tmp_file = "{}.{}.tmp".format(target, threading.get_ident())
+        with open(tmp_file, "wb") as f:
+            for chunk in transcode(read_chunks(path), encoding):
+                f.write(chunk)
+        os.replace(tmp_file, target)
+    return directory, filename
+
+
+def send_text_file(book_id, directory, filename, range_request=False):
+    path = os.path.join(directory, filename)
+    encoding = get_encoding(path)
+    if encoding == 'utf-8':
+        return send_from_directory(directory, filename, mimetype="text/plain; charset=utf-8")
+    if range_request or os.path.isfile(fs.FileSystem().get_cache_file_path(_rendition_name(book_id, path),
+                                                                            CACHE_TYPE_TEXT)):
+        try:
+            rendition_dir, rendition = get_utf8_rendition(book_id, path, encoding)
+            return send_from_directory(rendition_dir, rendition, mimetype="text/plain; charset=utf-8")
+        except OSError as ex:
+            log.error("Creating UTF-8 copy of text file {} failed: {}".format(book_id, ex))
+    return Response(stream_with_context(transcode(read_chunks(path), encoding)),
+                    mimetype="text/plain; charset=utf-8")
@@ -23,7 +23,13 @@ import sys
 from datetime import datetime, timezone, timedelta
 import itertools
 import uuid
-from flask import session as flask_session
+import json
+import time
+import threading
+from array import array
+from collections import OrderedDict
+from flask import session as flask_session, flash
+from flask_babel import gettext as _
 from binascii import hexlify
 
 from .cw_login import AnonymousUserMixin, current_user
@@ -40,7 +46,7 @@ except ImportError as e:
     except ImportError as e:
         OAuthConsumerMixin = BaseException
         oauth_support = False
-from sqlalchemy import create_engine, exc, exists, event, text, UniqueConstraint
+from sqlalchemy import create_engine, exc, exists, event, inspect, text, UniqueConstraint
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy import String, Integer, SmallInteger, Boolean, DateTime, Float, JSON
 from sqlalchemy.orm.attributes import flag_modified
@@ -61,7 +67,7 @@ log = logger.create()
 session = None
 app_DB_path = None
 Base = declarative_base()
-searched_ids = {}
+searched_ids = None
 
 logged_in = dict()
 
@@ -123,17 +129,106 @@ def check_user_session(user_id, session_key, random):
 
 user_logged_in.connect(signal_store_user_session)
 
+def _store_search_ids(ids):
+    if len(ids) > constants.SEARCH_RESULT_MAX_IDS:
+        ids = ids[:constants.SEARCH_RESULT_MAX_IDS]
+        flash(_("Only the first %(count)d books of the search result can be added to a shelf",
+                count=constants.SEARCH_RESULT_MAX_IDS), category="warning")
+    searched_ids.set(current_user.id, ids)
+
 def store_ids(result):
     ids = list()
     for element in result:
         ids.append(element.id)
-    searched_ids[current_user.id] = ids
+    _store_search_ids(ids)
 
 def store_combo_ids(result):
     ids = list()
     for element in result:
         ids.append(element[0].id)
-    searched_ids[current_user.id] = ids
+    _store_search_ids(ids)
+
+
+class MemorySearchResults:
+    """Keeps the search results of the most recently active users in memory,
+    entries expire after ttl seconds and the least recently used ones are dropped once more than max_users
+    entries or max_ids ids in total are stored"""
+    def __init__(self, ttl=constants.SEARCH_RESULT_TTL, max_users=constants.SEARCH_RESULT_MAX_USERS,
+                 max_ids=constants.SEARCH_RESULT_MAX_IDS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_ids = max_ids
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def set(self, user_id, ids):
+        ids = array('q', ids)
+        with self._lock:
+            self._remove(user_id)
+            if len(ids) > self.max_ids:
+                log.warning("Search result with {} books is truncated to {} books".format(len(ids), self.max_ids))
+                ids = ids[:self.max_ids]
+            self._entries[user_id] = (time.monotonic() + self.ttl, ids)
+            self._size += len(ids)
+            while len(self._entries) > self.max_users or self._size > self.max_ids:
+                self._remove(next(iter(self._entries)))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return list()
+            if entry[0] < time.monotonic():
+                self._remove(user_id)
+                return list()
+            self._entries.move_to_end(user_id)
+            return entry[1].tolist()
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            self._size -= len(entry[1])
+
+
+class SQLiteSearchResults:
+    """Keeps the search results in the search_result table of app.db, shared by all processes using the database"""
+    def __init__(self, ttl=constants.SEARCH_RESULT_TTL):
+        self.ttl = ttl
+        self._session = None
+
+    @property
+    def session(self):
+        if not self._session:
+            self._session = get_new_session_instance()
+        return self._session
+
+    def set(self, user_id, ids):
+        now = int(time.time())
+        try:
+            self.session.query(SearchResult).filter(SearchResult.expiry < now).delete()
+            self.session.merge(SearchResult(user_id=user_id, expiry=now + self.ttl, ids=json.dumps(list(ids))))
+            self.session.commit()
+        except exc.SQLAlchemyError as ex:
+            self.session.rollback()
+            log.error_or_exception("Settings Database error: {}".format(ex))
+
+    def get(self, user_id):
+        try:
+            result = self.session.query(SearchResult).filter(SearchResult.user_id == user_id,
+                                                             SearchResult.expiry >= int(time.time())).first()
+            self.session.commit()
+            return json.loads(result.ids) if result else list()
+        except exc.SQLAlchemyError as ex:
+            self.session.rollback()
+            log.error_or_exception("Settings Database error: {}".format(ex))
+            return list()
+
+
+def create_search_result_store():
+    if constants.SEARCH_RESULT_STORE == "sqlite":
+        return SQLiteSearchResults()
+    return MemorySearchResults()
 
 
 class UserBase:
@@ -358,6 +453,31 @@ class User_Sessions(Base):
         self.expiry = expiry
 
 
+# Ids of the last search of a user, used if the search results are added to a shelf
+class SearchResult(Base):
+    __tablename__ = 'search_result'
+
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    expiry = Column(Integer, index=True)
+    ids = Column(String, default="[]")
+
+
+# Journal of queued background tasks, pending and interrupted tasks are queued again after a restart
+class TaskJournal(Base):
+    __tablename__ = 'task_journal'
+
+    id = Column(Integer, primary_key=True)
+    task_class = Column(String)
+    args = Column(String)
+    user = Column(String)
+    hidden = Column(Boolean, default=False)
+    status = Column(Integer, default=0)
+    progress = Column(Float, default=0)
+    attempts = Column(Integer, default=0)
+    added = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    updated = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
 # Baseclass representing Shelfs in calibre-web in app.db
 class Shelf(Base):
     __tablename__ = 'shelf'
@@ -449,6 +569,27 @@ class KoboSyncedBooks(Base):
     user_id = Column(Integer, ForeignKey('user.id'))
     book_id = Column(Integer)
 
+
+# Change feed for the Kobo sync, every change of a book, its archive bit or its reading state gets a new,
+# never reused sequence number. Changes without user_id concern all users.
+class BookChange(Base):
+    __tablename__ = 'book_change'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    KIND_BOOK = 'book'
+    KIND_ARCHIVE = 'archive'
+    KIND_READING_STATE = 'reading_state'
+    # the restrictions of the user changed (no book_id), the books not synced yet are queued by the next sync
+    KIND_VISIBILITY = 'visibility'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String)
+    book_id = Column(Integer)
+    user_id = Column(Integer, nullable=True)
+    # last_modified of the book in metadata.db for changes found by scanning the library
+    book_modified = Column(String, nullable=True)
+    created = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
 # The Kobo ReadingState API keeps track of 4 timestamped entities:
 #   ReadingState, StatusInfo, Statistics, CurrentBookmark
 # Which we map to the following 4 tables:
@@ -499,6 +640,39 @@ def receive_before_flush(session, flush_context, instances):
     for change in itertools.chain(session.new, session.deleted):
         if isinstance(change, BookShelf):
             change.ub_shelf.last_modified = datetime.now(timezone.utc)
+    record_book_changes(session)
+
+
+# user settings deciding which books the user can see
+VISIBILITY_ATTRIBUTES = ('default_language', 'denied_tags', 'allowed_tags', 'denied_column_value',
+                         'allowed_column_value')
+
+
+def record_book_changes(session):
+    """Appends reading state changes, books added to Kobo synced shelves and changed restrictions of users to
+    the change feed"""
+    changes = set()
+    for change in itertools.chain(session.new, session.dirty):
+        if isinstance(change, (ReadBook, KoboStatistics, KoboBookmark)):
+            change = change.kobo_reading_state
+        if isinstance(change, KoboReadingState) and change.user_id is not None:
+            # a newly created reading state only matters if the book was already marked as read before
+            if change not in session.new or (change.book_read_link and change.book_read_link.read_status):
+                changes.add((BookChange.KIND_READING_STATE, change.book_id, change.user_id))
+        elif isinstance(change, BookShelf) and change in session.new:
+            if change.ub_shelf and change.ub_shelf.kobo_sync:
+                changes.add((BookChange.KIND_BOOK, change.book_id, change.ub_shelf.user_id))
+        elif isinstance(change, Shelf) and change.kobo_sync and change.id is not None:
+            if inspect(change).attrs.kobo_sync.history.has_changes():
+                with session.no_autoflush:
+                    for book in session.query(BookShelf.book_id).filter(BookShelf.shelf == change.id):
+                        changes.add((BookChange.KIND_BOOK, book.book_id, change.user_id))
+        elif isinstance(change, User) and change.id is not None and change not in session.new:
+            state = inspect(change)
+            if any(state.attrs[attribute].history.has_changes() for attribute in VISIBILITY_ATTRIBUTES):
+                changes.add((BookChange.KIND_VISIBILITY, None, change.id))
+    for kind, book_id, user_id in sorted(changes, key=lambda c: (c[0], c[1] or 0, c[2] or 0)):
+        session.add(BookChange(kind=kind, book_id=book_id, user_id=user_id))
 
 
 # Baseclass representing Downloads from calibre-web in app.db
@@ -609,6 +783,12 @@ def add_missing_tables(engine, _session):
         ContentComments.__table__.create(bind=engine)
     if not engine.dialect.has_table(engine.connect(), "content_ratings"):
         ContentRatings.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "search_result"):
+        SearchResult.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "task_journal"):
+        TaskJournal.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "book_change"):
+        BookChange.__table__.create(bind=engine)
 
 
 # migrate all settings missing in registration table
@@ -725,8 +905,10 @@ def init_db(app_db_path):
     # Open session for database connection
     global session
     global app_DB_path
+    global searched_ids
 
     app_DB_path = app_db_path
+    searched_ids = create_search_result_store()
     engine = create_engine('sqlite:///{0}'.format(app_db_path), echo=False)
 
     Session = scoped_session(sessionmaker())
@@ -21,7 +21,6 @@
 import os
 import json
 import mimetypes
-import chardet  # dependency of requests
 import copy
 from importlib.metadata import metadata
 
@@ -41,7 +40,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 from . import constants, logger, isoLanguages, services, limiter
 from . import db, ub, config, app
-from . import calibre_db, kobo_sync_status
+from . import calibre_db, kobo_sync_status, search_index, comic_pages, text_stream
 from .search import render_search_results, render_adv_search_results
 from .gdriveutils import getFileFromEbooksFolder, do_gdrive_download
 from .helper import check_valid_domain, check_email, check_username, \
@@ -247,53 +246,78 @@ def post_rate(book_id):
     return ""
 
 
-'''
-@web.route("/ajax/getcomic/<int:book_id>/<book_format>/<int:page>")
-@user_login_required
-def get_comic_book(book_id, book_format, page):
-    book = calibre_db.get_book(book_id)
+def get_comic_file(book_id, book_format):
+    book_format = book_format.lower()
+    if book_format not in comic_pages.COMIC_FORMATS or config.config_use_google_drive:
+        return None
+    book = calibre_db.get_filtered_book(book_id)
     if not book:
+        return None
+    data = calibre_db.get_book_format(book_id, book_format.upper())
+    if not data:
+        return None
+    comic_file = os.path.join(config.get_book_path(), book.path, data.name + "." + book_format)
+    return comic_file if os.path.isfile(comic_file) else None
+
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_index(book_id, book_format):
+    comic_file = get_comic_file(book_id, book_format)
+    if not comic_file:
         return "", 204
-    else:
-        for bookformat in book.data:
-            if bookformat.format.lower() == book_format.lower():
-                cbr_file = os.path.join(config.config_calibre_dir, book.path, bookformat.name) + "." + book_format
-                if book_format in ("cbr", "rar"):
-                    if feature_support['rar'] == True:
-                        rarfile.UNRAR_TOOL = config.config_rarfile_location
-                        try:
-                            rf = rarfile.RarFile(cbr_file)
-                            names = sort(rf.namelist())
-                            extract = lambda page: rf.read(names[page])
-                        except:
-                            # rarfile not valid
-                            log.error('Unrar binary not found, or unable to decompress file %s', cbr_file)
-                            return "", 204
-                    else:
-                        log.info('Unrar is not supported please install python rarfile extension')
-                        # no support means return nothing
-                        return "", 204
-                elif book_format in ("cbz", "zip"):
-                    zf = zipfile.ZipFile(cbr_file)
-                    names=sort(zf.namelist())
-                    extract = lambda page: zf.read(names[page])
-                elif book_format in ("cbt", "tar"):
-                    tf = tarfile.TarFile(cbr_file)
-                    names=sort(tf.getnames())
-                    extract = lambda page: tf.extractfile(names[page]).read()
-                else:
-                    log.error('unsupported comic format')
-                    return "", 204
-
-                b64 = codecs.encode(extract(page), 'base64').decode()
-                ext = names[page].rpartition('.')[-1]
-                if ext not in ('png', 'gif', 'jpg', 'jpeg', 'webp'):
-                    ext = 'png'
-                extractedfile="data:image/" + ext + ";base64," + b64
-                fileData={"name": names[page], "page":page, "last":len(names)-1, "content": extractedfile}
-                return make_response(json.dumps(fileData))
+    try:
+        archive = comic_pages.get_archive(comic_file, book_format, config.config_rarfile_location)
+    except Exception as ex:
+        log.error('Unable to open comic file %s: %s', comic_file, ex)
         return "", 204
-'''
+    return jsonify(pages=len(archive.pages), names=archive.pages)
+
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>/<int:page>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_page(book_id, book_format, page):
+    comic_file = get_comic_file(book_id, book_format)
+    if not comic_file:
+        return "", 204
+    width = request.args.get("width", type=int)
+    if width is not None and width <= 0:
+        width = None
+    etag = "{}-{}-{}-{}".format(book_id, int(os.path.getmtime(comic_file)), page, width or 0)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = 3600
+        return response
+    try:
+        archive = comic_pages.get_archive(comic_file, book_format, config.config_rarfile_location)
+    except Exception as ex:
+        log.error('Unable to open comic file %s: %s', comic_file, ex)
+        return "", 204
+    if page >= len(archive.pages):
+        abort(404)
+    try:
+        name, content = comic_pages.get_page(comic_file, book_format, page, width, config.config_rarfile_location)
+    except Exception as ex:
+        log.error('Unable to read page %s of comic file %s: %s', page, comic_file, ex)
+        return "", 204
+    prefetch = min(max(request.args.get("prefetch", 0, type=int), 0), comic_pages.MAX_PREFETCH)
+    next_pages = list(range(page + 1, min(page + 1 + prefetch, len(archive.pages))))
+    comic_pages.prefetch(comic_file, book_format, next_pages, width, config.config_rarfile_location)
+
+    response = make_response(content)
+    response.headers["Content-Type"] = mimetypes.types_map.get(os.path.splitext(name)[1].lower(),
+                                                               "application/octet-stream")
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    for next_page in next_pages:
+        response.headers.add("Link", "<{}>; rel=prefetch".format(
+            url_for("web.get_comic_page", book_id=book_id, book_format=book_format, page=next_page, width=width)))
+    return response.make_conditional(request)
 
 
 # ################################### Typeahead ##################################################################
@@ -347,8 +371,9 @@ def get_matching_tags():
     title_input = request.args.get('title') or ''
     include_tag_inputs = request.args.getlist('include_tag') or ''
     exclude_tag_inputs = request.args.getlist('exclude_tag') or ''
-    q = q.filter(db.Books.authors.any(func.lower(db.Authors.name).ilike("%" + author_input + "%")),
-                 func.lower(db.Books.title).ilike("%" + title_input + "%"))
+    q = q.filter(db.Books.authors.any(search_index.key_filter('authors', db.Authors.id, db.Authors.name,
+                                                              author_input)),
+                 search_index.key_filter('books', db.Books.id, db.Books.title, title_input))
     if len(include_tag_inputs) > 0:
         for tag in include_tag_inputs:
             q = q.filter(db.Books.tags.any(db.Tags.id == tag))
@@ -882,6 +907,7 @@ def list_books():
     search_param = request.args.get("search")
     sort_param = request.args.get("sort", "id")
     order = request.args.get("order", "").lower()
+    cursor = request.args.get("cursor")
     state = None
     join = tuple()
     if not order in ["asc", "desc", ""]:
@@ -906,12 +932,15 @@ def list_books():
         order = [db.Languages.lang_code.asc()] if order == "asc" else [db.Languages.lang_code.desc()]
         join = db.books_languages_link, db.Books.id == db.books_languages_link.c.book, db.Languages
     elif order and sort_param in ["sort", "title", "authors_sort", "series_index"]:
-        order = [text(sort_param + " " + order)]
+        column = {"sort": db.Books.sort, "title": db.Books.title, "authors_sort": db.Books.author_sort,
+                  "series_index": db.Books.series_index}[sort_param]
+        order = [column.asc()] if order == "asc" else [column.desc()]
     elif not state:
         order = [db.Books.timestamp.desc()]
 
-    total_count = filtered_count = calibre_db.session.query(db.Books).filter(
-        calibre_db.common_filters(allow_show_archived=True)).count()
+    total_count = filtered_count = calibre_db.cached_count(calibre_db.session.query(db.Books).filter(
+        calibre_db.common_filters(allow_show_archived=True)))
+    pagination = None
     if state is not None:
         if search_param:
             books = calibre_db.search_query(search_param, config).all()
@@ -928,15 +957,16 @@ def list_books():
                                                                     limit,
                                                                     *join)
     else:
-        entries, __, __ = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
-                                                                        db.Books,
-                                                                        limit,
-                                                                        True,
-                                                                        order,
-                                                                        True,
-                                                                        True,
-                                                                        config.config_read_column,
-                                                                        *join)
+        entries, __, pagination = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
+                                                                                db.Books,
+                                                                                limit,
+                                                                                True,
+                                                                                order,
+                                                                                True,
+                                                                                True,
+                                                                                config.config_read_column,
+                                                                                *join,
+                                                                                cursor=cursor)
 
     result = list()
     for entry in entries:
@@ -949,6 +979,8 @@ def list_books():
         result.append(val)
 
     table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result}
+    if pagination and pagination.next_cursor:
+        table_entries["nextCursor"] = pagination.next_cursor
     js_list = json.dumps(table_entries, cls=db.AlchemyEncoder)
 
     response = make_response(js_list)
@@ -1201,6 +1233,7 @@ def get_cover(book_id, resolution=None):
         'og': constants.COVER_THUMBNAIL_ORIGINAL,
         'sm': constants.COVER_THUMBNAIL_SMALL,
         'md': constants.COVER_THUMBNAIL_MEDIUM,
+        'ml': constants.COVER_THUMBNAIL_MEDIUM_LARGE,
         'lg': constants.COVER_THUMBNAIL_LARGE,
     }
     cover_resolution = resolutions.get(resolution, None)
@@ -1261,18 +1294,8 @@ def serve_book(book_id, book_format, anyname):
     else:
         if book_format.upper() == 'TXT':
             try:
-                rawdata = open(os.path.join(config.get_book_path(), book.path, data.name + "." + book_format),
-                               "rb").read()
-                result = chardet.detect(rawdata)
-                try:
-                    text_data = rawdata.decode(result['encoding']).encode('utf-8')
-                except UnicodeDecodeError as e:
-                    log.error("Encoding error in text file {}: {}".format(book.id, e))
-                    if "surrogate" in e.reason:
-                        text_data = rawdata.decode(result['encoding'], 'surrogatepass').encode('utf-8', 'surrogatepass')
-                    else:
-                        text_data = rawdata.decode(result['encoding'], 'ignore').encode('utf-8', 'ignore')
-                return make_response(text_data)
+                return text_stream.send_text_file(book.id, os.path.join(config.get_book_path(), book.path),
+                                                  data.name + "." + book_format, bool(range_header))
             except FileNotFoundError:
                 log.error("File Not Found")
                 return "File Not Found"
@@ -1684,8 +1707,11 @@ def read_book(book_id, book_format):
                     if book.series_index:
                         title = title + " #" + '{0:.2f}'.format(book.series_index).rstrip('0').rstrip('.')
                 log.debug("Start comic reader for %d", book_id)
+                # pages are loaded one by one from local files, files on Google Drive are loaded as a whole
+                pages_url = url_for("web.get_comic_index", book_id=book_id, book_format=fileExt) \
+                    if get_comic_file(book_id, fileExt) else None
                 return render_title_template('readcbr.html', comicfile=all_name, title=title,
-                                             extension=fileExt, bookmark=bookmark)
+                                             extension=fileExt, bookmark=bookmark, pages_url=pages_url)
         log.debug("Selected book is unavailable. File does not exist or is not accessible")
         flash(_("Oops! Selected book is unavailable. File does not exist or is not accessible"),
               category="error")